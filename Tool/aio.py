@@ -0,0 +1,159 @@
+"""
+This module contains the asyncio plumbing of the OpenAI calls: a pooled aiohttp session and a shared event loop.
+
+openai 0.27 opens a new aiohttp session (and new TCP/TLS connections) for every async request unless a session
+is set in openai.aiosession. get_session gives each event loop one session whose connector keeps up to
+POOL_SIZE keep-alive connections, and pooled_session installs it around a request.
+
+The blocking API (llm_run, llm_completion, ...) is a thin wrapper over the async one: run_sync submits the
+coroutine to a single background event loop, so all threads share its connection pool, and relays the
+callbacks of the coroutine (e.g. streamed fields) back to the calling thread, where Streamlit expects them.
+
+The pool is configured with the OPENAI_POOL_SIZE and OPENAI_KEEPALIVE_TIMEOUT environment variables.
+
+Apps serving several users with their own API keys don't set the global openai.api_key: the key of a scan
+is held in the request_api_key context variable, which every task of the scan inherits, and passed to each
+request (see request_options).
+"""
+import os
+import queue
+import atexit
+import asyncio
+import threading
+from contextvars import ContextVar
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Coroutine, Dict, Iterable, List, Optional
+import aiohttp
+import openai
+
+# Maximum number of open connections per event loop, and idle time before a keep-alive connection is closed
+POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '100'))
+KEEPALIVE_TIMEOUT = float(os.getenv('OPENAI_KEEPALIVE_TIMEOUT', '30'))
+
+# API key of the scan being run (None: openai.api_key)
+request_api_key: ContextVar[Optional[str]] = ContextVar('request_api_key', default=None)
+# Context variables of the calling thread that run_sync sets in the coroutines it runs (see propagate_context_var)
+_propagated_vars: List[ContextVar] = [request_api_key]
+
+_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Function to get the pooled session of the running event loop, created on first use.
+
+    :return: The aiohttp session.
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        # Forget the sessions of loops that have been closed since
+        for stale in [other for other in _sessions if other.is_closed()]:
+            del _sessions[stale]
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        session = _sessions[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+async def close_session() -> None:
+    """
+    Closes the pooled session of the running event loop, e.g. before the loop shuts down.
+    """
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+@asynccontextmanager
+async def pooled_session() -> AsyncIterator[aiohttp.ClientSession]:
+    """
+    Async context manager making the openai requests issued inside it use the pooled session.
+    """
+    session = get_session()
+    token = openai.aiosession.set(session)
+    try:
+        yield session
+    finally:
+        openai.aiosession.reset(token)
+
+def request_options() -> Dict[str, str]:
+    """
+    Function to get the keyword arguments of an openai request for the scan being run, i.e. its API key if set.
+    """
+    api_key = request_api_key.get()
+    return {'api_key': api_key} if api_key else {}
+
+def propagate_context_var(var: ContextVar) -> None:
+    """
+    Function to register a context variable (with a default) whose value in the calling thread is set in the
+    coroutines run by run_sync, like request_api_key, so the blocking API honours it.
+    """
+    if var not in _propagated_vars:
+        _propagated_vars.append(var)
+
+async def _in_context(values: List[Any], coroutine: Coroutine[Any, Any, Any]) -> Any:
+    # The task runs in its own copy of the loop's context, so these values don't leak into other tasks
+    for var, value in values:
+        var.set(value)
+    return await coroutine
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Function to get the shared background event loop, started on first use in a daemon thread.
+
+    :return: The running event loop.
+    """
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            # Blocking steps (SQLite, disk, quota waits) run in threads; size the pool like the connection pool
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='jobscan-io'))
+            _loop_thread = threading.Thread(target=_loop.run_forever, name='jobscan-loop', daemon=True)
+            _loop_thread.start()
+            atexit.register(_shutdown_loop, _loop)
+        return _loop
+
+def _shutdown_loop(loop: asyncio.AbstractEventLoop) -> None:
+    # Close the pooled connections cleanly when the interpreter exits
+    if loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(close_session(), loop).result(timeout=5)
+        except Exception:
+            pass
+
+def run_sync(coroutine_function: Callable[..., Coroutine[Any, Any, Any]], *args: Any,
+             callbacks: Iterable[str] = (), **kwargs: Any) -> Any:
+    """
+    Function to run a coroutine function on the shared event loop and wait for its result.
+    The coroutine sees the values of the propagated context variables of the calling thread.
+
+    :param coroutine_function: The async function, e.g., llm_run_async.
+    :param callbacks: Names of the keyword arguments holding callbacks; they are called in the calling thread.
+    :return: The return value of the coroutine.
+
+    :raises RuntimeError: If called from the shared event loop itself (use the async function there).
+    """
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError('run_sync cannot be called from the shared event loop; await the coroutine instead.')
+    events: 'queue.SimpleQueue[Any]' = queue.SimpleQueue()
+    for name in callbacks:
+        callback = kwargs.get(name)
+        if callback is not None:
+            kwargs[name] = lambda *callback_args, callback=callback: events.put((callback, callback_args))
+    values = [(var, var.get()) for var in _propagated_vars]
+    future = asyncio.run_coroutine_threadsafe(_in_context(values, coroutine_function(*args, **kwargs)), get_loop())
+    future.add_done_callback(lambda _: events.put(None))
+    try:
+        # Relay the callbacks until the coroutine is done
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            callback, callback_args = event
+            callback(*callback_args)
+    except BaseException:
+        future.cancel()
+        raise
+    return future.result()
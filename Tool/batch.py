@@ -0,0 +1,263 @@
+"""
+This module contains the batch scanning engine.
+
+A batch is any iterable of job descriptions (or a JSONL file of them). Every item goes through the same
+pipeline as a single submit (llm_run / llm_deploy_run: cache, moderation, completion, classification),
+spread over a bounded pool of worker threads. Results are streamed back as soon as each item completes and
+carry the item ID, so the caller can restore the input order if needed.
+
+In packed mode (pack=True, see Tool.packing) the items that need a completion are grouped into multi-description
+requests, which cuts the per-description prompt overhead.
+
+Command line usage:
+    python -m Tool.batch postings.jsonl --model GPT-3.5 --role "Data relevant" --workers 8 --output results.jsonl [--pack]
+"""
+import os
+import sys
+import json
+import uuid
+import argparse
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
+from Tool import llm_comp
+from Tool.llm_comp import llm_run, llm_deploy_run, lookup_scan, is_flagged, flagged_scan, finalize_scan, ScanContext, charged_to
+from Tool.budget import BudgetExceeded, BudgetScope
+from Tool.metrics import metrics, span
+from Tool.packing import DEFAULT_PACK_SIZE, DEFAULT_PACK_TOKENS, llm_packed_completion, pack_descriptions
+
+BatchItem = Union[str, Tuple[str, str], Dict[str, Any]]
+
+def read_jsonl_descriptions(file_path: str, text_field: str = 'description', id_field: str = 'id') -> Iterator[Tuple[str, str]]:
+    """
+    Function to lazily read job descriptions from a JSONL file, one JSON object per line.
+    Lines without an ID get their line number as ID; blank lines are skipped.
+
+    :param file_path: Path of the JSONL file.
+    :param text_field: Key holding the job description.
+    :param id_field: Key holding the item ID.
+    :return: A generator of (item_id, description) tuples.
+    """
+    with open(file_path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            item_id = str(record.get(id_field, line_number))
+            yield item_id, record[text_field]
+
+def _iter_items(descriptions: Iterable[BatchItem]) -> Iterator[Tuple[str, str]]:
+    # Accept plain strings (ID = position), (id, text) tuples and dicts with 'id' and 'description' keys
+    for index, item in enumerate(descriptions):
+        if isinstance(item, str):
+            yield str(index), item
+        elif isinstance(item, dict):
+            yield str(item.get('id', index)), item['description']
+        else:
+            item_id, text = item
+            yield str(item_id), text
+
+def _scan_item(model_name: str, role_name: str, item_id: str, user_message: str,
+               store_data: bool, use_cache: bool, budget: Optional[BudgetScope] = None) -> Dict[str, Any]:
+    run = llm_run if store_data else llm_deploy_run
+    try:
+        response_dict, info = run(model_name, role_name, user_message, use_cache=use_cache, budget=budget)
+    except ValueError:
+        # Invalid model or role name: fail the whole batch rather than every item
+        raise
+    except Exception as e:
+        return {'id': item_id, 'info': 'error', 'error': str(e), 'response': {'cost': 0}}
+    return {'id': item_id, 'info': info, 'response': response_dict}
+
+def _precheck_item(model_name: str, role_name: str, item_id: str, user_message: str,
+                   store_data: bool, use_cache: bool) -> Tuple[str, Optional[Dict[str, Any]], ScanContext]:
+    # Everything before the completion: cache, near-duplicates, local classifier and moderation
+    if not use_cache:
+        cache, dedup = None, None
+    elif store_data:
+        cache, dedup = llm_comp.result_cache, llm_comp.dedup_index
+    else:
+        cache, dedup = llm_comp.deploy_result_cache, llm_comp.deploy_dedup_index
+    result, context = lookup_scan(model_name, role_name, user_message, cache, dedup)
+    if result is None:
+        with span('moderation', model_name, role_name):
+            flagged = is_flagged(user_message)
+        if flagged:
+            result = flagged_scan(context)
+    if result is None:
+        return item_id, None, context
+    response_dict, info = result
+    metrics.inc('scans_total', model=model_name, role=role_name, outcome=info or 'ok')
+    return item_id, {'id': item_id, 'info': info, 'response': response_dict}, context
+
+def _packed_item(budget: Optional[BudgetScope], store_data: bool, *args: Any) -> Any:
+    # Packed completion charged to the budget of the batch (worker threads don't inherit the caller's context)
+    with charged_to(budget, store_data):
+        return llm_packed_completion(*args)
+
+def _batch_packed(model_name: str, role_name: str, items: Iterator[Tuple[str, str]], max_workers: int,
+                  store_data: bool, use_cache: bool, pack_tokens: int, pack_size: int,
+                  budget: Optional[BudgetScope] = None) -> Iterator[Dict[str, Any]]:
+    # Items are processed in windows: first the per-item checks, then the packed completions of the window
+    window = max_workers * pack_size
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            chunk = list(islice(items, window))
+            if not chunk:
+                break
+            futures = {executor.submit(_precheck_item, model_name, role_name, item_id, user_message,
+                                       store_data, use_cache): item_id
+                       for item_id, user_message in chunk}
+            contexts = {}
+            for future in as_completed(futures):
+                try:
+                    item_id, record, context = future.result()
+                except ValueError:
+                    raise
+                except Exception as e:
+                    yield {'id': futures[future], 'info': 'error', 'error': str(e), 'response': {'cost': 0}}
+                    continue
+                if record is not None:
+                    yield record
+                else:
+                    contexts[item_id] = context
+            pending = [(item_id, contexts[item_id].user_message) for item_id, _ in chunk if item_id in contexts]
+            pack_futures = {executor.submit(_packed_item, budget, store_data, model_name, role_name,
+                                            [user_message for _, user_message in pack]): pack
+                            for pack in pack_descriptions(pending, pack_tokens=pack_tokens, pack_size=pack_size)}
+            for future in as_completed(pack_futures):
+                pack = pack_futures[future]
+                try:
+                    completions = future.result()
+                except ValueError:
+                    raise
+                except BudgetExceeded:
+                    for item_id, _ in pack:
+                        yield {'id': item_id, 'info': 'over_budget', 'response': {'cost': 0}}
+                    continue
+                except Exception as e:
+                    for item_id, _ in pack:
+                        yield {'id': item_id, 'info': 'error', 'error': str(e), 'response': {'cost': 0}}
+                    continue
+                for (item_id, _), (response, token_usage) in zip(pack, completions):
+                    response_dict, info = finalize_scan(contexts[item_id], response, token_usage, store_data)
+                    metrics.inc('scans_total', model=model_name, role=role_name, outcome=info or 'ok')
+                    yield {'id': item_id, 'info': info, 'response': response_dict}
+
+def batch_run(model_name: str,
+              role_name: str,
+              descriptions: Iterable[BatchItem],
+              max_workers: int = 8,
+              store_data: bool = True,
+              use_cache: bool = True,
+              pack: bool = False,
+              pack_tokens: int = DEFAULT_PACK_TOKENS,
+              pack_size: int = DEFAULT_PACK_SIZE,
+              budget_limit: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Scans many job descriptions concurrently and yields the results as they complete.
+
+    At most 2 * max_workers items (max_workers * pack_size in packed mode) are read ahead of the workers,
+    so arbitrarily large (or lazy) inputs are processed in constant memory.
+
+    :param model_name: Name of the model to use, e.g., 'GPT-3.5' or 'GPT-4', or 'Cascade' (see llm_run).
+    :param role_name: Role for the conversation, e.g., 'Data relevant', 'Software Engineer', 'General'.
+    :param descriptions: Iterable of job descriptions, (id, description) tuples or dicts with 'id' and 'description'.
+    :param max_workers: Number of concurrent worker threads.
+    :param store_data: Whether to store inputs and outputs like llm_run (True) or not like llm_deploy_run (False).
+    :param use_cache: Whether to serve repeated job descriptions from the result cache.
+    :param pack: Whether to send several descriptions per completion request (see Tool.packing).
+    :param pack_tokens: Maximum prompt tokens of the descriptions of one pack.
+    :param pack_size: Maximum number of descriptions of one pack.
+    :param budget_limit: Spend limit of the whole batch in dollars (see Tool.budget), None for no limit; once it is
+                         reached, the items that need a completion get info 'over_budget' without calling the API.
+    :return: A generator of dictionaries with keys 'id', 'info' and 'response' (the response dictionary including the cost);
+             items that raised carry info 'error' and an 'error' message.
+
+    :raises ValueError: If max_workers is not positive, the model_name or role_name is not valid,
+                        or the 'Cascade' model or the 'functions' extraction mode is used in packed mode.
+    """
+    if max_workers < 1:
+        raise ValueError(f"'max_workers' must be positive, got {max_workers}.")
+    if pack and model_name == llm_comp.CASCADE_MODEL:
+        raise ValueError(f"'{model_name}' can't be used in packed mode; choose one model.")
+    if pack and llm_comp.extraction_mode == 'functions':
+        # Packs are always sent with the prose prompt, the cache keys would carry the function-calling version
+        raise ValueError("Packed mode can't be used with the 'functions' extraction mode.")
+    items = _iter_items(descriptions)
+    budget = BudgetScope(batch=uuid.uuid4().hex, batch_limit=budget_limit)
+    if pack:
+        yield from _batch_packed(model_name, role_name, items, max_workers, store_data, use_cache, pack_tokens, pack_size,
+                                 budget)
+        return
+    max_pending = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        exhausted = False
+        while pending or not exhausted:
+            # Keep the pool fed without materializing the whole input
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    item_id, user_message = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(_scan_item, model_name, role_name, item_id, user_message,
+                                            store_data, use_cache, budget))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Scan a JSONL file of job descriptions with JobScanGPT.')
+    parser.add_argument('input', help='JSONL file with one job description per line.')
+    parser.add_argument('--model', default='GPT-3.5', choices=['GPT-3.5', 'GPT-4', 'Cascade'],
+                        help='Cascade tries GPT-3.5 first and escalates uncertain extractions to GPT-4.')
+    parser.add_argument('--role', default='Data relevant', choices=['Data relevant', 'Software Engineer', 'General'])
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent workers.')
+    parser.add_argument('--text-field', default='description', help='JSON key holding the job description.')
+    parser.add_argument('--id-field', default='id', help='JSON key holding the item ID.')
+    parser.add_argument('--output', default=None, help='JSONL file for the results (default: stdout).')
+    parser.add_argument('--no-store', action='store_true', help="Don't store inputs and outputs under data/.")
+    parser.add_argument('--no-cache', action='store_true', help="Don't use the result cache.")
+    parser.add_argument('--pack', action='store_true', help='Send several descriptions per completion request.')
+    parser.add_argument('--pack-size', type=int, default=DEFAULT_PACK_SIZE, help='Maximum descriptions per packed request.')
+    parser.add_argument('--speculative', action='store_true', help="Don't wait for the moderation verdict before the completion.")
+    parser.add_argument('--mode', default='prompt', choices=['prompt', 'functions'],
+                        help='Extraction mode of the single scans: JSON described in the prompt, or function calling.')
+    parser.add_argument('--budget', type=float, default=None,
+                        help="Spend limit of the batch in dollars; items beyond it get info 'over_budget'.")
+    args = parser.parse_args()
+    if args.pack and args.mode == 'functions':
+        parser.error("--pack can't be used with --mode functions.")
+
+    # Load API
+    import openai
+    from dotenv import load_dotenv
+    _ = load_dotenv('API_key/.env')
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+
+    llm_comp.speculative_moderation = args.speculative
+    llm_comp.extraction_mode = args.mode
+    descriptions = read_jsonl_descriptions(args.input, text_field=args.text_field, id_field=args.id_field)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    summary = {}
+    total_cost = 0
+    try:
+        for result in batch_run(args.model, args.role, descriptions, max_workers=args.workers,
+                                store_data=not args.no_store, use_cache=not args.no_cache,
+                                pack=args.pack, pack_size=args.pack_size, budget_limit=args.budget):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            summary[str(result['info'])] = summary.get(str(result['info']), 0) + 1
+            total_cost += result['response'].get('cost', 0)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Scanned {sum(summary.values())} items {summary}, total cost {round(total_cost, 4)}$", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+This module contains the compressed, content-addressed store of the raw job descriptions.
+
+Instead of one small text file per scan, the descriptions are appended to a few large pack files
+(data/text_store/pack-00000.pack, ...), each compressed on its own with zstd when the zstandard package is
+installed and zlib otherwise, and deduplicated by the SHA-256 digest of their text. A SQLite index (WAL mode)
+maps every digest to its pack, offset and length, and every stored scan (record ID) to its digest, company
+and model. That gives random reads with one seek, iteration in disk order, lookups by company, and no file
+name built from model output. The record ID is saved with the extraction in data/LLM_output under 'text_id'.
+
+Every blob in a pack starts with a header (magic, codec, digest, length), so the packs are self-describing
+and are checked against their digest when read.
+"""
+import os
+import zlib
+import time
+import uuid
+import struct
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: writers are then only serialized within the process
+    fcntl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A new pack file is started once the current one reaches this size
+PACK_SIZE = 256 * 1024 * 1024
+_MAGIC = b'JSB1'
+# Magic, codec, SHA-256 digest, length of the compressed payload
+_HEADER = struct.Struct('>4sB32sI')
+_ZLIB, _ZSTD = 1, 2
+
+def _compress(data: bytes) -> Tuple[int, bytes]:
+    if zstandard is not None:
+        return _ZSTD, zstandard.ZstdCompressor(level=10).compress(data)
+    return _ZLIB, zlib.compress(data, 9)
+
+def _decompress(codec: int, payload: bytes) -> bytes:
+    if codec == _ZSTD:
+        if zstandard is None:
+            raise RuntimeError('This blob is zstd-compressed; install the zstandard package to read it.')
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+class BlobStore:
+    """
+    Append-only pack store of the raw job descriptions, indexed in SQLite.
+
+    :param directory: Directory of the pack files and of the index database.
+    :param pack_size: Size at which a new pack file is started.
+    """
+    def __init__(self, directory: str = os.path.join('data', 'text_store'), pack_size: int = PACK_SIZE) -> None:
+        self.directory = directory
+        self.pack_size = pack_size
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the database lazily so importing the module has no side effect on disk
+        if self._conn is None:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            self._conn = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    digest TEXT PRIMARY KEY,
+                    pack INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    codec INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS records (
+                    record_id TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL REFERENCES blobs (digest),
+                    company TEXT,
+                    model TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_records_company ON records (company COLLATE NOCASE);
+                CREATE INDEX IF NOT EXISTS idx_records_digest ON records (digest);
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def _pack_path(self, pack: int) -> str:
+        return os.path.join(self.directory, f"pack-{pack:05d}.pack")
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        # Exclusive lock shared by threads and processes appending to the packs
+        with open(os.path.join(self.directory, 'pack.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _append(self, digest: bytes, codec: int, payload: bytes) -> Tuple[int, int]:
+        # Append one compressed blob to the current pack; returns its pack and payload offset
+        pack = 0
+        while os.path.exists(self._pack_path(pack + 1)):
+            pack += 1
+        if os.path.exists(self._pack_path(pack)) and os.path.getsize(self._pack_path(pack)) >= self.pack_size:
+            pack += 1
+        with open(self._pack_path(pack), 'ab') as f:
+            start = f.seek(0, os.SEEK_END)
+            f.write(_HEADER.pack(_MAGIC, codec, digest, len(payload)) + payload)
+        return pack, start + _HEADER.size
+
+    def put(self, text: str, company: Optional[str] = None, model: Optional[str] = None) -> str:
+        """
+        Stores a job description; identical texts are stored once.
+
+        :param text: The job description.
+        :param company: Company name of the extraction, for lookups with find.
+        :param model: Model name of the extraction.
+        :return: The record ID of this scan, to read the text back with get.
+        """
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data)
+        record_id = uuid.uuid4().hex
+        # Compress outside the locks; the work is wasted only for duplicates
+        codec, payload = _compress(data)
+        with self._lock:
+            conn = self._connect()
+            with self._write_lock():
+                row = conn.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest.hexdigest(),)).fetchone()
+                if row is None:
+                    pack, offset = self._append(digest.digest(), codec, payload)
+                    conn.execute("INSERT INTO blobs (digest, pack, offset, length, size, codec) VALUES (?, ?, ?, ?, ?, ?)",
+                                 (digest.hexdigest(), pack, offset, len(payload), len(data), codec))
+                conn.execute("INSERT INTO records (record_id, digest, company, model, created_at) VALUES (?, ?, ?, ?, ?)",
+                             (record_id, digest.hexdigest(), company, model, time.time()))
+                conn.commit()
+        return record_id
+
+    def _read(self, digest: str, pack: int, offset: int, length: int, codec: int) -> str:
+        with open(self._pack_path(pack), 'rb') as f:
+            f.seek(offset)
+            payload = f.read(length)
+        data = _decompress(codec, payload)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Blob {digest} is corrupted in {self._pack_path(pack)}.")
+        return data.decode('utf-8')
+
+    def get(self, record_id: str) -> Optional[str]:
+        """
+        Reads the job description of a scan.
+
+        :param record_id: The record ID returned by put (the 'text_id' of the stored extraction).
+        :return: The job description, or None if the record ID is unknown.
+        """
+        with self._lock:
+            row = self._connect().execute("""
+                SELECT blobs.digest, pack, offset, length, codec FROM records JOIN blobs USING (digest)
+                WHERE record_id = ?""", (record_id,)).fetchone()
+        return None if row is None else self._read(*row)
+
+    def created_at(self, record_id: str) -> Optional[float]:
+        """
+        :return: The time (seconds since the epoch) the text of a scan was stored, or None if the record ID is unknown.
+        """
+        with self._lock:
+            row = self._connect().execute("SELECT created_at FROM records WHERE record_id = ?", (record_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def find(self, company: str) -> List[Dict[str, Any]]:
+        """
+        Looks up the scans of a company (case-insensitive).
+
+        :return: One dictionary per scan with the record_id, company, model and created_at, latest first.
+        """
+        with self._lock:
+            rows = self._connect().execute("""
+                SELECT record_id, company, model, created_at FROM records WHERE company = ? COLLATE NOCASE
+                ORDER BY created_at DESC""", (company,)).fetchall()
+        return [dict(zip(('record_id', 'company', 'model', 'created_at'), row)) for row in rows]
+
+    def iter_texts(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates over the distinct job descriptions in disk order (one sequential pass per pack).
+
+        :return: A generator of (digest, text) tuples.
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT digest, pack, offset, length, codec FROM blobs ORDER BY pack, offset").fetchall()
+        for row in rows:
+            yield row[0], self._read(*row)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The number of records, distinct blobs and packs, and the raw and stored bytes.
+        """
+        with self._lock:
+            conn = self._connect()
+            records = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            blobs, raw, stored, packs = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(length), 0), COUNT(DISTINCT pack) FROM blobs").fetchone()
+        return {'records': records, 'blobs': blobs, 'packs': packs, 'raw_bytes': raw,
+                'stored_bytes': stored + blobs * _HEADER.size}
+
+    def import_text_files(self, directory: str = os.path.join('data', 'text_input'), remove: bool = True) -> int:
+        """
+        Moves the text files written by Tool.utils.write_to_file into the store; the company is taken
+        from the file name (<Company>_<timestamp>.txt).
+
+        :param directory: Directory of the text files.
+        :param remove: Whether to delete every file once it is stored (False copies them into the store).
+        :return: The number of files imported.
+        """
+        if not os.path.isdir(directory):
+            return 0
+        count = 0
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.endswith('.txt') or not os.path.isfile(path):
+                continue
+            with open(path, 'r') as f:
+                text = f.read()
+            company = name[:-len('.txt')].rsplit('_', 1)[0].replace('_', ' ')
+            self.put(text, company=company)
+            if remove:
+                os.remove(path)
+            count += 1
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,278 @@
+"""
+This module contains the price table of the models and the spend budget of the scans.
+
+Prices are dollars per 1,000 tokens per API model, in the `prices` table; they can be overridden with a JSON file
+({"gpt-4": {"prompt": 0.03, "completion": 0.06}, ...}) given to load_prices or in the JOBSCAN_PRICES environment
+variable, so a price change or a new model needs no code change.
+
+Every completion request goes through the BudgetLedger (see Tool.llm_comp.get_completion_from_messages_async):
+- Before the request, its worst-case cost is estimated from the prompt tokens and the max_tokens ceiling and
+  reserved against the limits of the scan: the daily limit (daily_limit, JOBSCAN_DAILY_BUDGET), and the limits
+  of its session and batch (BudgetScope, held in the current_budget context variable). A request that would
+  exceed a limit raises BudgetExceeded instead of being sent; the scan then ends with info 'over_budget'.
+- After the request, the reservation is released and the actual cost of the token usage is written to a SQLite
+  ledger (one row per request), together with running totals per day, session and batch, in one transaction.
+  The usage of a streamed completion is counted locally; its row is flagged as an estimate.
+The totals and the reservations are rows of the database, checked and updated in immediate transactions, so the
+limits hold across all the processes using the same database (e.g. the workers of Tool.service). Reservations
+left by a process that died are deleted after RESERVATION_SECONDS.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from Tool.aio import propagate_context_var
+
+class ModelPrice(NamedTuple):
+    """
+    Price of an API model in dollars per 1,000 prompt and completion tokens.
+    """
+    prompt: float
+    completion: float
+
+prices: Dict[str, ModelPrice] = {
+    'gpt-3.5-turbo': ModelPrice(0.0015, 0.002),
+    'gpt-4': ModelPrice(0.03, 0.06),
+}
+# Spend limit in dollars per day across all scans (None: no limit)
+daily_limit: Optional[float] = float(os.getenv('JOBSCAN_DAILY_BUDGET')) if os.getenv('JOBSCAN_DAILY_BUDGET') else None
+# Seconds after which the reservation of a request that was never settled (its process died) is deleted
+RESERVATION_SECONDS = 900
+
+def load_prices(file_path: str) -> None:
+    """
+    Function to update the price table from a JSON file mapping API model names to their prompt and completion
+    prices per 1,000 tokens.
+    """
+    with open(file_path, 'r') as f:
+        table = json.load(f)
+    prices.update({model: ModelPrice(float(price['prompt']), float(price['completion'])) for model, price in table.items()})
+
+if os.getenv('JOBSCAN_PRICES'):
+    load_prices(os.getenv('JOBSCAN_PRICES'))
+
+def token_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Function to compute the cost of a request from the price table.
+
+    :param model: The API model name, e.g., 'gpt-3.5-turbo'.
+    :return: The cost in dollars.
+
+    :raises ValueError: If the model has no price.
+    """
+    if model not in prices:
+        raise ValueError(f"No price for the model '{model}'. Add it to Tool.budget.prices or load_prices.")
+    price = prices[model]
+    return prompt_tokens / 1000 * price.prompt + completion_tokens / 1000 * price.completion
+
+class BudgetScope(NamedTuple):
+    """
+    Session and batch a scan is charged to, each with its spend limit in dollars (None: no limit).
+    """
+    session: Optional[str] = None
+    session_limit: Optional[float] = None
+    batch: Optional[str] = None
+    batch_limit: Optional[float] = None
+
+# Budget scope of the scan being run (None: only the daily limit applies)
+current_budget: ContextVar[Optional[BudgetScope]] = ContextVar('current_budget', default=None)
+propagate_context_var(current_budget)
+
+class BudgetExceeded(Exception):
+    """
+    Raised instead of sending a request whose estimated cost would exceed a spend limit.
+    """
+    def __init__(self, kind: str, key: str, limit: float, spent: float, estimate: float) -> None:
+        super().__init__(f"The {kind} budget of {limit}$ would be exceeded: {round(spent, 4)}$ spent or reserved, "
+                         f"{round(estimate, 4)}$ requested.")
+        self.kind, self.key, self.limit, self.spent, self.estimate = kind, key, limit, spent, estimate
+
+class Reservation(NamedTuple):
+    """
+    Estimated cost of a request in flight, held against the totals of its scopes.
+    """
+    model: str
+    estimate: float
+    scope: Optional[BudgetScope]
+    day: str
+    ids: Tuple[int, ...] = ()
+
+def _today() -> str:
+    return time.strftime('%Y-%m-%d')
+
+class BudgetLedger:
+    """
+    SQLite (WAL mode) ledger of the actual spend, with the reservations of the requests in flight.
+
+    :param db_path: Path of the SQLite database.
+    """
+    def __init__(self, db_path: str = os.path.join('data', 'budget.sqlite')) -> None:
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the database lazily so importing the module has no side effect on disk
+        if self._conn is None:
+            directory_name = os.path.dirname(self.db_path)
+            if directory_name and not os.path.exists(directory_name):
+                os.makedirs(directory_name)
+            # Autocommit mode: every update opens its own immediate transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS ledger (
+                    id INTEGER PRIMARY KEY,
+                    at REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    session TEXT,
+                    batch TEXT,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    cost REAL NOT NULL,
+                    estimated INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS totals (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    cost REAL NOT NULL,
+                    requests INTEGER NOT NULL,
+                    PRIMARY KEY (kind, key)
+                );
+                CREATE TABLE IF NOT EXISTS reservations (
+                    id INTEGER PRIMARY KEY,
+                    at REAL NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    estimate REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_reservations_scope ON reservations (kind, key);
+            """)
+            # Ledgers of older versions have no estimate flag
+            if 'estimated' not in [row[1] for row in conn.execute("PRAGMA table_info(ledger)")]:
+                conn.execute("ALTER TABLE ledger ADD COLUMN estimated INTEGER NOT NULL DEFAULT 0")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _scopes(scope: Optional[BudgetScope], day: str) -> List[Tuple[str, str, Optional[float]]]:
+        # (kind, key, limit) of every total a request counts towards
+        scopes = [('day', day, daily_limit)]
+        if scope is not None and scope.session is not None:
+            scopes.append(('session', scope.session, scope.session_limit))
+        if scope is not None and scope.batch is not None:
+            scopes.append(('batch', scope.batch, scope.batch_limit))
+        return scopes
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # Immediate transaction: the checks and updates of a reservation are atomic across processes
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def reserve(self, model: str, estimate: float, scope: Optional[BudgetScope] = None) -> Reservation:
+        """
+        Reserves the estimated cost of a request against the limits of its scopes.
+
+        :param model: The API model name.
+        :param estimate: Worst-case cost of the request.
+        :param scope: Session and batch of the request, None for the daily limit only.
+        :return: The reservation, to pass to settle (or release if the request is not sent).
+
+        :raises BudgetExceeded: If the spend and reservations of a scope plus the estimate exceed its limit.
+        """
+        day = _today()
+        scopes = self._scopes(scope, day)
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM reservations WHERE at < ?", (now - RESERVATION_SECONDS,))
+            for kind, key, limit in scopes:
+                if limit is None:
+                    continue
+                row = conn.execute("""
+                    SELECT (SELECT cost FROM totals WHERE kind = ? AND key = ?),
+                           (SELECT SUM(estimate) FROM reservations WHERE kind = ? AND key = ?)""",
+                    (kind, key, kind, key)).fetchone()
+                spent = (row[0] or 0.0) + (row[1] or 0.0)
+                if spent + estimate > limit:
+                    raise BudgetExceeded(kind, key, limit, spent, estimate)
+            ids = tuple(conn.execute("INSERT INTO reservations (at, kind, key, estimate) VALUES (?, ?, ?, ?)",
+                                     (now, kind, key, estimate)).lastrowid for kind, key, _ in scopes)
+        return Reservation(model, estimate, scope, day, ids)
+
+    def release(self, reservation: Reservation) -> None:
+        """
+        Releases a reservation without recording any spend.
+        """
+        with self._transaction() as conn:
+            self._release(conn, reservation)
+
+    @staticmethod
+    def _release(conn: sqlite3.Connection, reservation: Reservation) -> None:
+        conn.executemany("DELETE FROM reservations WHERE id = ?", [(id_,) for id_ in reservation.ids])
+
+    def settle(self, reservation: Reservation, token_usage: Dict[str, int]) -> float:
+        """
+        Releases a reservation and records the actual cost of the request.
+
+        :param token_usage: Dictionary of token usage details, with keys 'prompt_tokens' and 'completion_tokens',
+            and 'estimated' if the tokens were counted locally (streamed completion).
+        :return: The actual cost.
+        """
+        cost = token_cost(reservation.model, token_usage['prompt_tokens'], token_usage['completion_tokens'])
+        scope = reservation.scope or BudgetScope()
+        with self._transaction() as conn:
+            self._release(conn, reservation)
+            conn.execute("""
+                INSERT INTO ledger (at, day, model, session, batch, prompt_tokens, completion_tokens, cost, estimated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (time.time(), reservation.day, reservation.model, scope.session, scope.batch,
+                 token_usage['prompt_tokens'], token_usage['completion_tokens'], cost, int(bool(token_usage.get('estimated')))))
+            conn.executemany("""
+                INSERT INTO totals (kind, key, cost, requests) VALUES (?, ?, ?, 1)
+                ON CONFLICT (kind, key) DO UPDATE SET cost = cost + excluded.cost, requests = requests + 1""",
+                [(kind, key, cost) for kind, key, _ in self._scopes(reservation.scope, reservation.day)])
+        return cost
+
+    def spent(self, kind: str, key: str) -> float:
+        """
+        :param kind: 'day', 'session' or 'batch'.
+        :param key: The day (YYYY-MM-DD), session or batch ID.
+        :return: The recorded spend of the scope.
+        """
+        with self._lock:
+            row = self._connect().execute("SELECT cost FROM totals WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        return row[0] if row else 0.0
+
+    def summary(self, days: int = 7) -> List[Dict[str, Any]]:
+        """
+        :return: The number of requests, tokens and spend per day and model over the last days, latest first,
+                 with the part of the spend counted from estimated usage (streamed completions).
+        """
+        since = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+        with self._lock:
+            rows = self._connect().execute("""
+                SELECT day, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost),
+                       SUM(CASE WHEN estimated THEN cost ELSE 0 END) FROM ledger
+                WHERE day >= ? GROUP BY day, model ORDER BY day DESC, model""", (since,)).fetchall()
+        keys = ('day', 'model', 'requests', 'prompt_tokens', 'completion_tokens', 'cost', 'estimated_cost')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,140 @@
+"""
+This module contains a content-addressed cache for LLM scan results.
+
+A result is keyed on a hash of the normalized job description, the model name, the role name and the
+prompt version, so re-submitting the same job description skips both the moderation and the completion call.
+Entries are stored in a small SQLite database and evicted by age (TTL) and by least recent use once the
+cache grows beyond its size cap.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, Optional, Tuple
+from Tool.utils import normalize_job_text
+
+def make_cache_key(user_message: str, model_name: str, role_name: str, prompt_version: str) -> str:
+    """
+    Function to build the cache key of a scan request.
+
+    :param user_message: The job description.
+    :param model_name: Name of the model, e.g., 'GPT-3.5' or 'GPT-4'.
+    :param role_name: Role for the conversation, e.g., 'Data relevant', 'Software Engineer', 'General'.
+    :param prompt_version: Version of the role prompt (see Tool.prompt.prompt_versions).
+    :return: A hex digest identifying the request.
+    """
+    payload = '\x1f'.join([normalize_job_text(user_message), model_name, role_name, prompt_version])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """
+    SQLite-backed LRU/TTL cache of (response_dict, info) pairs returned by llm_run.
+
+    :param db_path: Path of the SQLite database, or ':memory:' for a cache living only in this process.
+    :param max_entries: Size cap; the least recently used entries are evicted beyond it.
+    :param ttl: Time to live of an entry in seconds, None to never expire.
+    """
+    def __init__(self,
+                 db_path: str = os.path.join('data', 'cache', 'llm_cache.sqlite'),
+                 max_entries: int = 10000,
+                 ttl: Optional[float] = 30 * 24 * 3600) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the database lazily so importing the module has no side effect on disk
+        if self._conn is None:
+            if self.db_path != ':memory:':
+                directory_name = os.path.dirname(self.db_path)
+                if directory_name and not os.path.exists(directory_name):
+                    os.makedirs(directory_name)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_last_access ON results (last_access)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], Optional[str]]]:
+        """
+        Look up a cached result and refresh its recency.
+
+        :param key: The key built by make_cache_key.
+        :return: A tuple of (response_dict, info) or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        value = json.loads(row[0])
+        return value['response'], value['info']
+
+    def set(self, key: str, response_dict: Dict[str, Any], info: Optional[str]) -> None:
+        """
+        Store a result and evict expired or least recently used entries beyond the size cap.
+
+        :param key: The key built by make_cache_key.
+        :param response_dict: The response dictionary without the cost.
+        :param info: The info string returned along with the response.
+        :return: None
+        """
+        now = time.time()
+        value = json.dumps({'response': response_dict, 'info': info})
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO results (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                         (key, value, now, now))
+            if self.ttl is not None:
+                conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl,))
+            count = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute("""
+                    DELETE FROM results WHERE key IN (
+                        SELECT key FROM results ORDER BY last_access ASC LIMIT ?
+                    )""", (count - self.max_entries,))
+            conn.commit()
+
+    def clear(self) -> None:
+        """
+        Remove every entry and reset the hit/miss counters.
+
+        :return: None
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM results")
+            conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report the cache counters.
+
+        :return: A dictionary with the number of hits, misses and stored entries.
+        """
+        with self._lock:
+            size = self._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
@@ -0,0 +1,98 @@
+"""
+This module contains a cheap local classifier deciding whether an input looks like a job description.
+
+It runs on the CPU in well under a millisecond and is used as a gate in front of moderation and completion:
+inputs scoring below the threshold are rejected as 'not_job' without any API call. The score counts how many
+distinct groups of job-posting vocabulary (responsibilities, qualifications, experience, education,
+employment type, compensation, job titles, ...) appear in the text. Short inputs can't mention many groups, so
+the number of groups needed for a full score shrinks with the length of the text: a one-line posting such as
+"Senior Data Scientist at Google. Python, SQL, 5 years." passes on its title, seniority and experience alone.
+The threshold is deliberately low so that only obvious non-job inputs are rejected; anything ambiguous is left
+to the LLM.
+Use evaluate_classifier to measure precision/recall of a threshold against a labeled set.
+"""
+import re
+from typing import Dict, Iterable, Tuple
+
+# Each group counts at most once, so a text repeating one keyword can't look like a job description
+_SIGNAL_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r"\bresponsibilit|\bduties\b|\bwhat you'?ll do\b",
+    r"\bqualifications?\b|\brequirements?\b|\bwhat we'?re looking for\b",
+    r"\bwe are (?:looking|seeking)\b|\bwe'?re (?:looking|seeking)\b|\bhiring\b|\bjoin (?:us|our)\b",
+    r"\byou will\b|\byou'll\b|\bthe ideal candidate\b",
+    r"\byears? of (?:\w+ )?experience\b|\bexperience (?:with|in)\b|\+ years\b|\b\d+\+? ?(?:years?|yrs)\b",
+    r"\bbachelor'?s?\b|\bmaster'?s?\b|\bph\.?d\b|\bdegree\b",
+    r"\bfull[- ]time\b|\bpart[- ]time\b|\binternship\b|\bintern\b|\bcontract(?:or)?\b",
+    r"\bsalary\b|\bcompensation\b|\bpay rate\b|\bper hour\b|\$\s?\d",
+    r"\bbenefits\b|\b401\(?k\)?|\bpto\b|\bhealth insurance\b|\bpaid time off\b",
+    r"\bapply\b|\bapplicants?\b|\bcandidates?\b",
+    r"\bequal (?:employment )?opportunity\b|\beeo\b",
+    r"\bvisa\b|\bsponsorship\b|\bpermanent resident\b|\bcitizenship\b",
+    r"\b(?:this|the) (?:role|position)\b|\bjob (?:title|description|type)\b|\bopening\b",
+    r"\bskills?\b|\bproficien|\bfamiliarity with\b",
+    r"\bremote\b|\bhybrid\b|\bon-?site\b|\blocation\b",
+    r"\bpreferred\b|\brequired\b|\bmust have\b|\bnice to have\b|\bplus\b",
+    r"\b(?:engineer|developer|scientist|analyst|architect|designer|manager|nurse|technician|consultant|"
+    r"administrator|specialist|recruiter|accountant)s?\b",
+    r"\bsenior\b|\bjunior\b|\bsr\.|\bjr\.|\bstaff\b|\bprincipal\b|\bentry[- ]level\b",
+]]
+# Number of signal groups at which the score saturates, number of words below which fewer groups are needed
+# (proportionally), and fewest groups ever needed for a full score
+_SATURATION = 8
+_MIN_WORDS = 30
+_MIN_SATURATION = 2
+DEFAULT_THRESHOLD = 0.2
+
+def job_description_score(text: str) -> float:
+    """
+    Function to score how much a text looks like a job description.
+
+    :param text: The input text.
+    :return: A score between 0 (certainly not a job description) and 1.
+    """
+    words = len(text.split())
+    if words == 0:
+        return 0.0
+    signals = sum(1 for pattern in _SIGNAL_PATTERNS if pattern.search(text))
+    saturation = max(_MIN_SATURATION, _SATURATION * min(1.0, words / _MIN_WORDS))
+    return min(1.0, signals / saturation)
+
+def is_job_description(text: str, threshold: float = DEFAULT_THRESHOLD) -> bool:
+    """
+    Function to check if a text is likely a job description.
+
+    :param text: The input text.
+    :param threshold: Minimum score to accept the text; 0 accepts everything.
+    :return: True if the score reaches the threshold, False otherwise.
+    """
+    return job_description_score(text) >= threshold
+
+def evaluate_classifier(samples: Iterable[Tuple[str, bool]], threshold: float = DEFAULT_THRESHOLD) -> Dict[str, float]:
+    """
+    Function to measure the classifier against labeled samples. Job descriptions are the positive class, so
+    recall is the share of job descriptions let through and precision the share of accepted inputs that are
+    job descriptions.
+
+    :param samples: Iterable of (text, is_job_description) pairs.
+    :param threshold: The threshold to evaluate.
+    :return: A dictionary with the confusion counts, precision, recall and accuracy.
+    """
+    tp = fp = tn = fn = 0
+    for text, label in samples:
+        predicted = is_job_description(text, threshold)
+        if predicted and label:
+            tp += 1
+        elif predicted:
+            fp += 1
+        elif label:
+            fn += 1
+        else:
+            tn += 1
+    total = tp + fp + tn + fn
+    return {
+        'threshold': threshold,
+        'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn,
+        'precision': tp / (tp + fp) if tp + fp else 1.0,
+        'recall': tp / (tp + fn) if tp + fn else 1.0,
+        'accuracy': (tp + tn) / total if total else 1.0,
+    }
@@ -0,0 +1,137 @@
+"""
+This module contains a local confidence score of an extraction, used to decide when a cheap model's answer
+must be escalated to a stronger model (see the 'Cascade' model of Tool.llm_comp).
+
+The score starts at 1 and is lowered, without any API call, for every sign of an uncertain answer:
+- no record at all (unparseable output, or a refusal of an input the local classifier accepted),
+- fields still missing or outside their [options] after the re-ask (schema and enum violations),
+- output that had to be repaired,
+- a high density of 'not mentioned' values, which smaller models use when they skim long descriptions,
+- disagreement with cheap regex heuristics on the description (job type, years of experience, minimum
+  education, visa sponsorship, permanent residency), and a YoE_level inconsistent with YoE_year.
+The reasons are returned with the score so that escalations can be audited.
+"""
+import re
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+from Tool.prompt import PromptField
+from Tool.schema import NOT_MENTIONED, ParsedOutput
+
+# Score below which an extraction is considered uncertain
+DEFAULT_CONFIDENCE_THRESHOLD = 0.7
+# Penalties per sign of uncertainty
+_INVALID_FIELD_PENALTY = 0.25
+_REPAIR_PENALTY = 0.05
+_DISAGREEMENT_PENALTY = 0.2
+# Share of 'not mentioned' fields tolerated before the score is lowered
+_NOT_MENTIONED_TOLERANCE = 0.5
+
+_JOB_TYPES = [
+    ('Intern', re.compile(r"\binternship\b|\bintern\b", re.IGNORECASE)),
+    ('Contractor', re.compile(r"\bcontract(?:or)?\b|\bper hour\b|\bpay rate\b|\bduration\b", re.IGNORECASE)),
+    ('Full time', re.compile(r"\bfull[- ]time\b", re.IGNORECASE)),
+]
+_EDUCATION = [
+    ('Bachelor', re.compile(r"\bbachelor'?s?\b|\bb\.?s\.?\b|\bundergraduate degree\b", re.IGNORECASE)),
+    ('Master', re.compile(r"\bmaster'?s?\b|\bm\.?s\.? degree\b", re.IGNORECASE)),
+    ('Phd only', re.compile(r"\bph\.?d\.?\b|\bdoctorate\b|\bdoctoral\b", re.IGNORECASE)),
+]
+_YEARS = re.compile(r"\b(\d{1,2})\s*\+?\s*(?:(?:-|to)\s*\d{1,2}\s*\+?\s*)?years?(?:\s+of)?(?:\s+[\w/-]+){0,3}?\s+experience",
+                    re.IGNORECASE)
+_NO_VISA = re.compile(r"\b(?:unable to|not able to|cannot|can't|will not|won't|does not|do not|not)\s+"
+                      r"(?:sponsor\b|(?:provide|offer)\s+(?:\w+\s+){0,2}?sponsorship\b)"
+                      r"|\bno (?:visa )?sponsorship\b|\bwithout (?:visa )?sponsorship\b", re.IGNORECASE)
+_VISA = re.compile(r"\bvisa sponsorship (?:is )?(?:available|provided|offered)\b|\bwill sponsor\b"
+                   r"|\b(?:provide|offer)s? (?:visa )?sponsorship\b", re.IGNORECASE)
+_RESIDENCY = re.compile(r"\bpermanent resident|\bgreen card\b|\bu\.?s\.? citizen", re.IGNORECASE)
+
+class Confidence(NamedTuple):
+    """
+    Result of score_extraction.
+
+    :param score: Confidence between 0 (certainly wrong) and 1.
+    :param reasons: The signs of uncertainty found, e.g., 'invalid:JobType' or 'disagrees:Min_Education'.
+    """
+    score: float
+    reasons: List[str]
+
+def heuristic_fields(text: str) -> Dict[str, str]:
+    """
+    Function to extract the fields that cheap regexes can read reliably from a job description.
+
+    :param text: The job description.
+    :return: The values found, keyed like the prompt fields; fields without a clear signal are left out.
+    """
+    found: Dict[str, str] = {}
+    for job_type, pattern in _JOB_TYPES:
+        if pattern.search(text):
+            found['JobType'] = job_type
+            break
+    # The lowest degree mentioned is the minimum requirement
+    for degree, pattern in _EDUCATION:
+        if pattern.search(text):
+            found['Min_Education'] = degree
+            break
+    years = [int(match.group(1)) for match in _YEARS.finditer(text) if int(match.group(1)) <= 20]
+    if years:
+        found['YoE_year'] = str(min(years))
+    if _NO_VISA.search(text):
+        found['Visa_policy'] = 'Will not provide'
+    elif _VISA.search(text):
+        found['Visa_policy'] = 'Will provide'
+    if _RESIDENCY.search(text):
+        found['Citizenship'] = 'Permanent Resident only'
+    return found
+
+def _years(value: Any) -> Optional[float]:
+    match = re.search(r"\d+(?:\.\d+)?", str(value))
+    return float(match.group(0)) if match else None
+
+def _expected_level(years: float) -> str:
+    # The thresholds of the YoE_level instruction of the role prompts
+    if years < 1:
+        return 'New grad'
+    return 'Mid-level' if years <= 3 else 'Senior'
+
+def score_extraction(parsed: ParsedOutput, fields: Iterable[PromptField], text: str) -> Confidence:
+    """
+    Function to score the confidence of an extraction without calling the API.
+
+    :param parsed: The validated output (see Tool.llm_comp.validate_output_async).
+    :param fields: The expected fields (see Tool.prompt.CompiledPrompt.fields).
+    :param text: The job description the extraction was made from.
+    :return: The confidence and its reasons.
+    """
+    if parsed.record is None:
+        return Confidence(0.0, ['no_record'])
+    fields = list(fields)
+    record = parsed.record
+    score = 1.0
+    reasons = []
+    for key in parsed.invalid_fields:
+        score -= _INVALID_FIELD_PENALTY
+        reasons.append(f'invalid:{key}')
+    if parsed.repaired:
+        score -= _REPAIR_PENALTY
+        reasons.append('repaired')
+    empty = sum(1 for field in fields if record.get(field.key) in (None, [], NOT_MENTIONED))
+    density = empty / len(fields) if fields else 0.0
+    if density > _NOT_MENTIONED_TOLERANCE:
+        score -= density - _NOT_MENTIONED_TOLERANCE
+        reasons.append(f'not_mentioned:{density:.2f}')
+    for key, expected in heuristic_fields(text).items():
+        if key not in record:
+            continue
+        value = record[key]
+        if key == 'YoE_year':
+            agrees = _years(value) == float(expected)
+        else:
+            agrees = value == expected
+        if not agrees:
+            score -= _DISAGREEMENT_PENALTY
+            reasons.append(f'disagrees:{key}')
+    years = _years(record.get('YoE_year', ''))
+    level = record.get('YoE_level')
+    if years is not None and level not in (None, NOT_MENTIONED) and level != _expected_level(years):
+        score -= _DISAGREEMENT_PENALTY
+        reasons.append('inconsistent:YoE_level')
+    return Confidence(max(0.0, score), reasons)
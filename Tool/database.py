@@ -0,0 +1,310 @@
+"""
+This module contains a queryable SQLite index of the extracted job information.
+
+Each stored extraction becomes a row of the `records` table with one indexed column per scalar field
+(Company, Industry, Visa_policy, JobType, YoE_level, Min_Education, ...). The list fields (DS_skills,
+SE_skills, Languages) are normalized into the `skills` join table, so questions like
+"all Senior roles that will provide visa sponsorship and require Python" are answered with index lookups
+instead of loading the whole history. The database runs in WAL mode, so readers (e.g. the Streamlit app)
+don't block the writer.
+
+Rollup tables are maintained in the same transaction as every insert: the number of records per role,
+industry and value of each categorical field (`rollup_fields`), and per role, industry and skill
+(`rollup_skills`). Dashboards read these small tables instead of aggregating the whole history.
+
+An index created empty next to an existing extraction history (data/LLM_output, e.g. scans stored before the
+index existed) is backfilled from it, records and rollups, on first use. Records are unique by the text ID of
+their scan, so a scan appended to the history before it is indexed is not indexed twice by the backfill.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from Tool.prompt import infer_role
+from Tool.utils import iter_json_from_file
+
+# Extraction keys stored as indexed columns, and the list keys normalized into the skills table
+scalar_fields = {
+    'Company': 'company',
+    'Industry': 'industry',
+    'Citizenship': 'citizenship',
+    'Visa_policy': 'visa_policy',
+    'JobType': 'job_type',
+    'YoE_year': 'yoe_year',
+    'YoE_level': 'yoe_level',
+    'Min_Education': 'min_education',
+}
+list_fields = ['DS_skills', 'SE_skills', 'Languages']
+# Keys the extraction history stores next to the extraction itself (see Tool.llm_comp.finalize_scan)
+_history_keys = ['cost', 'text_id', 'role', 'scanned_at']
+# Columns counted per role and industry in the rollup tables ('records' counts the records themselves)
+rollup_columns = ['visa_policy', 'yoe_level', 'min_education', 'job_type', 'citizenship']
+
+def _as_list(value: Any) -> List[str]:
+    # The model returns either a list of strings or a single (comma separated) string
+    if value is None:
+        return []
+    if isinstance(value, list):
+        items = value
+    else:
+        items = str(value).split(',')
+    return [str(item).strip() for item in items if str(item).strip()]
+
+def _as_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return ', '.join(str(item) for item in value)
+    return str(value)
+
+class ResultIndex:
+    """
+    SQLite (WAL mode) index of extraction records.
+
+    :param db_path: Path of the SQLite database.
+    :param history_models: Models whose extraction history (Tool.utils.iter_json_from_file) is indexed when the
+        database is empty.
+    """
+    def __init__(self, db_path: str = os.path.join('data', 'index.sqlite'), history_models: Iterable[str] = ()) -> None:
+        self.db_path = db_path
+        self.history_models = tuple(history_models)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the database lazily so importing the module has no side effect on disk
+        if self._conn is None:
+            directory_name = os.path.dirname(self.db_path)
+            if directory_name and not os.path.exists(directory_name):
+                os.makedirs(directory_name)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            columns = ',\n'.join(f"{column} TEXT COLLATE NOCASE" for column in scalar_fields.values())
+            conn.executescript(f"""
+                CREATE TABLE IF NOT EXISTS records (
+                    id INTEGER PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    {columns},
+                    created_at REAL NOT NULL,
+                    record TEXT NOT NULL,
+                    text_id TEXT
+                );
+                CREATE TABLE IF NOT EXISTS skills (
+                    record_id INTEGER NOT NULL,
+                    source TEXT NOT NULL,
+                    skill TEXT NOT NULL COLLATE NOCASE
+                );
+                CREATE INDEX IF NOT EXISTS idx_skills_skill ON skills (skill, record_id);
+                CREATE INDEX IF NOT EXISTS idx_skills_record ON skills (record_id);
+                CREATE INDEX IF NOT EXISTS idx_records_yoe_level ON records (yoe_level, visa_policy);
+                CREATE INDEX IF NOT EXISTS idx_records_visa_policy ON records (visa_policy);
+                CREATE INDEX IF NOT EXISTS idx_records_job_type ON records (job_type);
+                CREATE INDEX IF NOT EXISTS idx_records_min_education ON records (min_education);
+                CREATE INDEX IF NOT EXISTS idx_records_industry ON records (industry);
+                CREATE INDEX IF NOT EXISTS idx_records_company ON records (company);
+                CREATE INDEX IF NOT EXISTS idx_records_model_role ON records (model, role);
+                CREATE TABLE IF NOT EXISTS rollup_fields (
+                    role TEXT NOT NULL,
+                    industry TEXT NOT NULL COLLATE NOCASE,
+                    field TEXT NOT NULL,
+                    value TEXT NOT NULL COLLATE NOCASE,
+                    n INTEGER NOT NULL,
+                    PRIMARY KEY (role, industry, field, value)
+                );
+                CREATE TABLE IF NOT EXISTS rollup_skills (
+                    role TEXT NOT NULL,
+                    industry TEXT NOT NULL COLLATE NOCASE,
+                    skill TEXT NOT NULL COLLATE NOCASE,
+                    n INTEGER NOT NULL,
+                    PRIMARY KEY (role, industry, skill)
+                );
+            """)
+            # Databases of older versions have no text IDs
+            if 'text_id' not in [row[1] for row in conn.execute("PRAGMA table_info(records)")]:
+                conn.execute("ALTER TABLE records ADD COLUMN text_id TEXT")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_records_text_id ON records (text_id)")
+            conn.commit()
+            self._conn = conn
+            # Databases of older versions have records but no rollups yet
+            if conn.execute("SELECT 1 FROM rollup_fields LIMIT 1").fetchone() is None \
+                    and conn.execute("SELECT 1 FROM records LIMIT 1").fetchone() is not None:
+                self._rebuild_rollups(conn)
+            if self.history_models:
+                self._backfill(conn)
+        return self._conn
+
+    def _backfill(self, conn: sqlite3.Connection) -> None:
+        # Immediate transaction: of several processes opening a new index, only the first one backfills it
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            if conn.execute("SELECT 1 FROM records LIMIT 1").fetchone() is not None:
+                return
+            for model_name in self.history_models:
+                for stored in iter_json_from_file(model_name):
+                    record = {key: value for key, value in stored.items() if key not in _history_keys}
+                    self._insert(conn, model_name, stored.get('role') or infer_role(stored), record,
+                                 stored.get('scanned_at') or time.time(), stored.get('text_id'))
+
+    def _update_rollups(self, conn: sqlite3.Connection, role_name: str, record: Dict[str, Any]) -> None:
+        # Count one record in the rollup tables (inside the caller's transaction)
+        industry = (_as_text(record.get('Industry')) or 'not mentioned').strip()
+        counts = [(role_name, industry, 'records', '')]
+        for key, column in scalar_fields.items():
+            if column in rollup_columns:
+                counts.append((role_name, industry, column, (_as_text(record.get(key)) or 'not mentioned').strip()))
+        conn.executemany("""
+            INSERT INTO rollup_fields (role, industry, field, value, n) VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT (role, industry, field, value) DO UPDATE SET n = n + 1""", counts)
+        # A skill listed twice (or in two list fields) counts once per record
+        skills = {skill.lower(): skill for key in list_fields for skill in _as_list(record.get(key))}
+        conn.executemany("""
+            INSERT INTO rollup_skills (role, industry, skill, n) VALUES (?, ?, ?, 1)
+            ON CONFLICT (role, industry, skill) DO UPDATE SET n = n + 1""",
+            [(role_name, industry, skill) for skill in skills.values()])
+
+    def _rebuild_rollups(self, conn: sqlite3.Connection) -> None:
+        with conn:
+            conn.execute("DELETE FROM rollup_fields")
+            conn.execute("DELETE FROM rollup_skills")
+            for role_name, record in conn.execute("SELECT role, record FROM records ORDER BY id").fetchall():
+                self._update_rollups(conn, role_name, json.loads(record))
+
+    def rebuild_rollups(self) -> None:
+        """
+        Recount the rollup tables from the records, e.g., after records were deleted by hand.
+        """
+        with self._lock:
+            self._rebuild_rollups(self._connect())
+
+    def add(self, model_name: str, role_name: str, record: Dict[str, Any], text_id: Optional[str] = None) -> int:
+        """
+        Index one extraction record.
+
+        :param model_name: Name of the model that produced the record, e.g., 'GPT-3.5'.
+        :param role_name: Role of the prompt, e.g., 'Data relevant'.
+        :param record: The parsed JSON output of the model (without the cost).
+        :param text_id: Text ID of the scan (Tool.blobstore.BlobStore.put); a record with a text ID already
+            indexed, e.g. by the backfill, is not indexed again.
+        :return: The ID of the indexed record.
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return self._insert(conn, model_name, role_name, record, time.time(), text_id)
+
+    def _insert(self, conn: sqlite3.Connection, model_name: str, role_name: str, record: Dict[str, Any],
+                created_at: float, text_id: Optional[str] = None) -> int:
+        # Insert a record, its skills and its rollup counts (inside the caller's transaction)
+        columns = ['model', 'role'] + list(scalar_fields.values()) + ['created_at', 'record', 'text_id']
+        values = [model_name, role_name] + [_as_text(record.get(key)) for key in scalar_fields] \
+            + [created_at, json.dumps(record), text_id]
+        placeholders = ', '.join('?' for _ in columns)
+        cursor = conn.execute(f"INSERT OR IGNORE INTO records ({', '.join(columns)}) VALUES ({placeholders})", values)
+        if cursor.rowcount == 0:
+            return conn.execute("SELECT id FROM records WHERE text_id = ?", (text_id,)).fetchone()[0]
+        record_id = cursor.lastrowid
+        conn.executemany("INSERT INTO skills (record_id, source, skill) VALUES (?, ?, ?)",
+                         [(record_id, key, skill) for key in list_fields for skill in _as_list(record.get(key))])
+        self._update_rollups(conn, role_name, record)
+        return record_id
+
+    def _where(self, filters: Dict[str, Any], skills: Optional[List[str]]) -> Tuple[str, List[Any]]:
+        allowed = {'model', 'role', *scalar_fields.values()}
+        clauses, params = [], []
+        for column, value in filters.items():
+            if column not in allowed:
+                raise ValueError(f"'{column}' is not a valid filter. Choose from {sorted(allowed)}.")
+            if value is None:
+                continue
+            clauses.append(f"{column} = ?")
+            params.append(value)
+        # A record matches a skill if it appears in any of its list fields (DS_skills, SE_skills or Languages)
+        for skill in skills or []:
+            clauses.append("id IN (SELECT record_id FROM skills WHERE skill = ?)")
+            params.append(skill)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    def query(self, skills: Optional[List[str]] = None, limit: Optional[int] = 100, **filters: Any) -> List[Dict[str, Any]]:
+        """
+        Find the records matching every given filter, newest first. Comparisons are case-insensitive.
+
+        Example: index.query(yoe_level='Senior', visa_policy='Will provide', skills=['Python'])
+
+        :param skills: Skills (or languages) that must all be required by the job.
+        :param limit: Maximum number of records to return, None for all.
+        :param filters: Column filters: model, role, company, industry, citizenship, visa_policy, job_type,
+                        yoe_year, yoe_level, min_education.
+        :return: The matching records as dictionaries, with their 'id', 'model' and 'role'.
+
+        :raises ValueError: If a filter name is not valid.
+        """
+        where, params = self._where(filters, skills)
+        sql = f"SELECT id, model, role, record FROM records{where} ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        return [{'id': row[0], 'model': row[1], 'role': row[2], **json.loads(row[3])} for row in rows]
+
+    def count(self, skills: Optional[List[str]] = None, **filters: Any) -> int:
+        """
+        Count the records matching every given filter (same filters as query).
+        """
+        where, params = self._where(filters, skills)
+        with self._lock:
+            return self._connect().execute(f"SELECT COUNT(*) FROM records{where}", params).fetchone()[0]
+
+    def top_skills(self, limit: int = 20, source: Optional[str] = None, **filters: Any) -> List[Tuple[str, int]]:
+        """
+        Most frequently required skills among the records matching the filters (same filters as query).
+
+        :param limit: Number of skills to return.
+        :param source: Restrict to one list field: 'DS_skills', 'SE_skills' or 'Languages'.
+        :return: A list of (skill, count) tuples, most frequent first.
+        """
+        where, params = self._where(filters, None)
+        sql = f"SELECT skill, COUNT(*) AS n FROM skills WHERE record_id IN (SELECT id FROM records{where})"
+        if source is not None:
+            sql += " AND source = ?"
+            params.append(source)
+        sql += " GROUP BY skill COLLATE NOCASE ORDER BY n DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return [tuple(row) for row in self._connect().execute(sql, params).fetchall()]
+
+    def field_rollup(self, role: Optional[str] = None) -> List[Tuple[str, str, str, str, int]]:
+        """
+        Read the categorical rollup: record counts per role, industry, field and value.
+
+        :param role: Restrict to one role, None for all.
+        :return: A list of (role, industry, field, value, count) tuples; field 'records' holds the number of
+                 records per role and industry (with an empty value).
+        """
+        sql = "SELECT role, industry, field, value, n FROM rollup_fields"
+        params: List[Any] = []
+        if role is not None:
+            sql += " WHERE role = ?"
+            params.append(role)
+        with self._lock:
+            return [tuple(row) for row in self._connect().execute(sql, params).fetchall()]
+
+    def skill_rollup(self, role: Optional[str] = None) -> List[Tuple[str, str, str, int]]:
+        """
+        Read the skill rollup: number of records requiring each skill, per role and industry.
+
+        :param role: Restrict to one role, None for all.
+        :return: A list of (role, industry, skill, count) tuples.
+        """
+        sql = "SELECT role, industry, skill, n FROM rollup_skills"
+        params: List[Any] = []
+        if role is not None:
+            sql += " WHERE role = ?"
+            params.append(role)
+        with self._lock:
+            return [tuple(row) for row in self._connect().execute(sql, params).fetchall()]
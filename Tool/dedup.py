@@ -0,0 +1,187 @@
+"""
+This module contains a near-duplicate index of previously scanned job descriptions.
+
+The same posting is often re-posted with trivial differences (tracking footers, whitespace, reordered
+benefits), which an exact-hash cache misses. Each description is reduced to a MinHash signature over its word
+shingles, and the signature is split into LSH bands stored in an indexed SQLite table. A lookup only compares
+the signatures sharing at least one band bucket (a handful of index probes, independent of the number of
+stored descriptions), and returns the stored extraction of the most similar one if its estimated Jaccard
+similarity reaches the threshold. A description without any word has no shingles, hence nothing to compare:
+it is neither looked up nor stored.
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+# Prime just above 2**32: (a * x + b) stays below 2**64 for 32-bit shingle hashes, so uint64 never overflows
+_PRIME = np.uint64(4294967311)
+# Signature value of a text without shingles: permuted hashes are below _PRIME, so it never occurs otherwise
+_EMPTY = np.iinfo(np.uint64).max
+_WORD_PATTERN = re.compile(r"[a-z0-9]+(?:[+#.'][a-z0-9+#]+)*")
+
+def shingles(text: str, k: int = 4) -> List[str]:
+    """
+    Function to split a text into lowercase word k-grams (punctuation and whitespace are ignored).
+
+    :param text: The job description.
+    :param k: Number of words per shingle.
+    :return: The distinct shingles of the text (the words themselves if the text is shorter than k words).
+    """
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < k:
+        return sorted(set(words))
+    return sorted({' '.join(words[i:i + k]) for i in range(len(words) - k + 1)})
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index of scanned job descriptions and their extraction results.
+
+    :param db_path: Path of the SQLite database, or ':memory:' for an index living only in this process.
+    :param threshold: Minimum estimated Jaccard similarity for two descriptions to be near-duplicates.
+    :param num_perm: Number of MinHash permutations (signature length).
+    :param bands: Number of LSH bands; num_perm must be a multiple of it. More bands find lower similarities
+                  at the cost of more candidates to verify.
+    :param seed: Seed of the hash permutations. Changing it invalidates stored signatures.
+    """
+    def __init__(self,
+                 db_path: str = os.path.join('data', 'near_duplicates.sqlite'),
+                 threshold: float = 0.9,
+                 num_perm: int = 128,
+                 bands: int = 16,
+                 seed: int = 1) -> None:
+        if num_perm % bands != 0:
+            raise ValueError(f"'num_perm' ({num_perm}) must be a multiple of 'bands' ({bands}).")
+        self.db_path = db_path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 2 ** 32, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, 2 ** 32, size=num_perm, dtype=np.uint64)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the database lazily so importing the module has no side effect on disk
+        if self._conn is None:
+            if self.db_path != ':memory:':
+                directory_name = os.path.dirname(self.db_path)
+                if directory_name and not os.path.exists(directory_name):
+                    os.makedirs(directory_name)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            if self.db_path != ':memory:':
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY,
+                    scope TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    response TEXT NOT NULL,
+                    info TEXT,
+                    created_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS buckets (
+                    bucket INTEGER NOT NULL,
+                    document_id INTEGER NOT NULL,
+                    PRIMARY KEY (bucket, document_id)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS matches (
+                    id INTEGER PRIMARY KEY,
+                    document_id INTEGER NOT NULL,
+                    similarity REAL NOT NULL,
+                    created_at REAL NOT NULL
+                );
+            """)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        Compute the MinHash signature of a text.
+
+        :param text: The job description.
+        :return: An array of num_perm uint64 minimum hash values (all equal to the maximum uint64 value if the
+                 text has no shingles).
+        """
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text)), dtype=np.uint64)
+        if hashes.size == 0:
+            return np.full(self.num_perm, _EMPTY, dtype=np.uint64)
+        permuted = (np.outer(hashes, self._a) + self._b) % _PRIME
+        return permuted.min(axis=0)
+
+    def _buckets(self, signature: np.ndarray, scope: str) -> List[int]:
+        # One bucket per band: a 63-bit hash of (scope, band number, band values)
+        buckets = []
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            digest = hashlib.blake2b(scope.encode('utf-8') + band.to_bytes(2, 'little') + values, digest_size=8).digest()
+            buckets.append(int.from_bytes(digest, 'little') >> 1)
+        return buckets
+
+    def lookup(self, text: str, scope: str) -> Optional[Tuple[int, float, Dict[str, Any], Optional[str]]]:
+        """
+        Find the most similar stored description within the same scope.
+
+        :param text: The job description.
+        :param scope: Partition of the index, e.g., model, role and prompt version joined together;
+                      results are only shared within a scope.
+        :return: A tuple of (document_id, similarity, response_dict, info) if a near-duplicate reaches the threshold,
+                 None otherwise (always for a text without shingles). Matches are recorded in the `matches` table.
+        """
+        signature = self.signature(text)
+        # Texts without shingles would all match each other with a similarity of 1.0
+        if signature[0] == _EMPTY:
+            return None
+        buckets = self._buckets(signature, scope)
+        placeholders = ', '.join('?' for _ in buckets)
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(f"""
+                SELECT id, signature, response, info FROM documents WHERE id IN (
+                    SELECT DISTINCT document_id FROM buckets WHERE bucket IN ({placeholders})
+                ) AND scope = ?""", buckets + [scope]).fetchall()
+            best = None
+            for document_id, blob, response, info in rows:
+                similarity = float(np.mean(np.frombuffer(blob, dtype=np.uint64) == signature))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (document_id, similarity, response, info)
+            if best is None:
+                return None
+            conn.execute("INSERT INTO matches (document_id, similarity, created_at) VALUES (?, ?, ?)",
+                         (best[0], best[1], time.time()))
+            conn.commit()
+        return best[0], best[1], json.loads(best[2]), best[3]
+
+    def add(self, text: str, scope: str, response_dict: Dict[str, Any], info: Optional[str]) -> Optional[int]:
+        """
+        Store a scanned description and its result.
+
+        :param text: The job description.
+        :param scope: Partition of the index (see lookup).
+        :param response_dict: The response dictionary without the cost.
+        :param info: The info string returned along with the response.
+        :return: The document ID of the stored description, None if the text has no shingles and isn't stored.
+        """
+        signature = self.signature(text)
+        if signature[0] == _EMPTY:
+            return None
+        buckets = self._buckets(signature, scope)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO documents (scope, signature, response, info, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (scope, signature.tobytes(), json.dumps(response_dict), info, time.time()))
+                document_id = cursor.lastrowid
+                conn.executemany("INSERT OR IGNORE INTO buckets (bucket, document_id) VALUES (?, ?)",
+                                 [(bucket, document_id) for bucket in buckets])
+        return document_id
@@ -0,0 +1,237 @@
+"""
+This module contains the columnar export of the extraction history (data/LLM_output) to Parquet.
+
+export_parquet streams the JSONL store of every model into a Parquet dataset partitioned by model, role and scan
+date (data/parquet/<version>/model=GPT-3.5/role=Data%20relevant/scan_date=2023-08-01/part-0.parquet). Every prompt
+field is a column: the categorical ones are dictionary-encoded strings, the skills and languages are list<string>
+columns, and keys outside the prompt registry are kept as JSON in the `extra` column. Records are converted in
+batches of batch_size, so the export never holds the whole history in memory.
+
+Every export writes a new version directory and, once it is complete, switches the CURRENT file of the dataset
+directory to it with an atomic rename, so readers always find a complete dataset (see dataset_path). The
+previous version is kept for readers that resolved it just before the switch; older ones are deleted.
+
+read_parquet reads it back through a memory-mapped file system: only the requested columns and the partitions
+matching the filter are touched, and the pages are read from the page cache instead of being copied into
+buffers first. to_pandas keeps the Arrow memory (pyarrow-backed dtypes) instead of converting to NumPy objects.
+
+Records stored before role and scan time were saved with the extraction get the role implied by their list
+fields and the scan time of their raw text in the text store (Tool.blobstore), if any.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+from Tool.prompt import infer_role, prompt_registry
+from Tool.utils import iter_json_from_file
+from Tool.blobstore import BlobStore
+
+DEFAULT_DIRECTORY = os.path.join('data', 'parquet')
+# Records converted and written at a time
+BATCH_SIZE = 50000
+partition_columns = ['model', 'role', 'scan_date']
+# Bounds of the writer: pyarrow's default of 1,024 partitions applies to every batch, which a history spanning
+# years of scan dates across models and roles exceeds
+MAX_PARTITIONS = 100000
+MAX_OPEN_FILES = 1024
+# File of the dataset directory naming its current version, and names of the version directories
+POINTER_FILE = 'CURRENT'
+_VERSION_PATTERN = re.compile(r'^v\d{14}-[0-9a-f]{8}$')
+# Fields of every role, in prompt order
+_fields = {field.key: field for prompt in prompt_registry.values() for field in prompt.fields}
+_metadata_schema = [
+    pa.field('model', pa.string()),
+    pa.field('role', pa.string()),
+    pa.field('scan_date', pa.string()),
+    pa.field('scanned_at', pa.timestamp('s', tz='UTC')),
+    pa.field('text_id', pa.string()),
+    pa.field('cost', pa.float64()),
+    pa.field('tier', pa.string()),
+    pa.field('confidence', pa.float64()),
+]
+schema = pa.schema(_metadata_schema + [
+    pa.field(key, pa.list_(pa.string()) if field.is_list else pa.string()) for key, field in _fields.items()
+] + [pa.field('extra', pa.string())])
+_known_keys = set(schema.names)
+
+def _as_list(value: Any) -> Optional[List[str]]:
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    return [item.strip() for item in str(value).split(',') if item.strip()]
+
+def _as_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return ', '.join(str(item) for item in value)
+    return str(value)
+
+def _as_float(value: Any) -> Optional[float]:
+    try:
+        return None if value is None else float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _row(model_name: str, record: Dict[str, Any], text_store: Optional[BlobStore]) -> Dict[str, Any]:
+    scanned_at = _as_float(record.get('scanned_at'))
+    if scanned_at is None and text_store is not None and record.get('text_id'):
+        scanned_at = text_store.created_at(record['text_id'])
+    when = None if scanned_at is None else datetime.datetime.fromtimestamp(scanned_at, datetime.timezone.utc)
+    row = {
+        'model': model_name,
+        'role': record.get('role') or infer_role(record),
+        'scan_date': 'unknown' if when is None else when.date().isoformat(),
+        'scanned_at': when,
+        'text_id': record.get('text_id'),
+        'cost': _as_float(record.get('cost')),
+        'tier': record.get('tier'),
+        'confidence': _as_float(record.get('confidence')),
+    }
+    for key, field in _fields.items():
+        row[key] = _as_list(record.get(key)) if field.is_list else _as_text(record.get(key))
+    extra = {key: value for key, value in record.items() if key not in _known_keys}
+    row['extra'] = json.dumps(extra) if extra else None
+    return row
+
+def _record_batches(models: Iterable[str], batch_size: int, text_store: Optional[BlobStore],
+                    counts: Dict[str, int]) -> Iterator[pa.RecordBatch]:
+    for model_name in models:
+        rows = []
+        for record in iter_json_from_file(model_name):
+            rows.append(_row(model_name, record, text_store))
+            if len(rows) >= batch_size:
+                counts['records'] += len(rows)
+                yield pa.RecordBatch.from_pylist(rows, schema=schema)
+                rows = []
+        if rows:
+            counts['records'] += len(rows)
+            yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+def dataset_path(directory: str = DEFAULT_DIRECTORY) -> Optional[str]:
+    """
+    Function to resolve the current version of an exported dataset.
+
+    :param directory: Directory of the dataset.
+    :return: The directory of the current version, or None if nothing was exported yet.
+    """
+    try:
+        with open(os.path.join(directory, POINTER_FILE), 'r') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(directory, version)
+
+def _cleanup(directory: str, keep: List[str]) -> None:
+    # Only what exports created is deleted: older versions, unfinished writes of crashed exports and the
+    # partitions of the unversioned layout of earlier exports. Anything else in the directory is left alone.
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in keep or not os.path.isdir(path):
+            continue
+        if _VERSION_PATTERN.match(name) or name.startswith(f'{partition_columns[0]}='):
+            shutil.rmtree(path, ignore_errors=True)
+
+def export_parquet(directory: str = DEFAULT_DIRECTORY, models: Iterable[str] = ('GPT-3.5', 'GPT-4'),
+                   batch_size: int = BATCH_SIZE, text_store: Optional[BlobStore] = None) -> Dict[str, int]:
+    """
+    Function to export (or re-export) the extraction history of the models to a partitioned Parquet dataset.
+    The export is written to a new version directory and switched in once complete, so readers never see a
+    partial export, and every run compacts the history into a few large files per partition.
+
+    :param directory: Directory of the dataset.
+    :param models: Model names whose history is exported.
+    :param batch_size: Number of records converted and written at a time.
+    :param text_store: Store of the raw texts, used for the scan time of records that have none.
+        Defaults to the text store of the app (data/text_store) if it exists.
+    :return: The number of records exported and of files written.
+    """
+    if text_store is None and os.path.isdir(os.path.join('data', 'text_store')):
+        text_store = BlobStore()
+    os.makedirs(directory, exist_ok=True)
+    previous = dataset_path(directory)
+    version = f"v{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    counts = {'records': 0}
+    written = []
+    ds.write_dataset(
+        _record_batches(models, batch_size, text_store, counts), os.path.join(directory, version), schema=schema,
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([schema.field(name) for name in partition_columns]), flavor='hive'),
+        basename_template='part-{i}.parquet', max_rows_per_group=batch_size, min_rows_per_group=min(batch_size, 10000),
+        max_partitions=MAX_PARTITIONS, max_open_files=MAX_OPEN_FILES,
+        file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+        existing_data_behavior='overwrite_or_ignore', file_visitor=lambda file: written.append(file.path))
+    os.makedirs(os.path.join(directory, version), exist_ok=True)
+    # Switch the pointer: os.replace is atomic, readers see either the previous or the new version
+    pointer = os.path.join(directory, POINTER_FILE)
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer + '.tmp', pointer)
+    _cleanup(directory, [version] + ([os.path.basename(previous)] if previous else []))
+    return {'records': counts['records'], 'files': len(written)}
+
+def open_dataset(directory: str = DEFAULT_DIRECTORY) -> ds.Dataset:
+    """
+    Function to open the current version of the exported dataset on a memory-mapped file system, e.g. to scan
+    it in batches.
+
+    :param directory: Directory of the dataset.
+    :return: The pyarrow dataset, partitioned by model, role and scan_date.
+
+    :raises FileNotFoundError: If nothing was exported to the directory yet.
+    """
+    path = dataset_path(directory)
+    if path is None:
+        raise FileNotFoundError(f"No Parquet export in '{directory}', run python -m Tool.export first.")
+    return ds.dataset(os.path.abspath(path), schema=schema, format='parquet', partitioning='hive',
+                      filesystem=fs.LocalFileSystem(use_mmap=True))
+
+def read_parquet(directory: str = DEFAULT_DIRECTORY, columns: Optional[List[str]] = None,
+                 filter: Optional[ds.Expression] = None) -> pa.Table:
+    """
+    Function to read columns of the exported history. Only the requested columns, and the partitions and row
+    groups matching the filter, are read, e.g. read_parquet(columns=['Industry', 'DS_skills'],
+    filter=(ds.field('role') == 'Data relevant') & (ds.field('scan_date') >= '2023-08-01')).
+
+    :param directory: Directory of the dataset.
+    :param columns: Columns to read, all of them if None.
+    :param filter: Row filter on any column (partition columns prune whole files).
+    :return: The records as a pyarrow Table (empty if nothing was exported yet).
+    """
+    if dataset_path(directory) is None:
+        return schema.empty_table() if columns is None else schema.empty_table().select(columns)
+    return open_dataset(directory).to_table(columns=columns, filter=filter)
+
+def to_pandas(table: pa.Table):
+    """
+    Function to convert a table to a pandas DataFrame backed by the Arrow memory (pd.ArrowDtype columns),
+    without converting strings and lists to Python objects.
+    """
+    import pandas as pd
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Export the extraction history (data/LLM_output) to partitioned Parquet.')
+    parser.add_argument('--output', default=DEFAULT_DIRECTORY,
+                        help='Directory of the dataset; every run adds a new version and deletes the older exported ones.')
+    parser.add_argument('--model', action='append', choices=['GPT-3.5', 'GPT-4'],
+                        help='Model whose history is exported (repeatable, default: all).')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Records converted and written at a time.')
+    args = parser.parse_args()
+    result = export_parquet(args.output, args.model or ('GPT-3.5', 'GPT-4'), args.batch_size)
+    print(f"Exported {result['records']} records to {result['files']} files in {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""
+This module contains the bulk ingestion of raw job-posting dumps into the batch scanning engine (Tool.batch).
+
+Dumps are read lazily, one posting at a time, so their size doesn't matter:
+- JSONL files (.jsonl, .ndjson): one JSON object per line,
+- CSV files (.csv, .tsv): one row per posting, with a header,
+- HTML files (.html, .htm): either one page per posting, or many postings per page, one per element of a
+  given tag (e.g. <article>); the markup is parsed incrementally and only the visible text is kept,
+- directories, walked recursively in name order.
+Every posting gets a stable ID derived from its normalized text (the same posting gets the same ID in every
+dump and every run), and exact duplicates within a run are dropped; near-duplicates are still served by the
+near-duplicate index of the scan pipeline.
+
+A checkpoint (a small SQLite database) records every finished posting, so an interrupted run started again
+with the same checkpoint skips the postings already scanned instead of paying for them twice. Only final results
+are recorded (extracted, not_job, flagged): postings that failed with an error, got malformed output (not_json)
+or ran out of budget are retried by the next run. The checkpoint also holds the IDs of the postings seen by the
+current run, which drops the exact duplicates without keeping every ID of the dumps in memory.
+
+Command line usage:
+    python -m Tool.ingest dumps/ postings.csv --model GPT-3.5 --role "Data relevant" --checkpoint data/ingest.sqlite --output results.jsonl
+"""
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from html.parser import HTMLParser
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from Tool.utils import normalize_job_text
+
+# Bytes read from an HTML file at a time
+_CHUNK_SIZE = 64 * 1024
+# Elements whose content is never visible, and elements ending a line of text
+_HIDDEN_TAGS = {'script', 'style', 'noscript', 'template', 'head', 'svg'}
+_BLOCK_TAGS = {'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'table', 'section', 'article', 'header', 'footer',
+               'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'dd', 'dt', 'blockquote', 'pre', 'hr'}
+_EXTENSIONS = {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv', '.tsv': 'csv', '.html': 'html', '.htm': 'html'}
+# Infos of the scans that are final; the others (error, not_json, over_budget) are retried by the next run
+FINAL_INFOS = (None, 'not_job', 'flagged')
+
+def posting_id(text: str) -> str:
+    """
+    Function to compute the stable ID of a posting from its normalized text.
+
+    :param text: The job description.
+    :return: A 16-character hex ID.
+    """
+    return hashlib.sha256(normalize_job_text(text).encode('utf-8')).hexdigest()[:16]
+
+class _TextExtractor(HTMLParser):
+    """
+    Incremental HTML parser collecting the visible text, either of the whole document or of every element
+    with the posting tag. Completed postings are queued in `postings`.
+    """
+    def __init__(self, posting_tag: Optional[str] = None) -> None:
+        super().__init__(convert_charrefs=True)
+        self.posting_tag = posting_tag
+        self.postings: List[str] = []
+        self._parts: List[str] = []
+        self._hidden = 0
+        self._depth = 0
+
+    def _collecting(self) -> bool:
+        return self.posting_tag is None or self._depth > 0
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag in _HIDDEN_TAGS:
+            self._hidden += 1
+        if tag == self.posting_tag:
+            self._depth += 1
+        if tag in _BLOCK_TAGS and self._collecting():
+            self._parts.append('\n')
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in _HIDDEN_TAGS and self._hidden:
+            self._hidden -= 1
+        if tag in _BLOCK_TAGS and self._collecting():
+            self._parts.append('\n')
+        if tag == self.posting_tag and self._depth:
+            self._depth -= 1
+            if not self._depth:
+                self.flush()
+
+    def handle_data(self, data: str) -> None:
+        if not self._hidden and self._collecting():
+            self._parts.append(data)
+
+    def flush(self) -> None:
+        text = _clean_text(''.join(self._parts))
+        self._parts = []
+        if text:
+            self.postings.append(text)
+
+def _clean_text(text: str) -> str:
+    # Collapse the whitespace of every line and drop the empty lines
+    lines = (' '.join(line.split()) for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+def strip_html(html: str) -> str:
+    """
+    Function to extract the visible text of an HTML fragment, one line per block element.
+
+    :param html: The HTML markup.
+    :return: The text.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    parser.flush()
+    return '\n'.join(parser.postings)
+
+def iter_html(file_path: str, posting_tag: Optional[str] = None) -> Iterator[Tuple[Optional[str], str]]:
+    """
+    Function to lazily read the postings of an HTML file.
+
+    :param file_path: Path of the HTML file.
+    :param posting_tag: Tag of the elements holding one posting each (e.g. 'article'), None if the whole page is one posting.
+    :return: A generator of (source_id, description) tuples; the source ID is the position of the posting in the file.
+    """
+    parser = _TextExtractor(posting_tag)
+    index = 0
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+                if posting_tag is None:
+                    parser.flush()
+            for text in parser.postings:
+                yield str(index), text
+                index += 1
+            parser.postings = []
+            if not chunk:
+                break
+
+def iter_jsonl(file_path: str, text_field: str = 'description', id_field: str = 'id') -> Iterator[Tuple[Optional[str], str]]:
+    """
+    Function to lazily read the postings of a JSONL file. Descriptions containing HTML markup are stripped.
+
+    :return: A generator of (source_id, description) tuples; the source ID is None if the line has no ID.
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            text = record.get(text_field)
+            if not text:
+                continue
+            source_id = record.get(id_field)
+            yield (None if source_id is None else str(source_id)), _plain_text(text)
+
+def iter_csv(file_path: str, text_field: str = 'description', id_field: str = 'id') -> Iterator[Tuple[Optional[str], str]]:
+    """
+    Function to lazily read the postings of a CSV file with a header row (tab separated for .tsv files).
+    Descriptions containing HTML markup are stripped.
+
+    :return: A generator of (source_id, description) tuples; the source ID is None if the row has no ID.
+    """
+    # Scraped descriptions easily exceed the default field size limit of 128 KB
+    csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+    delimiter = '\t' if file_path.endswith('.tsv') else ','
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f, delimiter=delimiter):
+            text = row.get(text_field)
+            if not text:
+                continue
+            source_id = row.get(id_field)
+            yield (source_id or None), _plain_text(text)
+
+def _plain_text(text: str) -> str:
+    # Cheap check before parsing: only markup needs stripping
+    return strip_html(text) if '<' in text and '>' in text else text
+
+def iter_files(paths: Iterable[str]) -> Iterator[str]:
+    """
+    Function to expand the input paths into the files to ingest; directories are walked recursively in name order
+    and files of unknown types in them are skipped.
+
+    :raises ValueError: If a file given explicitly has an unsupported extension.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if os.path.splitext(name)[1].lower() in _EXTENSIONS:
+                        yield os.path.join(root, name)
+        else:
+            if os.path.splitext(path)[1].lower() not in _EXTENSIONS:
+                raise ValueError(f"'{path}' has an unsupported type. Choose from {sorted(_EXTENSIONS)}.")
+            yield path
+
+def iter_postings(paths: Iterable[str],
+                  text_field: str = 'description',
+                  id_field: str = 'id',
+                  posting_tag: Optional[str] = None,
+                  seen: Optional['Checkpoint'] = None) -> Iterator[Dict[str, str]]:
+    """
+    Function to lazily read, clean and deduplicate the postings of any number of dumps.
+
+    :param paths: Files or directories to ingest.
+    :param text_field: Column or key holding the job description (CSV and JSONL).
+    :param id_field: Column or key holding the source ID (CSV and JSONL).
+    :param posting_tag: Tag of the elements holding one posting each in HTML files, None for one posting per page.
+    :param seen: Checkpoint of the run (or any container with an `add` method, e.g. a set for small dumps): the
+                 postings it contains are dropped and the IDs of the others are added, None to keep duplicates.
+    :return: A generator of dictionaries with the stable 'id', the 'source' (file and source ID) and the 'description'.
+    """
+    for file_path in iter_files(paths):
+        kind = _EXTENSIONS[os.path.splitext(file_path)[1].lower()]
+        if kind == 'html':
+            postings = iter_html(file_path, posting_tag)
+        elif kind == 'csv':
+            postings = iter_csv(file_path, text_field, id_field)
+        else:
+            postings = iter_jsonl(file_path, text_field, id_field)
+        for source_id, text in postings:
+            item_id = posting_id(text)
+            if seen is not None:
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+            source = file_path if source_id is None else f"{file_path}:{source_id}"
+            yield {'id': item_id, 'source': source, 'description': text}
+
+class Checkpoint:
+    """
+    SQLite record of the postings finished by an ingestion run, so that a restarted run skips them, and of the
+    postings seen by the current run, so that their exact duplicates are skipped too.
+
+    :param db_path: Path of the SQLite database.
+    """
+    def __init__(self, db_path: str = os.path.join('data', 'ingest_checkpoint.sqlite')) -> None:
+        self.db_path = db_path
+        directory_name = os.path.dirname(db_path)
+        if directory_name and not os.path.exists(directory_name):
+            os.makedirs(directory_name)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS done (
+                id TEXT PRIMARY KEY,
+                info TEXT,
+                cost REAL NOT NULL,
+                finished_at REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)")
+        self._conn.commit()
+
+    def __contains__(self, item_id: str) -> bool:
+        """
+        :return: True if the posting was finished by a run or already seen by the current run.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM done WHERE id = ? UNION ALL SELECT 1 FROM seen WHERE id = ?",
+                                      (item_id, item_id)).fetchone() is not None
+
+    def start_run(self) -> None:
+        """
+        Forgets the postings seen by the previous run; those it didn't finish are read again.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM seen")
+            self._conn.commit()
+
+    def add(self, item_id: str) -> None:
+        """
+        Records a posting seen by the current run. Not committed by itself: the next mark_done commits it, and
+        a crash only loses rows the next run forgets anyway.
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO seen (id) VALUES (?)", (item_id,))
+
+    def mark_done(self, item_id: str, info: Optional[str], cost: float) -> None:
+        """
+        Records a finished posting (committed immediately, so nothing is lost on a crash).
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO done (id, info, cost, finished_at) VALUES (?, ?, ?, ?)",
+                               (item_id, info, cost, time.time()))
+            self._conn.commit()
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        :return: The number of finished postings per info string and their total cost.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT info, COUNT(*), SUM(cost) FROM done GROUP BY info").fetchall()
+        return {'done': {str(info): count for info, count, _ in rows}, 'cost': sum(cost or 0 for _, _, cost in rows)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+def ingest_run(model_name: str,
+               role_name: str,
+               paths: Iterable[str],
+               checkpoint: Checkpoint,
+               max_workers: int = 8,
+               store_data: bool = True,
+               use_cache: bool = True,
+               text_field: str = 'description',
+               id_field: str = 'id',
+               posting_tag: Optional[str] = None,
+               budget_limit: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Scans the postings of raw dumps with the batch engine (see Tool.batch.batch_run), skipping the postings
+    finished by earlier runs with the same checkpoint and recording the new ones as they complete.
+
+    :param model_name: Name of the model to use, e.g., 'GPT-3.5', 'GPT-4' or 'Cascade'.
+    :param role_name: Role for the conversation, e.g., 'Data relevant', 'Software Engineer', 'General'.
+    :param paths: Files or directories to ingest (see iter_postings).
+    :param checkpoint: The checkpoint of the run.
+    :param budget_limit: Spend limit of the run in dollars, None for no limit; the postings beyond it are left for
+                         the next run.
+    :return: A generator of the batch results ('id' is the stable posting ID), with the 'source' of every posting.
+    """
+    from Tool.batch import batch_run
+    checkpoint.start_run()
+    # The checkpoint drops both the postings finished by earlier runs and the duplicates within this run
+    postings = iter_postings(paths, text_field, id_field, posting_tag, seen=checkpoint)
+    # Sources are only kept for the postings in flight
+    sources: Dict[str, str] = {}
+    def items() -> Iterator[Tuple[str, str]]:
+        for posting in postings:
+            sources[posting['id']] = posting['source']
+            yield posting['id'], posting['description']
+    for result in batch_run(model_name, role_name, items(), max_workers=max_workers,
+                            store_data=store_data, use_cache=use_cache, budget_limit=budget_limit):
+        result['source'] = sources.pop(result['id'], None)
+        # Failed, malformed and over-budget postings are retried by the next run
+        if result['info'] in FINAL_INFOS:
+            checkpoint.mark_done(result['id'], result['info'], result['response'].get('cost', 0))
+        yield result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Ingest raw job-posting dumps (HTML, JSONL, CSV) and scan them with JobScanGPT.')
+    parser.add_argument('paths', nargs='+', help='Dump files or directories.')
+    parser.add_argument('--model', default='GPT-3.5', choices=['GPT-3.5', 'GPT-4', 'Cascade'])
+    parser.add_argument('--role', default='Data relevant', choices=['Data relevant', 'Software Engineer', 'General'])
+    parser.add_argument('--workers', type=int, default=8, help='Number of concurrent workers.')
+    parser.add_argument('--text-field', default='description', help='Column or JSON key holding the job description.')
+    parser.add_argument('--id-field', default='id', help='Column or JSON key holding the source ID.')
+    parser.add_argument('--posting-tag', default=None, help="HTML tag holding one posting each, e.g. 'article' (default: one posting per page).")
+    parser.add_argument('--checkpoint', default=os.path.join('data', 'ingest_checkpoint.sqlite'),
+                        help='Checkpoint database; reuse it to resume an interrupted run.')
+    parser.add_argument('--output', default=None, help='JSONL file the results are appended to (default: stdout).')
+    parser.add_argument('--no-store', action='store_true', help="Don't store inputs and outputs under data/.")
+    parser.add_argument('--no-cache', action='store_true', help="Don't use the result cache.")
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Spend limit of this run in dollars; the postings beyond it are left for the next run.')
+    args = parser.parse_args()
+
+    # Load API
+    import openai
+    from dotenv import load_dotenv
+    _ = load_dotenv('API_key/.env')
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+
+    checkpoint = Checkpoint(args.checkpoint)
+    # Append, so the results of a resumed run follow those of the interrupted one
+    out = open(args.output, 'a') if args.output else sys.stdout
+    summary = {}
+    total_cost = 0
+    try:
+        for result in ingest_run(args.model, args.role, args.paths, checkpoint, max_workers=args.workers,
+                                 store_data=not args.no_store, use_cache=not args.no_cache,
+                                 text_field=args.text_field, id_field=args.id_field, posting_tag=args.posting_tag,
+                                 budget_limit=args.budget):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            summary[str(result['info'])] = summary.get(str(result['info']), 0) + 1
+            total_cost += result['response'].get('cost', 0)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        checkpoint.close()
+    print(f"Scanned {sum(summary.values())} new postings {summary}, total cost {round(total_cost, 4)}$", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
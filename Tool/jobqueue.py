@@ -0,0 +1,237 @@
+"""
+This module contains the persistent job queue of the worker service (see Tool.service).
+
+Scans submitted to the service are rows of a SQLite table (WAL mode), so the HTTP server and any number of worker
+processes share the queue through the database file and queued jobs survive a restart. A worker claims the
+oldest queued job in an immediate transaction, which makes the claim atomic across processes, and holds it for a
+lease, which the worker renews while the scan runs: a job whose worker died is claimed again once its lease
+expires, up to MAX_ATTEMPTS times.
+
+The API key of a job (if the user brought their own) is erased from the database as soon as a worker claims the
+job; the worker keeps it in memory for the scan. A job whose worker died after the claim can't be run again with
+the key of the user, so it is failed instead of being claimed again. The job description is stored in the
+database until the job finishes, including for jobs that must not store data (llm_deploy_run), whose description
+is then erased.
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+# Seconds a worker holds a claimed job before another worker may take it over
+LEASE_SECONDS = 600
+# Claims of a job before it is failed (a worker crashing on it every time must not block the queue)
+MAX_ATTEMPTS = 3
+# Statuses of a job
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+class JobQueue:
+    """
+    SQLite (WAL mode) queue of scan jobs, shared by the service and its worker processes.
+
+    :param db_path: Path of the SQLite database.
+    """
+    def __init__(self, db_path: str = os.path.join('data', 'jobs.sqlite')) -> None:
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Open the database lazily so a queue can be created before forking worker processes
+        if self._conn is None:
+            directory_name = os.path.dirname(self.db_path)
+            if directory_name and not os.path.exists(directory_name):
+                os.makedirs(directory_name)
+            # Autocommit mode: claims open their own immediate transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    description TEXT,
+                    store_data INTEGER NOT NULL,
+                    use_cache INTEGER NOT NULL,
+                    api_key TEXT,
+                    budget_session TEXT,
+                    budget_limit REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    lease_until REAL,
+                    response TEXT,
+                    info TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+            """)
+            # Queues created before the budget columns
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (('budget_session', 'TEXT'), ('budget_limit', 'REAL')):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            self._conn = conn
+        return self._conn
+
+    def submit(self, model_name: str, role_name: str, description: str, store_data: bool = True,
+               use_cache: bool = True, api_key: Optional[str] = None, budget_session: Optional[str] = None,
+               budget_limit: Optional[float] = None) -> str:
+        """
+        Adds a scan to the queue.
+
+        :param model_name: Model of the scan, see Tool.llm_comp.llm_run.
+        :param role_name: Role of the scan.
+        :param description: The job description.
+        :param store_data: Whether the scan stores its input and output (llm_run) or not (llm_deploy_run).
+        :param use_cache: Whether the scan may be served from the result cache.
+        :param api_key: OpenAI API key of the user, None for the key of the workers.
+        :param budget_session: Session the scan is charged to (see Tool.budget.BudgetScope), if any.
+        :param budget_limit: Spend limit of the session in dollars, None for no limit.
+        :return: The job ID.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._connect().execute("""
+                INSERT INTO jobs (id, status, model, role, description, store_data, use_cache, api_key, budget_session,
+                    budget_limit, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (job_id, QUEUED, model_name, role_name, description, int(store_data), int(use_cache), api_key,
+                 budget_session, budget_limit, time.time()))
+        return job_id
+
+    def claim(self, worker: str, lease: float = LEASE_SECONDS) -> Optional[Dict[str, Any]]:
+        """
+        Claims the oldest queued job, or a running job whose lease has expired.
+
+        :param worker: Name of the claiming worker, kept for the status of the job.
+        :param lease: Seconds the job is held before another worker may claim it.
+        :return: The job (id, model, role, description, store_data, use_cache, api_key, budget_session, budget_limit,
+                 attempts), or None if the queue is empty.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs abandoned too many times, or whose API key was erased by the lost claim (left as an empty
+                # string), are failed instead of being claimed again
+                conn.execute("""
+                    UPDATE jobs SET status = ?, error = 'worker lost', finished_at = ?, api_key = NULL,
+                        description = CASE WHEN store_data THEN description END
+                    WHERE status = ? AND lease_until < ? AND (attempts >= ? OR api_key = '')""",
+                    (FAILED, now, RUNNING, now, MAX_ATTEMPTS))
+                row = conn.execute("""
+                    SELECT id, model, role, description, store_data, use_cache, api_key, budget_session, budget_limit,
+                        attempts FROM jobs
+                    WHERE status = ? OR (status = ? AND lease_until < ?)
+                    ORDER BY created_at LIMIT 1""", (QUEUED, RUNNING, now)).fetchone()
+                if row is not None:
+                    conn.execute("""
+                        UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1,
+                            started_at = ?, api_key = CASE WHEN api_key IS NOT NULL THEN '' END
+                        WHERE id = ?""", (RUNNING, worker, now + lease, now, row[0]))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = dict(zip(('id', 'model', 'role', 'description', 'store_data', 'use_cache', 'api_key', 'budget_session',
+                        'budget_limit', 'attempts'), row))
+        job.update(store_data=bool(job['store_data']), use_cache=bool(job['use_cache']), attempts=job['attempts'] + 1)
+        return job
+
+    def renew(self, job_id: str, worker: str, lease: float = LEASE_SECONDS) -> bool:
+        """
+        Extends the lease of a running job, so a scan longer than the lease is not claimed by another worker.
+
+        :param lease: Seconds the job is held from now.
+        :return: False if the job was meanwhile taken over by another worker.
+        """
+        with self._lock:
+            cursor = self._connect().execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ? AND worker = ?",
+                (time.time() + lease, job_id, RUNNING, worker))
+        return cursor.rowcount == 1
+
+    def _finish(self, job_id: str, worker: str, status: str, response: Optional[Dict[str, Any]],
+                info: Optional[str], error: Optional[str]) -> bool:
+        with self._lock:
+            cursor = self._connect().execute("""
+                UPDATE jobs SET status = ?, response = ?, info = ?, error = ?, finished_at = ?, api_key = NULL,
+                    description = CASE WHEN store_data THEN description END
+                WHERE id = ? AND status = ? AND worker = ?""",
+                (status, None if response is None else json.dumps(response), info, error, time.time(), job_id,
+                 RUNNING, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, response: Dict[str, Any], info: Optional[str]) -> bool:
+        """
+        Records the result of a job.
+
+        :return: False if the job was meanwhile taken over by another worker (its result is then discarded).
+        """
+        return self._finish(job_id, worker, DONE, response, info, None)
+
+    def fail(self, job_id: str, worker: str, error: str) -> bool:
+        """
+        Records the failure of a job.
+
+        :return: False if the job was meanwhile taken over by another worker.
+        """
+        return self._finish(job_id, worker, FAILED, None, None, error)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        :return: The status of a job (id, status, model, role, attempts, timestamps) with its response and info
+                 once done or its error once failed, or None if the job ID is unknown.
+        """
+        with self._lock:
+            row = self._connect().execute("""
+                SELECT id, status, model, role, attempts, response, info, error, created_at, started_at, finished_at
+                FROM jobs WHERE id = ?""", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(('id', 'status', 'model', 'role', 'attempts', 'response', 'info', 'error',
+                        'created_at', 'started_at', 'finished_at'), row))
+        job['response'] = None if job['response'] is None else json.loads(job['response'])
+        for key in ('response', 'info', 'error'):
+            if job[key] is None:
+                del job[key]
+        return job
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: The number of jobs per status.
+        """
+        with self._lock:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        counts.update(rows)
+        return counts
+
+    def purge(self, older_than: float) -> int:
+        """
+        Deletes the finished jobs older than some age.
+
+        :param older_than: Age in seconds.
+        :return: The number of jobs deleted.
+        """
+        with self._lock:
+            cursor = self._connect().execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                                             (DONE, FAILED, time.time() - older_than))
+        return cursor.rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
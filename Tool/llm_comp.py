@@ -1,154 +1,790 @@
-from typing import Any, List, Dict, Tuple, Union
+from typing import Any, Callable, List, Dict, NamedTuple, Optional, Tuple, Union
 import json
+import time
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
 import openai
-from Tool.utils import write_to_file, append_json_to_file, is_valid_json
-from Tool.prompt import ds_prompt, se_prompt, general_prompt
+from Tool.utils import append_json_to_file, is_valid_json, estimate_tokens, IncrementalJSONParser
+from Tool.prompt import REJECT_FUNCTION, field_prompt, function_registry, get_functions, get_prompt, prompt_versions
+from Tool.schema import ParsedOutput, complete_record, parse_model_output
+from Tool.cache import ResultCache, make_cache_key
+from Tool.scheduler import get_scheduler
+from Tool.database import ResultIndex
+from Tool.blobstore import BlobStore
+from Tool.dedup import NearDuplicateIndex
+from Tool.classifier import DEFAULT_THRESHOLD, is_job_description
+from Tool.confidence import DEFAULT_CONFIDENCE_THRESHOLD, score_extraction
+from Tool.preprocess import DEFAULT_TOKEN_BUDGET, preprocess_job_description
+from Tool.metrics import metrics, record_usage, span
+from Tool.aio import pooled_session, propagate_context_var, request_api_key, request_options, run_sync
+from Tool.budget import BudgetExceeded, BudgetLedger, BudgetScope, current_budget, token_cost
 
-def llm_completion(model_name: str, role_name: str, user_message: str) -> Tuple[str, Dict[str, int]]:
+# Result caches: persistent for llm_run, in-memory for llm_deploy_run which must not store data on disk
+result_cache = ResultCache()
+deploy_result_cache = ResultCache(db_path=':memory:')
+# Near-duplicate indexes (same storage policy as the result caches)
+dedup_index = NearDuplicateIndex()
+deploy_dedup_index = NearDuplicateIndex(db_path=':memory:')
+# Score below which an input is rejected as 'not_job' without calling the API (0 disables the local check)
+classifier_threshold = DEFAULT_THRESHOLD
+# Send the completion without waiting for the moderation verdict (lower latency; a flagged input wastes its completion)
+speculative_moderation = False
+# How the fields are requested: 'prompt' (JSON described in the prompt) or 'functions' (function calling)
+extraction_mode = 'prompt'
+valid_extraction_modes = ['prompt', 'functions']
+# Model name of the cascade: the tiers are tried in order until an extraction reaches the confidence threshold
+CASCADE_MODEL = 'Cascade'
+cascade_models = ['GPT-3.5', 'GPT-4']
+cascade_threshold = DEFAULT_CONFIDENCE_THRESHOLD
+# Queryable index of the stored extractions (llm_run only)
+result_index = ResultIndex(history_models=('GPT-3.5', 'GPT-4'))
+# Compressed store of the raw job descriptions (llm_run only)
+text_store = BlobStore()
+# Spend ledgers (same storage policy as the result caches)
+budget_ledger = BudgetLedger()
+deploy_budget_ledger = BudgetLedger(db_path=':memory:')
+# Ledger of the scan being run (None: budget_ledger)
+_current_ledger: ContextVar[Optional[BudgetLedger]] = ContextVar('current_ledger', default=None)
+propagate_context_var(_current_ledger)
+
+@contextmanager
+def charged_to(budget: Optional[BudgetScope], store_data: bool = True):
     """
-    Generates a language model completion for a given model, role, and user message.
+    Context manager charging the completion requests issued inside it (in this thread, its run_sync calls and its
+    tasks) to a budget scope, and recording them in the ledger of the storage policy.
 
-    :param model_name: Name of the model to use, must be one of ['GPT-3.5', 'GPT-4'].
-    :param role_name: Role for the conversation, must be one of ['Data relevant', 'Software Engineer', 'General'].
-    :param user_message: The user's input message for the conversation(A job description in our case).
+    :param budget: Session and batch limits (see Tool.budget.BudgetScope), None to keep the current scope.
+    :param store_data: Whether to record the spend in the persistent ledger (True) or in memory only (False).
+    """
+    ledger_token = _current_ledger.set(budget_ledger if store_data else deploy_budget_ledger)
+    budget_token = current_budget.set(budget) if budget is not None else None
+    try:
+        yield
+    finally:
+        if budget_token is not None:
+            current_budget.reset(budget_token)
+        _current_ledger.reset(ledger_token)
+
+async def get_completion_from_messages_async(messages: List[Dict[str, str]],
+                                             model: str,
+                                             temperature: float = 0,
+                                             max_tokens: int = 500,
+                                             on_delta: Optional[Callable[[str], None]] = None,
+                                             functions: Optional[List[Dict[str, Any]]] = None) -> Tuple[str, Dict[str, int]]:
+    """
+    Sends a chat completion request through the rate-limit scheduler of the model, over the pooled aiohttp session.
+
+    :param messages: The chat messages.
+    :param model: The API model name, e.g., 'gpt-3.5-turbo'.
+    :param temperature: Sampling temperature.
+    :param max_tokens: Maximum number of completion tokens.
+    :param on_delta: If given, the completion is streamed and on_delta is called with every piece of content as it arrives.
+    :param functions: Function declarations for the function-calling mode (see Tool.prompt.compile_functions).
+                      If the model calls a function, the content is its JSON arguments, or the not-a-job sentence
+                      for the reject function.
     :return: A tuple containing the content response from the model and a dictionary of token usage details.
+
+    :raises BudgetExceeded: If the worst-case cost of the request would exceed a spend limit (see Tool.budget).
     """
-    def get_completion_from_messages(messages: List[Dict[str, str]],
-                                     model: str,
-                                     temperature: float = 0,
-                                     max_tokens: int = 500) -> Tuple[str, Dict[str, int]]:
-        response = openai.ChatCompletion.create(
+    # Prompt + completion tokens reserved in the TPM quota (OpenAI counts max_tokens against it)
+    prompt_tokens = sum(estimate_tokens(message['content']) + 4 for message in messages) + 3
+    if functions:
+        prompt_tokens += estimate_tokens(json.dumps(functions))
+    estimated_tokens = prompt_tokens + max_tokens
+    # Reserve the worst-case cost against the spend limits before sending anything
+    ledger = _current_ledger.get() or budget_ledger
+    reservation = await asyncio.to_thread(ledger.reserve, model, token_cost(model, prompt_tokens, max_tokens),
+                                          current_budget.get())
+    try:
+        content, token_dict = await _send_completion(messages, model, temperature, max_tokens, on_delta, functions,
+                                                     prompt_tokens, estimated_tokens)
+    except asyncio.CancelledError:
+        # The prompt may have been sent already, count it as spent
+        ledger.settle(reservation, {'prompt_tokens': prompt_tokens, 'completion_tokens': 0})
+        raise
+    except BaseException:
+        ledger.release(reservation)
+        raise
+    await asyncio.to_thread(ledger.settle, reservation, token_dict)
+    return content, token_dict
+
+async def _send_completion(messages: List[Dict[str, str]], model: str, temperature: float, max_tokens: int,
+                           on_delta: Optional[Callable[[str], None]], functions: Optional[List[Dict[str, Any]]],
+                           prompt_tokens: int, estimated_tokens: int) -> Tuple[str, Dict[str, int]]:
+    scheduler = get_scheduler(model)
+    options = dict(request_options(), functions=functions) if functions else request_options()
+    async with pooled_session():
+        response = await scheduler.acall(
+            openai.ChatCompletion.acreate,
+            estimated_tokens=estimated_tokens,
             model=model,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
+            stream=on_delta is not None,
+            **options,
         )
-        content = response.choices[0].message["content"]
+        if on_delta is not None:
+            pieces = []
+            function_name = None
+            async for chunk in response:
+                delta = chunk.choices[0].delta
+                piece = delta.get('content')
+                function_call = delta.get('function_call')
+                if function_call:
+                    function_name = function_name or function_call.get('name')
+                    piece = function_call.get('arguments')
+                if piece:
+                    pieces.append(piece)
+                    on_delta(piece)
+            content = ''.join(pieces)
+            if function_name is not None:
+                content = _function_content(function_name, content)
+            # The streaming API reports no usage: the tokens are counted locally and flagged as an estimate
+            completion_tokens = estimate_tokens(content)
+            token_dict = {
+                'prompt_tokens':prompt_tokens,
+                'completion_tokens':completion_tokens,
+                'total_tokens':prompt_tokens + completion_tokens,
+                'estimated':True,
+            }
+            # The stream reports no usage: the scheduler leaves its reservation to be settled here
+            scheduler.settle(estimated_tokens, token_dict['total_tokens'])
+            return content, token_dict
+
+    message = response.choices[0].message
+    if message.get('function_call'):
+        content = _function_content(message['function_call']['name'], message['function_call'].get('arguments', ''))
+    else:
+        content = message["content"]
 
-        token_dict = {
-            'prompt_tokens':response['usage']['prompt_tokens'],
-            'completion_tokens':response['usage']['completion_tokens'],
-            'total_tokens':response['usage']['total_tokens'],
-        }
+    token_dict = {
+        'prompt_tokens':response['usage']['prompt_tokens'],
+        'completion_tokens':response['usage']['completion_tokens'],
+        'total_tokens':response['usage']['total_tokens'],
+    }
 
-        return content, token_dict
+    return content, token_dict
+
+def _function_content(name: str, arguments: str) -> str:
+    # A call of the reject function reads like the refusal of the prose prompts
+    if name == REJECT_FUNCTION:
+        return 'The input is not a job description'
+    return arguments
+
+def get_completion_from_messages(messages: List[Dict[str, str]],
+                                 model: str,
+                                 temperature: float = 0,
+                                 max_tokens: int = 500,
+                                 on_delta: Optional[Callable[[str], None]] = None,
+                                 functions: Optional[List[Dict[str, Any]]] = None) -> Tuple[str, Dict[str, int]]:
+    """
+    Blocking version of get_completion_from_messages_async; on_delta is called in the calling thread.
+    """
+    return run_sync(get_completion_from_messages_async, messages, model, temperature, max_tokens,
+                    on_delta=on_delta, functions=functions, callbacks=('on_delta',))
 
+def api_model_name(model_name: str) -> str:
+    """
+    Maps a model name of the app to the OpenAI API model name.
+
+    :param model_name: Name of the model, must be one of ['GPT-3.5', 'GPT-4'].
+    :return: The API model name, e.g., 'gpt-3.5-turbo'.
+
+    :raises ValueError: If the model_name is not valid.
+    """
     # Check the model name is valid
     valid_models = ['GPT-3.5', 'GPT-4']
     if model_name not in valid_models:
         raise ValueError(f"'{model_name}' is not a valid argument. Choose from {valid_models}.")
     model_APInames_ = ['gpt-3.5-turbo', 'gpt-4']
     model_dict = dict(zip(valid_models, model_APInames_))
-    # Check role name is valid
-    valid_roles = ['Data relevant', 'Software Engineer', 'General']
-    if role_name not in valid_roles:
-        raise ValueError(f"'{role_name}' is not a valid argument. Choose from {valid_roles}.")  
-
-    # Prompt preparation
-    if role_name == 'Data relevant':
-        system_message = ds_prompt
-    elif role_name == 'Software Engineer':
-        system_message = se_prompt
+    return model_dict[model_name]
+
+def role_system_message(role_name: str) -> str:
+    """
+    Selects the system prompt of a role from the prompt registry.
+
+    :param role_name: Role for the conversation, must be one of ['Data relevant', 'Software Engineer', 'General'].
+    :return: The system prompt.
+
+    :raises ValueError: If the role_name is not valid.
+    """
+    return get_prompt(role_name).text
+
+def _extraction_mode(mode: Optional[str]) -> str:
+    mode = mode or extraction_mode
+    if mode not in valid_extraction_modes:
+        raise ValueError(f"'{mode}' is not a valid argument. Choose from {valid_extraction_modes}.")
+    return mode
+
+def prepare_messages(model_name: str, role_name: str, user_message: str,
+                     token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET,
+                     mode: Optional[str] = None) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Builds the chat messages of a completion: role prompt and preprocessed job description.
+
+    :param model_name: Name of the model to use, must be one of ['GPT-3.5', 'GPT-4'].
+    :param role_name: Role for the conversation, must be one of ['Data relevant', 'Software Engineer', 'General'].
+    :param user_message: The user's input message for the conversation(A job description in our case).
+    :param token_budget: Token budget of the job description after boilerplate removal (see preprocess_job_description),
+                         None to send the job description verbatim.
+    :param mode: Extraction mode, 'prompt' or 'functions' (defaults to extraction_mode).
+    :return: A tuple containing the messages and the number of prompt tokens saved by the preprocessing.
+
+    :raises ValueError: If the model_name, role_name or mode is not valid.
+    """
+    api_model_name(model_name)
+    if _extraction_mode(mode) == 'functions':
+        system_message = get_functions(role_name).system
     else:
-        system_message = general_prompt
-    messages =  [
-    {'role':'system',
-    'content': system_message},
-    {'role':'user',
-    'content': f"####{user_message}####"},
-    ]
-    response, token_usage = get_completion_from_messages(messages, model_dict[model_name])
+        system_message = role_system_message(role_name)
+    with span('prompt_build', model_name, role_name):
+        tokens_saved = 0
+        if token_budget is not None:
+            user_message, preprocess_stats = preprocess_job_description(user_message, token_budget)
+            tokens_saved = preprocess_stats['tokens_saved']
+        messages =  [
+        {'role':'system',
+        'content': system_message},
+        {'role':'user',
+        'content': f"####{user_message}####"},
+        ]
+    return messages, tokens_saved
+
+async def _complete_async(model_name: str, role_name: str, messages: List[Dict[str, str]], tokens_saved: int,
+                          on_delta: Optional[Callable[[str], None]] = None,
+                          mode: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+    options = {}
+    if _extraction_mode(mode) == 'functions':
+        # The completion budget follows the size of the schema
+        compiled = get_functions(role_name)
+        options = {'functions': compiled.functions, 'max_tokens': compiled.max_tokens}
+    with span('completion', model_name, role_name):
+        response, token_usage = await get_completion_from_messages_async(messages, api_model_name(model_name),
+                                                                         on_delta=on_delta, **options)
+    token_usage['tokens_saved'] = tokens_saved
     return response, token_usage
-    
-def llm_run(model_name: str, role_name: str, user_message: str) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+
+async def llm_completion_async(model_name: str, role_name: str, user_message: str,
+                               on_delta: Optional[Callable[[str], None]] = None,
+                               token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET,
+                               mode: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+    """
+    Generates a language model completion for a given model, role, and user message.
+
+    :param model_name: Name of the model to use, must be one of ['GPT-3.5', 'GPT-4'].
+    :param role_name: Role for the conversation, must be one of ['Data relevant', 'Software Engineer', 'General'].
+    :param user_message: The user's input message for the conversation(A job description in our case).
+    :param on_delta: If given, the completion is streamed and on_delta is called with every piece of content as it arrives.
+                     The returned content is the same as without streaming; since the streaming API doesn't report
+                     token usage, it is counted locally (see estimate_tokens) and flagged with 'estimated'.
+    :param token_budget: Token budget of the job description after boilerplate removal (see preprocess_job_description),
+                         None to send the job description verbatim.
+    :param mode: Extraction mode (defaults to extraction_mode): 'prompt' asks for JSON in the prompt, 'functions' declares
+                 the fields as a function and returns the JSON arguments of the call (the refusal sentence if the model
+                 rejects the input).
+    :return: A tuple containing the content response from the model and a dictionary of token usage details,
+             including the prompt tokens saved by the preprocessing under 'tokens_saved'.
+    """
+    messages, tokens_saved = prepare_messages(model_name, role_name, user_message, token_budget, mode)
+    return await _complete_async(model_name, role_name, messages, tokens_saved, on_delta, mode)
+
+def llm_completion(model_name: str, role_name: str, user_message: str,
+                   on_delta: Optional[Callable[[str], None]] = None,
+                   token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET,
+                   mode: Optional[str] = None) -> Tuple[str, Dict[str, int]]:
+    """
+    Blocking version of llm_completion_async; on_delta is called in the calling thread.
+    """
+    return run_sync(llm_completion_async, model_name, role_name, user_message,
+                    on_delta=on_delta, token_budget=token_budget, mode=mode, callbacks=('on_delta',))
+
+async def llm_run_async(model_name: str, role_name: str, user_message: str, use_cache: bool = True,
+                        on_field: Optional[Callable[[str, Any], None]] = None,
+                        api_key: Optional[str] = None,
+                        budget: Optional[BudgetScope] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
     """
     Runs the language model completion for a given model, role, and user message, 
     with moderation checks and response handling.
+    Moderation runs concurrently with the prompt preparation; the blocking steps (cache, storage) run in worker threads.
 
-    :param model_name: Name of the model to use, e.g., 'GPT-3.5' or 'GPT-4'.
+    :param model_name: Name of the model to use, e.g., 'GPT-3.5' or 'GPT-4', or 'Cascade' to try GPT-3.5 first and
+                       escalate to GPT-4 only when the extraction is uncertain (the response dictionary then carries
+                       the answering model under 'tier', its 'confidence' and the cost of all tiers).
     :param role_name: Role for the conversation, e.g., 'Data relevant', 'Software Engineer', 'General'.
     :param user_message: The user's message for the conversation.
+    :param use_cache: Whether to serve repeated (or near-duplicate) job descriptions from the result cache (cost is 0 on a hit).
+                      Near-duplicate hits carry the matched document ID under 'duplicate_of' in the response dictionary.
+    :param on_field: If given, the completion is streamed and on_field(key, value) is called for every field
+                     of the JSON output as soon as it is complete. The returned result is the same as without streaming.
+    :param api_key: OpenAI API key of the user, for apps serving several users with their own keys (default: openai.api_key).
+    :param budget: Session and batch spend limits of the scan (see Tool.budget.BudgetScope); the daily limit always applies.
     :return: A tuple containing a response dictionary with the cost and optionally the company information,
-             and an info string if there are issues with the input or response (e.g., 'flagged', 'not_job', 'not_json').
+             and an info string if there are issues with the input or response (e.g., 'flagged', 'not_job', 'not_json',
+             or 'over_budget' if the completion would exceed a spend limit).
 
-    :raises ValueError: If the model_name or role_name is not valid (checked in llm_completion).
+    :raises ValueError: If the model_name or role_name is not valid (checked in prepare_messages).
     """
-    # Check appropriateness of input
-    moderation_output = openai.Moderation.create(user_message)["results"][0]
-    info = None
-    if moderation_output['flagged']:
-        info = 'flagged'
-        response_dict = {'cost': 0}
-        return response_dict, info
-    else:
-        # API call
-        response, token_usage = llm_completion(model_name, role_name, user_message)
+    cache, dedup = (result_cache, dedup_index) if use_cache else (None, None)
+    return await _run_pipeline(model_name, role_name, user_message, store_data=True, cache=cache, dedup=dedup,
+                               on_field=on_field, api_key=api_key, budget=budget)
 
-    # Check if the input is relevant to job descriptions
-    if token_usage['completion_tokens'] == 8:
-        info = 'not_job'
-        response_dict = {}
-    # Check output from LLM
-    elif not is_valid_json(response):
-        info = 'not_json'
-        response_dict = {}
-    if info is None:
-        # Parse output
-        response_dict = json.loads(response)
-        # Store data
-        company_name = response_dict['Company']
-        file_name = '_'.join(company_name.split(' ')) + '.txt'
-        write_to_file(file_name, user_message)
-        append_json_to_file(model_name, response_dict)
+async def llm_deploy_run_async(model_name: str, role_name: str, user_message: str, use_cache: bool = True,
+                               on_field: Optional[Callable[[str, Any], None]] = None,
+                               api_key: Optional[str] = None,
+                               budget: Optional[BudgetScope] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Same as llm_run_async except when running in deployed environment do not store data.
+    The result cache and near-duplicate index are kept in memory only, so nothing is written to disk.
+    See llm_run_async for the parameters.
+    """
+    cache, dedup = (deploy_result_cache, deploy_dedup_index) if use_cache else (None, None)
+    return await _run_pipeline(model_name, role_name, user_message, store_data=False, cache=cache, dedup=dedup,
+                               on_field=on_field, api_key=api_key, budget=budget)
 
-    # Calculate cost
-    cost = api_cost(model_name, token_usage)
-    response_dict['cost'] = cost
-    return response_dict, info
+def llm_run(model_name: str, role_name: str, user_message: str, use_cache: bool = True,
+            on_field: Optional[Callable[[str, Any], None]] = None,
+            api_key: Optional[str] = None,
+            budget: Optional[BudgetScope] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Blocking version of llm_run_async; on_field is called in the calling thread.
 
-def llm_deploy_run(model_name: str, role_name: str, user_message: str) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    :param model_name: Name of the model to use, e.g., 'GPT-3.5' or 'GPT-4', or 'Cascade' to try GPT-3.5 first and
+                       escalate to GPT-4 only when the extraction is uncertain (the response dictionary then carries
+                       the answering model under 'tier', its 'confidence' and the cost of all tiers).
+    :param role_name: Role for the conversation, e.g., 'Data relevant', 'Software Engineer', 'General'.
+    :param user_message: The user's message for the conversation.
+    :param use_cache: Whether to serve repeated (or near-duplicate) job descriptions from the result cache (cost is 0 on a hit).
+                      Near-duplicate hits carry the matched document ID under 'duplicate_of' in the response dictionary.
+    :param on_field: If given, the completion is streamed and on_field(key, value) is called for every field
+                     of the JSON output as soon as it is complete. The returned result is the same as without streaming.
+    :param api_key: OpenAI API key of the user, for apps serving several users with their own keys (default: openai.api_key).
+    :param budget: Session and batch spend limits of the scan (see Tool.budget.BudgetScope); the daily limit always applies.
+    :return: A tuple containing a response dictionary with the cost and optionally the company information,
+             and an info string if there are issues with the input or response (e.g., 'flagged', 'not_job', 'not_json',
+             or 'over_budget' if the completion would exceed a spend limit).
+
+    :raises ValueError: If the model_name or role_name is not valid (checked in prepare_messages).
+    """
+    return run_sync(llm_run_async, model_name, role_name, user_message, use_cache=use_cache,
+                    on_field=on_field, api_key=api_key, budget=budget, callbacks=('on_field',))
+
+def llm_deploy_run(model_name: str, role_name: str, user_message: str, use_cache: bool = True,
+                   on_field: Optional[Callable[[str, Any], None]] = None,
+                   api_key: Optional[str] = None,
+                   budget: Optional[BudgetScope] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
     """
     Same as llm_run except when running in deployed environment do not store data.
+    The result cache and near-duplicate index are kept in memory only, so nothing is written to disk.
 
-    :param model_name: Name of the model to use, e.g., 'GPT-3.5' or 'GPT-4'.
+    :param model_name: Name of the model to use, e.g., 'GPT-3.5' or 'GPT-4', or 'Cascade' to try GPT-3.5 first and
+                       escalate to GPT-4 only when the extraction is uncertain (the response dictionary then carries
+                       the answering model under 'tier', its 'confidence' and the cost of all tiers).
     :param role_name: Role for the conversation, e.g., 'Data relevant', 'Software Engineer', 'General'.
     :param user_message: The user's message for the conversation.
+    :param use_cache: Whether to serve repeated (or near-duplicate) job descriptions from the result cache (cost is 0 on a hit).
+                      Near-duplicate hits carry the matched document ID under 'duplicate_of' in the response dictionary.
+    :param on_field: If given, the completion is streamed and on_field(key, value) is called for every field
+                     of the JSON output as soon as it is complete. The returned result is the same as without streaming.
+    :param api_key: OpenAI API key of the user, for apps serving several users with their own keys (default: openai.api_key).
+    :param budget: Session and batch spend limits of the scan (see Tool.budget.BudgetScope); the daily limit always applies.
     :return: A tuple containing a response dictionary with the cost and optionally the company information,
-             and an info string if there are issues with the input or response (e.g., 'flagged', 'not_job', 'not_json').
+             and an info string if there are issues with the input or response (e.g., 'flagged', 'not_job', 'not_json',
+             or 'over_budget' if the completion would exceed a spend limit).
 
-    :raises ValueError: If the model_name or role_name is not valid (checked in llm_completion).
+    :raises ValueError: If the model_name or role_name is not valid (checked in prepare_messages).
     """
-    # Check appropriateness of input
-    moderation_output = openai.Moderation.create(user_message)["results"][0]
-    info = None
-    if moderation_output['flagged']:
-        info = 'flagged'
-        response_dict = {'cost': 0}
-        return response_dict, info
+    return run_sync(llm_deploy_run_async, model_name, role_name, user_message, use_cache=use_cache,
+                    on_field=on_field, api_key=api_key, budget=budget, callbacks=('on_field',))
+
+class ScanContext(NamedTuple):
+    """
+    State of one scan carried between the pipeline steps (lookup, moderation, completion, finalize_scan).
+    """
+    model_name: str
+    role_name: str
+    user_message: str
+    cache: Optional[ResultCache]
+    dedup: Optional[NearDuplicateIndex]
+    cache_key: Optional[str]
+    scope: str
+
+def lookup_scan(model_name: str, role_name: str, user_message: str,
+                cache: Optional[ResultCache],
+                dedup: Optional[NearDuplicateIndex]) -> Tuple[Optional[Tuple[Dict[str, Union[float, str]], Union[str, None]]], ScanContext]:
+    """
+    First pipeline step: serve the scan from the result cache or the near-duplicate index, or reject it locally
+    as not a job description, all without calling the API.
+
+    :param cache: The result cache to consult, or None to bypass caching.
+    :param dedup: The near-duplicate index to consult, or None to bypass it.
+    :return: A tuple containing the final (response_dict, info) result or None if the API must be called,
+             and the context of the scan for the next steps.
+    """
+    if extraction_mode == 'functions' and role_name in function_registry:
+        prompt_version = function_registry[role_name].version
     else:
-        # API call
-        response, token_usage = llm_completion(model_name, role_name, user_message)
+        prompt_version = prompt_versions.get(role_name, '')
+    cache_key = make_cache_key(user_message, model_name, role_name, prompt_version) if cache is not None else None
+    scope = '|'.join([model_name, role_name, prompt_version])
+    context = ScanContext(model_name, role_name, user_message, cache, dedup, cache_key, scope)
+    # Serve repeated job descriptions from the cache
+    if cache is not None:
+        with span('cache_lookup', model_name, role_name):
+            cached = cache.get(cache_key)
+        if cached is not None:
+            metrics.inc('cache_hits_total', model=model_name, role=role_name, source='cache')
+            response_dict, info = cached
+            response_dict['cost'] = 0
+            return (response_dict, info), context
+    # Serve near-duplicates of previously scanned job descriptions
+    if dedup is not None:
+        with span('dedup_lookup', model_name, role_name):
+            match = dedup.lookup(user_message, scope)
+        if match is not None:
+            metrics.inc('cache_hits_total', model=model_name, role=role_name, source='near_duplicate')
+            document_id, _, response_dict, info = match
+            response_dict['duplicate_of'] = document_id
+            if cache is not None:
+                cache.set(cache_key, response_dict, info)
+            response_dict['cost'] = 0
+            return (response_dict, info), context
+
+    # Reject obvious non-job inputs locally, before paying for moderation and completion
+    with span('classifier', model_name, role_name):
+        is_job = is_job_description(user_message, classifier_threshold)
+    if not is_job:
+        return ({'cost': 0}, 'not_job'), context
+    return None, context
+
+async def is_flagged_async(user_message: str) -> bool:
+    """
+    Checks the appropriateness of the input with the moderation API.
+
+    :param user_message: The user's message.
+    :return: True if the moderation flagged the input.
+    """
+    async with pooled_session():
+        moderation = await get_scheduler('text-moderation-latest').acall(openai.Moderation.acreate, user_message,
+                                                                         **request_options())
+    moderation_output = moderation["results"][0]
+    return moderation_output['flagged']
+
+def is_flagged(user_message: str) -> bool:
+    """
+    Blocking version of is_flagged_async.
+    """
+    return run_sync(is_flagged_async, user_message)
+
+def flagged_scan(context: ScanContext) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Pipeline step for a flagged input: remember the verdict and return the 'flagged' result.
+    """
+    info = 'flagged'
+    if context.cache is not None:
+        context.cache.set(context.cache_key, {}, info)
+    if context.dedup is not None:
+        context.dedup.add(context.user_message, context.scope, {}, info)
+    response_dict = {'cost': 0}
+    return response_dict, info
+
+def finalize_scan(context: ScanContext, response: str, token_usage: Dict[str, int],
+                  store_data: bool, parsed: Optional[ParsedOutput] = None,
+                  cost: Optional[float] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Last pipeline step: classify and parse the completion, store it, fill the cache and compute the cost.
 
+    :param context: The context returned by lookup_scan.
+    :param response: The content response from the model.
+    :param token_usage: Dictionary of token usage details.
+    :param store_data: Whether to store the input text and the parsed output.
+    :param parsed: The response already parsed by parse_model_output (see validate_output_async), None to parse it here.
+    :param cost: The cost already computed and recorded by the caller (see _cascade_scan), None to compute it here.
+    :return: The (response_dict, info) result of the scan.
+    """
+    model_name, role_name, user_message = context.model_name, context.role_name, context.user_message
+    fields = get_prompt(role_name).fields
+    info = None
+    if parsed is None:
+        with span('validation', model_name, role_name):
+            parsed = parse_model_output(response, fields)
     # Check if the input is relevant to job descriptions
-    if token_usage['completion_tokens'] == 8:
+    if parsed.record is None and is_not_job_response(response, token_usage):
         info = 'not_job'
         response_dict = {}
     # Check output from LLM
-    elif not is_valid_json(response):
+    elif parsed.record is None:
         info = 'not_json'
         response_dict = {}
-    if info is None:
-        # Parse output and don't store
-        response_dict = json.loads(response)
+    else:
+        if parsed.invalid_fields:
+            metrics.inc('invalid_fields_total', len(parsed.invalid_fields), model=model_name, role=role_name)
+        response_dict = complete_record(parsed.record, fields)
+    if info is None and store_data:
+        # Store data; the extraction links to its raw text by record ID, role and scan time are kept for the
+        # Parquet export (Tool.export)
+        with span('text_store', model_name, role_name):
+            text_id = text_store.put(user_message, company=response_dict['Company'], model=model_name)
+        with span('append_json_to_file', model_name, role_name):
+            append_json_to_file(model_name, dict(response_dict, text_id=text_id, role=role_name, scanned_at=time.time()))
+        with span('index', model_name, role_name):
+            result_index.add(model_name, role_name, response_dict, text_id=text_id)
+    # Malformed output is not cached so that a re-submit gets another chance
+    if info != 'not_json':
+        if context.cache is not None:
+            context.cache.set(context.cache_key, response_dict, info)
+        if context.dedup is not None:
+            context.dedup.add(user_message, context.scope, response_dict, info)
 
     # Calculate cost
-    cost = api_cost(model_name, token_usage)
+    if cost is None:
+        with span('api_cost', model_name, role_name):
+            cost = api_cost(model_name, token_usage)
+        record_usage(model_name, role_name, token_usage, cost)
     response_dict['cost'] = cost
+    if token_usage.get('estimated'):
+        response_dict['cost_estimated'] = True
+    return response_dict, info
+
+async def validate_output_async(model_name: str, role_name: str, messages: List[Dict[str, str]], response: str,
+                                token_usage: Dict[str, int]) -> Tuple[ParsedOutput, Dict[str, int]]:
+    """
+    Parses and validates a completion (see Tool.schema.parse_model_output) and asks the model again, once,
+    for the fields that are missing or outside their options only, instead of repeating the whole extraction.
+
+    :param messages: The messages of the completion (the user message is reused for the follow-up request).
+    :param response: The content response from the model.
+    :param token_usage: Dictionary of token usage details of the completion.
+    :return: A tuple containing the parsed output and the token usage including the follow-up request.
+    """
+    fields = get_prompt(role_name).fields
+    with span('validation', model_name, role_name):
+        parsed = parse_model_output(response, fields)
+    if parsed.repaired:
+        metrics.inc('output_repairs_total', model=model_name, role=role_name)
+    if parsed.record is None or not parsed.invalid_fields:
+        return parsed, token_usage
+
+    metrics.inc('field_reasks_total', model=model_name, role=role_name)
+    reask_fields = [field for field in fields if field.key in parsed.invalid_fields]
+    reask_messages = [
+        {'role':'system',
+        'content': field_prompt(role_name, parsed.invalid_fields)},
+        messages[-1],
+    ]
+    try:
+        with span('field_reask', model_name, role_name):
+            reply, reply_usage = await get_completion_from_messages_async(reask_messages, api_model_name(model_name),
+                                                                          max_tokens=200)
+    except BudgetExceeded:
+        # Keep the first answer rather than spending over the limit
+        return parsed, token_usage
+    retry = parse_model_output(reply, reask_fields)
+    record = dict(parsed.record)
+    fixed = [key for key in (retry.record or {}) if key not in retry.invalid_fields]
+    record.update({key: retry.record[key] for key in fixed})
+    record = {field.key: record[field.key] for field in fields if field.key in record}
+    invalid = [key for key in parsed.invalid_fields if key not in fixed]
+    usage = {key: token_usage[key] + reply_usage[key] for key in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+    usage['tokens_saved'] = token_usage.get('tokens_saved', 0)
+    if token_usage.get('estimated'):
+        usage['estimated'] = True
+    return ParsedOutput(record, invalid, True), usage
+
+async def _run_pipeline(model_name: str, role_name: str, user_message: str,
+                        store_data: bool, cache: Optional[ResultCache],
+                        dedup: Optional[NearDuplicateIndex],
+                        on_field: Optional[Callable[[str, Any], None]] = None,
+                        api_key: Optional[str] = None,
+                        budget: Optional[BudgetScope] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Shared implementation of llm_run_async and llm_deploy_run_async.
+
+    :param store_data: Whether to store the input text and the parsed output.
+    :param cache: The result cache to consult and fill, or None to bypass caching.
+    :param dedup: The near-duplicate index to consult and fill, or None to bypass it.
+    :param on_field: Callback receiving the output fields while the completion is streamed, or None not to stream.
+    :param api_key: API key of the requests of this scan, None for openai.api_key.
+    :param budget: Session and batch limits of this scan, None for the current scope (see charged_to).
+    """
+    # Every task and thread of the scan inherits the key and the budget from the context
+    token = request_api_key.set(api_key)
+    try:
+        with span('scan', model_name, role_name), charged_to(budget, store_data):
+            response_dict, info = await _scan(model_name, role_name, user_message, store_data, cache, dedup, on_field)
+    except BudgetExceeded as e:
+        # Nothing was spent: the first completion request was refused
+        metrics.inc('budget_rejections_total', model=model_name, role=role_name, scope=e.kind)
+        response_dict, info = {'cost': 0}, 'over_budget'
+    finally:
+        request_api_key.reset(token)
+    metrics.inc('scans_total', model=model_name, role=role_name, outcome=info or 'ok')
+    return response_dict, info
+
+async def _scan(model_name: str, role_name: str, user_message: str,
+                store_data: bool, cache: Optional[ResultCache],
+                dedup: Optional[NearDuplicateIndex],
+                on_field: Optional[Callable[[str, Any], None]]) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    result, context = await asyncio.to_thread(lookup_scan, model_name, role_name, user_message, cache, dedup)
+    if result is not None:
+        return result
+
+    # Check appropriateness of input while the prompt is prepared
+    mode = extraction_mode
+    cascade = model_name == CASCADE_MODEL
+    async def moderate() -> bool:
+        with span('moderation', model_name, role_name):
+            return await is_flagged_async(user_message)
+    moderation = asyncio.ensure_future(moderate())
+    try:
+        messages, tokens_saved = await asyncio.to_thread(prepare_messages, cascade_models[0] if cascade else model_name,
+                                                         role_name, user_message, DEFAULT_TOKEN_BUDGET, mode)
+    except BaseException:
+        moderation.cancel()
+        raise
+    if speculative_moderation and not cascade:
+        return await _speculative_scan(context, moderation, messages, tokens_saved, store_data, on_field, mode)
+    if await moderation:
+        return await asyncio.to_thread(flagged_scan, context)
+    if cascade:
+        return await _cascade_scan(context, messages, tokens_saved, store_data, on_field, mode)
+
+    # API call
+    on_delta = _field_deltas(on_field)
+    response, token_usage = await _complete_async(model_name, role_name, messages, tokens_saved, on_delta, mode)
+    parsed, token_usage = await validate_output_async(model_name, role_name, messages, response, token_usage)
+    return await asyncio.to_thread(finalize_scan, context, response, token_usage, store_data, parsed)
+
+def _field_deltas(on_field: Optional[Callable[[str, Any], None]]) -> Optional[Callable[[str], None]]:
+    # Turn a field callback into a delta callback parsing the streamed JSON
+    if on_field is None:
+        return None
+    parser = IncrementalJSONParser()
+    def on_delta(piece: str) -> None:
+        for key, value in parser.feed(piece):
+            on_field(key, value)
+    return on_delta
+
+async def _cascade_scan(context: ScanContext, messages: List[Dict[str, str]], tokens_saved: int, store_data: bool,
+                        on_field: Optional[Callable[[str, Any], None]],
+                        mode: Optional[str] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Runs the extraction with the models of cascade_models in order, escalating to the next one only while
+    the confidence of the extraction (see Tool.confidence.score_extraction) is below cascade_threshold.
+    Every tier that ran is paid for: the result carries the blended cost, the answering model under 'tier'
+    and its 'confidence'. The extraction is stored under the answering model. When streaming, the fields of
+    an escalated tier are sent again with the values of the next one.
+    """
+    role_name, user_message = context.role_name, context.user_message
+    fields = get_prompt(role_name).fields
+    cost = 0.0
+    estimated = False
+    answer = None
+    for tier, tier_model in enumerate(cascade_models):
+        try:
+            response, token_usage = await _complete_async(tier_model, role_name, messages, tokens_saved,
+                                                          _field_deltas(on_field), mode)
+        except BudgetExceeded:
+            if answer is None:
+                raise
+            # No budget left to escalate: the previous tier answers
+            metrics.inc('cascade_budget_stops_total', model=tier_model, role=role_name)
+            break
+        parsed, token_usage = await validate_output_async(tier_model, role_name, messages, response, token_usage)
+        tier_cost = api_cost(tier_model, token_usage)
+        record_usage(tier_model, role_name, token_usage, tier_cost)
+        cost += tier_cost
+        estimated = estimated or bool(token_usage.get('estimated'))
+        with span('confidence', tier_model, role_name):
+            confidence = score_extraction(parsed, fields, user_message)
+        answer = (tier_model, response, token_usage, parsed, confidence)
+        if confidence.score >= cascade_threshold or tier == len(cascade_models) - 1:
+            break
+        metrics.inc('cascade_escalations_total', model=tier_model, role=role_name)
+    tier_model, response, token_usage, parsed, confidence = answer
+    metrics.inc('cascade_answers_total', model=tier_model, role=role_name)
+    response_dict, info = await asyncio.to_thread(finalize_scan, context._replace(model_name=tier_model), response,
+                                                  token_usage, store_data, parsed, cost)
+    if estimated:
+        response_dict['cost_estimated'] = True
+    response_dict['tier'] = tier_model
+    response_dict['confidence'] = round(confidence.score, 2)
     return response_dict, info
 
+async def _speculative_scan(context: ScanContext, moderation: 'asyncio.Future[bool]',
+                            messages: List[Dict[str, str]], tokens_saved: int, store_data: bool,
+                            on_field: Optional[Callable[[str, Any], None]],
+                            mode: Optional[str] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+    """
+    Runs the completion while the moderation is pending. Streamed fields are held back until the input is cleared;
+    if it is flagged, the completion is cancelled (or discarded if already done).
+    Reports the counters speculative_scans_total, speculative_flagged_total, speculative_saved_seconds_total
+    (round trip saved compared to waiting for the verdict) and speculative_wasted_dollars_total (spend on flagged inputs).
+    """
+    model_name, role_name = context.model_name, context.role_name
+    held_fields = []
+    cleared = False
+    on_delta = None
+    if on_field is not None:
+        parser = IncrementalJSONParser()
+        def on_delta(piece: str) -> None:
+            for key, value in parser.feed(piece):
+                if cleared:
+                    on_field(key, value)
+                else:
+                    held_fields.append((key, value))
+    start = time.perf_counter()
+    completion = asyncio.ensure_future(_complete_async(model_name, role_name, messages, tokens_saved, on_delta, mode))
+    try:
+        flagged = await moderation
+    except BaseException:
+        completion.cancel()
+        raise
+    moderation_wait = time.perf_counter() - start
+    metrics.inc('speculative_scans_total', model=model_name, role=role_name)
+    if flagged:
+        if completion.done() and not completion.cancelled() and completion.exception() is None:
+            wasted = api_cost(model_name, completion.result()[1])
+        elif completion.done() and not completion.cancelled() and isinstance(completion.exception(), BudgetExceeded):
+            # Refused before anything was sent
+            wasted = 0.0
+        else:
+            completion.cancel()
+            # The prompt has been sent already, count it as spent
+            prompt_tokens = sum(estimate_tokens(message['content']) + 4 for message in messages) + 3
+            wasted = api_cost(model_name, {'prompt_tokens': prompt_tokens, 'completion_tokens': 0})
+        metrics.inc('speculative_flagged_total', model=model_name, role=role_name)
+        metrics.inc('speculative_wasted_dollars_total', wasted, model=model_name, role=role_name)
+        return await asyncio.to_thread(flagged_scan, context)
+
+    cleared = True
+    for key, value in held_fields:
+        on_field(key, value)
+    response, token_usage = await completion
+    # Waiting for the verdict first would have delayed the completion by the moderation time still left
+    saved = max(0.0, min(moderation_wait, time.perf_counter() - start))
+    metrics.inc('speculative_saved_seconds_total', saved, model=model_name, role=role_name)
+    parsed, token_usage = await validate_output_async(model_name, role_name, messages, response, token_usage)
+    return await asyncio.to_thread(finalize_scan, context, response, token_usage, store_data, parsed)
+
+def is_not_job_response(response: str, token_usage: Dict[str, int]) -> bool:
+    """
+    Checks if the model answered that the input is not a job description (as instructed by the role prompts).
+
+    :param response: The content response from the model.
+    :param token_usage: Dictionary of token usage details.
+    :return: True if the model refused the input as not being a job description.
+    """
+    if 'not a job description' in response.lower() and not response.lstrip().startswith('{'):
+        return True
+    # Refusal without the expected wording (the exact sentence is 8 tokens)
+    return token_usage['completion_tokens'] == 8 and not is_valid_json(response)
+
 def api_cost(model_name: str, token_dict: Dict[str, int]) -> float:
     """
-    Calculates the cost for an API call based on the model name and token usage.
+    Calculates the cost for an API call based on the model name and token usage, from the price table.
 
     :param model_name: Name of the model used in the API call, must be one of ['GPT-3.5', 'GPT-4'].
     :param token_dict: Dictionary containing the token usage details, with keys 'prompt_tokens' and 'completion_tokens'.
@@ -156,16 +792,5 @@ def api_cost(model_name: str, token_dict: Dict[str, int]) -> float:
 
     :raises ValueError: If the model_name is not valid.
     """
-    # Check the model name is valid
-    valid_models = ['GPT-3.5', 'GPT-4']
-    if model_name not in valid_models:
-        raise ValueError(f"'{model_name}' is not a valid argument. Choose from {valid_models}.")
-
-    # Calculate cost based on the model name
-    if model_name == 'GPT-3.5':
-        cost = token_dict['prompt_tokens'] / 1000 * 0.0015 + token_dict['completion_tokens'] / 1000 * 0.002
-    elif model_name == 'GPT-4':
-        cost = token_dict['prompt_tokens'] / 1000 * 0.03 + token_dict['completion_tokens'] / 1000 * 0.06
-    else:
-        cost = 0
-    return cost
+    # Prices per API model (see Tool.budget.prices); api_model_name checks the model name
+    return token_cost(api_model_name(model_name), token_dict['prompt_tokens'], token_dict['completion_tokens'])
@@ -0,0 +1,261 @@
+"""
+This module contains the in-process metrics of the scan pipeline.
+
+Every stage of a scan (cache lookup, moderation, prompt building, completion, validation, storage, cost) is
+timed with a span and aggregated into a latency histogram per stage, model and role. Cumulative counters track
+scans per outcome, tokens and dollars per model and role. The metrics live in memory only (nothing about the
+input is recorded) and can be exported in the Prometheus text format, served over HTTP, or dumped periodically
+to a JSON file.
+
+Usage:
+    from Tool.metrics import metrics, span
+    with span('completion', model='GPT-3.5', role='General'):
+        ...
+    print(metrics.to_prometheus())
+"""
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_PREFIX = 'jobscan'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket bounds, like a Prometheus histogram.
+    """
+    def __init__(self, bounds: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile by linear interpolation within the bucket holding it.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+def _labels(labels: Dict[str, Optional[str]]) -> Labels:
+    return tuple(sorted((key, '' if value is None else str(value)) for key, value in labels.items()))
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+class MetricsRegistry:
+    """
+    Thread-safe store of the stage latency histograms and the cumulative counters.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self.started_at = time.time()
+
+    def observe(self, stage: str, seconds: float, **labels: Optional[str]) -> None:
+        """
+        Records the duration of one pipeline stage.
+
+        :param stage: Name of the stage, e.g., 'moderation' or 'completion'.
+        :param seconds: Duration of the stage.
+        :param labels: Extra labels, typically model and role.
+        """
+        key = ('stage_seconds', _labels(dict(labels, stage=stage)))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name: str, amount: float = 1, **labels: Optional[str]) -> None:
+        """
+        Increments a cumulative counter, e.g., inc('tokens_total', 120, model='GPT-3.5', role='General', type='prompt').
+        """
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    def stage_summary(self) -> List[Dict[str, object]]:
+        """
+        Function to summarize the stage latencies.
+
+        :return: One dictionary per stage and label set with the count, mean, p50, p95, p99 and max in milliseconds.
+        """
+        with self._lock:
+            rows = []
+            for (_, labels), histogram in sorted(self._histograms.items()):
+                row = dict(labels)
+                row.update({
+                    'count': histogram.count,
+                    'mean_ms': histogram.sum / histogram.count * 1000 if histogram.count else 0.0,
+                    'p50_ms': histogram.quantile(0.50) * 1000,
+                    'p95_ms': histogram.quantile(0.95) * 1000,
+                    'p99_ms': histogram.quantile(0.99) * 1000,
+                    'max_ms': histogram.max * 1000,
+                })
+                rows.append(row)
+            return rows
+
+    def counter_summary(self) -> List[Dict[str, object]]:
+        """
+        :return: One dictionary per counter and label set with the counter name and value.
+        """
+        with self._lock:
+            return [dict(labels, name=name, value=value) for (name, labels), value in sorted(self._counters.items())]
+
+    def snapshot(self) -> Dict[str, object]:
+        return {'started_at': self.started_at, 'timestamp': time.time(),
+                'stages': self.stage_summary(), 'counters': self.counter_summary()}
+
+    def to_prometheus(self) -> str:
+        """
+        Function to export the metrics in the Prometheus text exposition format.
+
+        :return: The metrics text.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        if histograms:
+            lines.append(f'# HELP {_PREFIX}_stage_seconds Duration of the scan pipeline stages.')
+            lines.append(f'# TYPE {_PREFIX}_stage_seconds histogram')
+        for (name, labels), histogram in histograms:
+            cumulative = 0
+            for bound, bucket_count in zip(list(histogram.bounds) + ['+Inf'], histogram.counts):
+                cumulative += bucket_count
+                lines.append(f'{_PREFIX}_{name}_bucket{_format_labels(labels, ("le", str(bound)))} {cumulative}')
+            lines.append(f'{_PREFIX}_{name}_sum{_format_labels(labels)} {histogram.sum}')
+            lines.append(f'{_PREFIX}_{name}_count{_format_labels(labels)} {histogram.count}')
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f'# TYPE {_PREFIX}_{name} counter')
+                typed.add(name)
+            lines.append(f'{_PREFIX}_{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+# Registry shared by the whole process
+metrics = MetricsRegistry()
+
+@contextmanager
+def span(stage: str, model: Optional[str] = None, role: Optional[str] = None) -> Iterator[None]:
+    """
+    Context manager timing one pipeline stage into the shared registry (also when the stage raises).
+
+    :param stage: Name of the stage.
+    :param model: Model name of the scan, if known.
+    :param role: Role name of the scan, if known.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(stage, time.perf_counter() - start, model=model, role=role)
+
+def record_usage(model: str, role: str, token_usage: Dict[str, int], cost: float) -> None:
+    """
+    Adds the tokens and the cost of one completion to the cumulative counters.
+    """
+    for key, token_type in (('prompt_tokens', 'prompt'), ('completion_tokens', 'completion'), ('tokens_saved', 'saved')):
+        if token_usage.get(key):
+            metrics.inc('tokens_total', token_usage[key], model=model, role=role, type=token_type)
+    metrics.inc('cost_dollars_total', cost, model=model, role=role)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] == '/metrics':
+            payload, content_type = metrics.to_prometheus().encode('utf-8'), 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] == '/metrics.json':
+            payload, content_type = json.dumps(metrics.snapshot()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port: int = 9108, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Function to serve /metrics (Prometheus text) and /metrics.json in a background thread.
+    Calling it again returns the running server, so it is safe in a Streamlit script.
+
+    :param port: Port to listen on.
+    :param host: Interface to listen on.
+    :return: The running server.
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
+
+def dump_metrics(file_path: str) -> None:
+    """
+    Function to write a JSON snapshot of the metrics atomically.
+    """
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(metrics.snapshot(), f, indent=4)
+    os.replace(tmp_path, file_path)
+
+def start_periodic_dump(file_path: str = 'data/metrics.json', interval: float = 60.0) -> threading.Event:
+    """
+    Function to dump the metrics to a JSON file every `interval` seconds in a background thread.
+
+    :return: An event; set it to stop the dumps.
+    """
+    stop = threading.Event()
+    def run() -> None:
+        while not stop.wait(interval):
+            dump_metrics(file_path)
+    threading.Thread(target=run, daemon=True).start()
+    return stop
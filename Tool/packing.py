@@ -0,0 +1,150 @@
+"""
+This module contains the packed completion mode for batch workloads.
+
+Every completion pays for the full role prompt (several hundred tokens) to extract a single job description.
+In packed mode several short descriptions are sent in one request, each delimited and numbered, and the model
+is asked for a JSON array with one result per description; the role prompt is then paid once per pack instead
+of once per description. The packer fills each request up to a token budget. If the answer isn't a JSON array
+of the expected length, or some of its elements aren't valid results, the affected descriptions are re-sent
+in smaller packs, down to the regular single-description completion.
+"""
+import json
+from typing import Dict, Iterable, Iterator, List, Tuple
+from Tool.utils import estimate_tokens
+from Tool.prompt import PromptField, get_prompt
+from Tool.schema import extract_json_array, parse_model_output
+from Tool.preprocess import DEFAULT_TOKEN_BUDGET, preprocess_job_description
+from Tool.metrics import span
+from Tool.llm_comp import api_model_name, get_completion_from_messages, llm_completion, role_system_message
+
+# Prompt tokens of all the descriptions of one pack, and maximum number of descriptions per pack
+DEFAULT_PACK_TOKENS = 3000
+DEFAULT_PACK_SIZE = 8
+# Completion tokens reserved per description (the single completion uses max_tokens=500)
+_COMPLETION_TOKENS_PER_ITEM = 400
+_NOT_JOB = 'The input is not a job description'
+
+def pack_instructions(count: int) -> str:
+    """
+    Instructions appended to the role prompt in packed mode.
+
+    :param count: Number of job descriptions in the pack.
+    :return: The extra system prompt text.
+    """
+    return f"""
+You will be provided with {count} job description queries at once. \
+Each query starts with its number in square brackets, e.g. [1], and is delimited with #### characters. \
+Apply the instructions above to every query independently. \
+Return a JSON array with exactly {count} elements, in the same order as the queries. \
+Element i is the JSON object for query i, or the string "{_NOT_JOB}" if query i is not a job description. \
+Don't provide extra explanations.
+"""
+
+def pack_descriptions(user_messages: Iterable[Tuple[str, str]],
+                      pack_tokens: int = DEFAULT_PACK_TOKENS,
+                      pack_size: int = DEFAULT_PACK_SIZE,
+                      token_budget: int = DEFAULT_TOKEN_BUDGET) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Function to group job descriptions into packs, filling each pack up to the token and size limits.
+    A description larger than pack_tokens forms a pack on its own.
+
+    :param user_messages: Iterable of (item_id, description) tuples.
+    :param pack_tokens: Maximum prompt tokens of the descriptions of one pack (after preprocessing).
+    :param pack_size: Maximum number of descriptions of one pack.
+    :param token_budget: Token budget of a single description (see preprocess_job_description).
+    :return: A generator of packs, lists of (item_id, description) tuples in input order.
+    """
+    pack, used = [], 0
+    for item_id, user_message in user_messages:
+        tokens = preprocess_job_description(user_message, token_budget)[1]['processed_tokens'] + 8
+        if pack and (used + tokens > pack_tokens or len(pack) >= pack_size):
+            yield pack
+            pack, used = [], 0
+        pack.append((item_id, user_message))
+        used += tokens
+    if pack:
+        yield pack
+
+def _split_usage(token_usage: Dict[str, int], weights: List[int], outputs: List[str]) -> List[Dict[str, int]]:
+    # Share the prompt tokens in proportion to the description sizes and the completion tokens to the output sizes
+    total_weight = sum(weights) or 1
+    output_weights = [estimate_tokens(output) for output in outputs]
+    total_output = sum(output_weights) or 1
+    shares = []
+    for weight, output_weight in zip(weights, output_weights):
+        prompt_tokens = round(token_usage['prompt_tokens'] * weight / total_weight)
+        completion_tokens = round(token_usage['completion_tokens'] * output_weight / total_output)
+        shares.append({
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'tokens_saved': 0,
+        })
+    return shares
+
+def _parse_pack(response: str, count: int, fields: Tuple[PromptField, ...]) -> List[Tuple[bool, str]]:
+    # One (valid, output) pair per description; valid outputs are an extraction of the role fields (see
+    # parse_model_output) or the not-a-job sentence
+    elements = extract_json_array(response)
+    if elements is None or len(elements) != count:
+        return [(False, '')] * count
+    parsed = []
+    for element in elements:
+        if isinstance(element, dict):
+            output = json.dumps(element)
+            parsed.append((parse_model_output(output, fields).record is not None, output))
+        elif isinstance(element, str) and 'not a job description' in element.lower():
+            parsed.append((True, _NOT_JOB))
+        else:
+            parsed.append((False, ''))
+    return parsed
+
+def llm_packed_completion(model_name: str, role_name: str, user_messages: List[str],
+                          token_budget: int = DEFAULT_TOKEN_BUDGET) -> List[Tuple[str, Dict[str, int]]]:
+    """
+    Generates the completions of several job descriptions with as few requests as possible.
+
+    :param model_name: Name of the model to use, must be one of ['GPT-3.5', 'GPT-4'].
+    :param role_name: Role for the conversation, must be one of ['Data relevant', 'Software Engineer', 'General'].
+    :param user_messages: The job descriptions of one pack (see pack_descriptions).
+    :param token_budget: Token budget of a single description (see preprocess_job_description).
+    :return: One (response, token_usage) tuple per description, in order, as returned by llm_completion.
+             Token usage is the share of the pack request attributed to the description (plus any retry).
+
+    :raises ValueError: If the model_name or role_name is not valid.
+    """
+    if len(user_messages) == 1:
+        return [llm_completion(model_name, role_name, user_messages[0], token_budget=token_budget)]
+    model = api_model_name(model_name)
+    system_message = role_system_message(role_name) + pack_instructions(len(user_messages))
+    processed, weights, tokens_saved = [], [], []
+    for user_message in user_messages:
+        text, stats = preprocess_job_description(user_message, token_budget)
+        processed.append(text)
+        weights.append(stats['processed_tokens'])
+        tokens_saved.append(stats['tokens_saved'])
+    queries = '\n'.join(f"[{number}]####{text}####" for number, text in enumerate(processed, start=1))
+    messages = [
+        {'role': 'system', 'content': system_message},
+        {'role': 'user', 'content': queries},
+    ]
+    max_tokens = min(4000, _COMPLETION_TOKENS_PER_ITEM * len(user_messages))
+    with span('packed_completion', model_name, role_name):
+        response, token_usage = get_completion_from_messages(messages, model, max_tokens=max_tokens)
+
+    parsed = _parse_pack(response, len(user_messages), get_prompt(role_name).fields)
+    usages = _split_usage(token_usage, weights, [output for _, output in parsed])
+    results = [(output, dict(usage, tokens_saved=saved)) for (_, output), usage, saved in zip(parsed, usages, tokens_saved)]
+    failed = [index for index, (valid, _) in enumerate(parsed) if not valid]
+    if not failed:
+        return results
+    # Re-split: re-send the failed descriptions in halves (the whole pack is halved if nothing could be parsed)
+    halves = [failed[:len(failed) // 2], failed[len(failed) // 2:]] if len(failed) > 1 else [failed]
+    for half in halves:
+        retried = llm_packed_completion(model_name, role_name, [user_messages[index] for index in half], token_budget)
+        for index, (output, usage) in zip(half, retried):
+            spent = results[index][1]
+            merged = {key: usage[key] + spent[key] for key in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+            merged['tokens_saved'] = usage.get('tokens_saved', 0)
+            results[index] = (output, merged)
+    return results
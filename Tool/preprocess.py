@@ -0,0 +1,121 @@
+"""
+This module contains the preprocessing applied to a job description before it is sent to the model.
+
+Long postings carry a lot of text with no extraction value (equal-opportunity statements, benefits and perks
+lists, legal and privacy notices, application instructions) that still inflates prompt_tokens and the cost.
+The preprocessing
+- drops boilerplate sections (introduced by a heading that is only a known section name, e.g. "Benefits:", and
+  never before the first other heading, where the title and summary of the posting are) and boilerplate sentences,
+- never drops a sentence mentioning something the prompts extract (visa, citizenship, education, years of
+  experience, pay rate, duration, employment type),
+- collapses whitespace,
+- and enforces a token budget, keeping the protected sentences plus as much of the head of the posting as still fits.
+If stripping the boilerplate would leave less than MIN_KEPT_SHARE of the posting, the posting is not stripped:
+such a posting was misread, and sending it (nearly) empty would still be paid for.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+from Tool.utils import estimate_tokens
+
+DEFAULT_TOKEN_BUDGET = 1500
+# Smallest share of the tokens of a posting the boilerplate stripping may keep
+MIN_KEPT_SHARE = 0.25
+
+# Headings opening a section without extraction value, dropped up to the next heading. Only the bare section name
+# matches, so titles such as "Privacy Engineer" or "Benefits Analyst" are not headings of boilerplate
+_BOILERPLATE_HEADING = re.compile(
+    r"^(?:our |what we |why you'?ll love |why )?(?:benefits|perks|what we offer|we offer|compensation (?:and|&) benefits"
+    r"|equal (?:employment )?opportunity(?: employer)?|eeo(?: statement)?|diversity(?:,? equity)?(?: (?:and|&) inclusion)?"
+    r"|accommodations?|reasonable accommodations?|privacy(?: notice| policy)?|legal(?: notice)?|disclaimer"
+    r"|how to apply|application process|working here|life at \w+|work perks)\s*:?$",
+    re.IGNORECASE)
+# Sentences that are boilerplate wherever they appear
+_BOILERPLATE_SENTENCE = re.compile(
+    r"equal (?:employment )?opportunity|without regard to|race, (?:color|religion)|sexual orientation|gender identity"
+    r"|protected veteran|reasonable accommodation|e-verify|privacy (?:notice|policy)|applicant privacy"
+    r"|pay transparency|fair chance|arrest (?:and|or) conviction|click (?:the )?apply|recruitment agencies"
+    r"|unsolicited resumes|drug[- ]free workplace|background check",
+    re.IGNORECASE)
+# Information the prompts extract: sentences mentioning it are always kept
+_PROTECTED = re.compile(
+    r"visa|sponsor|citizen|permanent resident|green card|clearance|authori[sz]ed to work|work authori[sz]ation"
+    r"|degree|bachelor|master|ph\.?d|years?\b|\byoe\b|salary|pay rate|per hour|/hr\b|duration|contract|intern"
+    r"|full[- ]time|part[- ]time",
+    re.IGNORECASE)
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+
+_BULLET = re.compile(r"^(?:[-*\u2022\u25aa\u25cf]|\d+[.)])\s")
+
+def _is_heading(line: str) -> bool:
+    # Short non-bullet line, ending with a colon or without final punctuation, e.g. "Benefits:" or "What You'll Do"
+    words = line.split()
+    return 0 < len(words) <= 8 and not _BULLET.match(line) and (line.endswith(':') or line[-1] not in '.!?,;')
+
+def _strip_boilerplate(lines: List[str]) -> List[str]:
+    kept = []
+    in_boilerplate = False
+    # Sections are only dropped after the first other heading: the text before it is the title and summary
+    seen_heading = False
+    for line in lines:
+        if _is_heading(line):
+            in_boilerplate = seen_heading and bool(_BOILERPLATE_HEADING.match(line))
+            seen_heading = seen_heading or not _BOILERPLATE_HEADING.match(line)
+            if in_boilerplate:
+                continue
+        # Inside a boilerplate section only protected sentences survive; elsewhere only boilerplate sentences are dropped
+        sentences = [sentence for sentence in _SENTENCE_SPLIT.split(line)
+                     if _PROTECTED.search(sentence)
+                     or not (in_boilerplate or _BOILERPLATE_SENTENCE.search(sentence))]
+        if sentences:
+            kept.append(' '.join(sentences))
+    return kept
+
+def _truncate(lines: List[str], token_budget: int) -> List[str]:
+    # Work on sentences so that a posting pasted as one long line can still be cut
+    units = [(index, sentence) for index, line in enumerate(lines) for sentence in _SENTENCE_SPLIT.split(line)]
+    costs = [estimate_tokens(sentence) + 1 for _, sentence in units]
+    kept = [False] * len(units)
+    used = 0
+    # Reserve the protected sentences first, then fill the rest of the budget with the head of the posting
+    for i, (_, sentence) in enumerate(units):
+        if _PROTECTED.search(sentence) and used + costs[i] <= token_budget:
+            kept[i] = True
+            used += costs[i]
+    for i in range(len(units)):
+        if kept[i]:
+            continue
+        if used + costs[i] > token_budget:
+            break
+        kept[i] = True
+        used += costs[i]
+    truncated = {}
+    for i, (index, sentence) in enumerate(units):
+        if kept[i]:
+            truncated.setdefault(index, []).append(sentence)
+    return [' '.join(sentences) for _, sentences in sorted(truncated.items())]
+
+def preprocess_job_description(text: str, token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET) -> Tuple[str, Dict[str, int]]:
+    """
+    Function to shrink a job description before sending it to the model.
+
+    :param text: The job description.
+    :param token_budget: Maximum number of tokens of the returned text, None for no limit.
+    :return: A tuple containing the processed text and a dictionary with 'original_tokens', 'processed_tokens'
+             and 'tokens_saved'.
+    """
+    original_tokens = estimate_tokens(text)
+    lines = [' '.join(line.split()) for line in text.splitlines()]
+    lines = [line for line in lines if line]
+    stripped = _strip_boilerplate(lines)
+    if estimate_tokens('\n'.join(stripped)) >= MIN_KEPT_SHARE * estimate_tokens('\n'.join(lines)):
+        lines = stripped
+    processed = '\n'.join(lines)
+    if token_budget is not None and estimate_tokens(processed) > token_budget:
+        processed = '\n'.join(_truncate(lines, token_budget))
+    processed_tokens = estimate_tokens(processed)
+    stats = {
+        'original_tokens': original_tokens,
+        'processed_tokens': processed_tokens,
+        'tokens_saved': max(0, original_tokens - processed_tokens),
+    }
+    return processed, stats
@@ -6,132 +6,255 @@ citizenship requirement, visa sponsor policy, job type, years of experience, rel
 knowledge required, and minimum education. The information extracted is to be returned in a specific 
 JSON format.
 
-The prompts are divided into three categories:
+The prompts are compiled once at import from shared field definitions plus role-specific fields:
 - Data Science Relevant (ds_prompt): Specific to data science positions, includes extraction of top three data science relevant skills.
 - Software Engineer (se_prompt): Specific to software engineering positions, includes extraction of required programming languages.
 - General Positions (general_prompt): Applicable to general positions without specific technical skill extraction.
 
+For the function-calling mode, compile_functions declares the same fields as the parameters of a function
+(options become enums, lists become arrays of strings), with a short system prompt and a max_tokens budget
+derived from the schema.
+
+Every compiled prompt carries a content hash version (part of the result cache key) and its token count;
+shared_prefix_tokens is the length of the prefix common to all roles, which provider-side prefix caching can reuse.
+
 The instructions in the prompts specify the exact format and options to be returned and emphasize not making assumptions or adding extra information.
 """
+import json
+import hashlib
+from typing import Any, Dict, List, NamedTuple, Tuple
+from Tool.utils import estimate_tokens
+
+class PromptField(NamedTuple):
+    """
+    One extracted field: its JSON key, its instruction line, the allowed [options] (empty for free text),
+    and whether the value is a list of strings.
+    """
+    key: str
+    instruction: str
+    options: Tuple[str, ...] = ()
+    is_list: bool = False
+
+class CompiledPrompt(NamedTuple):
+    """
+    The system prompt of a role with its fields, content hash version and token count.
+    """
+    role: str
+    text: str
+    fields: Tuple[PromptField, ...]
+    version: str
+    tokens: int
+
+    @property
+    def keys(self) -> List[str]:
+        return [field.key for field in self.fields]
+
+_HEADER = [
+    "You will be provided with job description queries. The job description query will be delimited with #### characters.",
+    "First classify if the input is an actual job description. If it is not a job description, return \"The input is not a job description\" immediately and do not conduct the following tasks. ",
+    "Your task is to extract or classify certain key information from the description. If the information isn't explicitly mentioned in the job description, don't make any assumptions - simply respond with 'Not mentioned'. If there are [options] provided for a certain task, only return those [options] with the exact word. Don't add extra information for [options]. ",
+]
+_FOOTER = [
+    "Return JSON format with keys = [{keys}] Values in the returned JSON must only be either string or a list of strings if multiple elements are required. ",
+    "Don't provide extra explanations. Don't give default output. ",
+]
+
+# Fields shared by all roles, before and after the role-specific ones
+common_fields_head = (
+    PromptField('Company', "Company's name: Extract Company's name with exact words or [not mentioned] if it could not be extracted."),
+    PromptField('Industry', "Industry: Identify the industry that the company is in or [not mentioned] if it is not specified in the description. "),
+    PromptField('Citizenship', "Citizenship Requirement: Identify whether the job requires the applicant to be a [Permanent Resident only] or if this requirement is [not mentioned]. ",
+                options=('Permanent Resident only', 'not mentioned')),
+    PromptField('Visa_policy', "Visa Sponsor Policy: Identify whether the company [Will provide], [Will not provide] visa sponsorship or if this policy is [not mentioned]. ",
+                options=('Will provide', 'Will not provide', 'not mentioned')),
+    PromptField('JobType', "Job type:  Classify one of [Full time, Intern, Contractor]. If the description contains words like (Duration, Pay Rate, Per hour), classify it as [Contractor]. ",
+                options=('Full time', 'Intern', 'Contractor')),
+    PromptField('YoE_year', "Years of Experience: Extract required YoE in years from the description. "),
+    PromptField('YoE_level', "Years of Experience level: Classify whether the job requires a [New grad] with under one year of experience, a [Mid-level] professional with 1 to 3 years of experience,  a [Senior] professional with more than 3 years of experience, or if this requirement is [not mentioned]. Use the information extracted from the `Years of Experience` to make this decision. ",
+                options=('New grad', 'Mid-level', 'Senior', 'not mentioned')),
+)
+common_fields_tail = (
+    PromptField('Domain_Knowledge', "Domain Knowledge Required: Identify any specific domain/Industry knowledge required for the job. "),
+    PromptField('Min_Education', "Minimum Education: Choose only one as the minimum requirement among [Phd only], [Master], [Bachelor], or [not mentioned]. If multiple degrees are mentioned, select the lowest qualification as the minimum requirement. ",
+                options=('Phd only', 'Master', 'Bachelor', 'not mentioned')),
+)
+# Role-specific fields, inserted between the shared ones
+role_fields = {
+    'Data relevant': (
+        PromptField('DS_skills', "Top Three Data science relevant Skills: Identify the top three technological skills required for the job. ", is_list=True),
+    ),
+    'Software Engineer': (
+        PromptField('Languages', "Required Programming Languages: List all the programming languages that are essential for the software engineering position at the company. ", is_list=True),
+        PromptField('SE_skills', "Top Three Software Engineering Relevant Skills: Identify the top three technological skills required for the software engineering job. ", is_list=True),
+    ),
+    'General': (),
+}
+
+def _compose(fields: Tuple[PromptField, ...]) -> str:
+    lines = _HEADER + [field.instruction for field in fields]
+    lines += [_FOOTER[0].format(keys=', '.join(field.key for field in fields))] + _FOOTER[1:]
+    return '\n' + '\n'.join(lines) + '\n'
+
+def compile_prompt(role: str) -> CompiledPrompt:
+    """
+    Function to compose the system prompt of a role from the shared and role-specific fields.
+
+    :param role: Role name, one of the keys of role_fields.
+    :return: The compiled prompt.
+    """
+    fields = common_fields_head + role_fields[role] + common_fields_tail
+    text = _compose(fields)
+    version = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+    return CompiledPrompt(role, text, fields, version, estimate_tokens(text))
+
+# Compiled once at import
+prompt_registry: Dict[str, CompiledPrompt] = {role: compile_prompt(role) for role in role_fields}
+
+def infer_role(record: Dict[str, Any]) -> str:
+    """
+    Function to tell which role produced an extraction stored without its role (older records): the role whose
+    specific list fields are all present, 'General' if none.
+
+    :param record: The extraction record.
+    :return: The role name.
+    """
+    for role, fields in role_fields.items():
+        if fields and all(field.key in record for field in fields):
+            return role
+    return 'General'
+
+def get_prompt(role_name: str) -> CompiledPrompt:
+    """
+    Function to get the compiled prompt of a role.
+
+    :param role_name: Role for the conversation, must be one of ['Data relevant', 'Software Engineer', 'General'].
+    :return: The compiled prompt.
+
+    :raises ValueError: If the role_name is not valid.
+    """
+    if role_name not in prompt_registry:
+        raise ValueError(f"'{role_name}' is not a valid argument. Choose from {list(prompt_registry)}.")
+    return prompt_registry[role_name]
+
+def field_prompt(role_name: str, keys: List[str]) -> str:
+    """
+    Function to compose a prompt asking only for some fields of a role, e.g. to re-ask for invalid fields.
+
+    :param role_name: Role for the conversation.
+    :param keys: Keys of the fields to ask for.
+    :return: The system prompt.
+
+    :raises ValueError: If the role_name is not valid.
+    """
+    return _compose(tuple(field for field in get_prompt(role_name).fields if field.key in keys))
+
+def _shared_prefix(texts: List[str]) -> str:
+    prefix = texts[0]
+    for text in texts[1:]:
+        length = 0
+        while length < min(len(prefix), len(text)) and prefix[length] == text[length]:
+            length += 1
+        prefix = prefix[:length]
+    return prefix
+
+# Tokens of the prefix common to every role prompt (reusable by provider-side prefix caching)
+shared_prefix_tokens = estimate_tokens(_shared_prefix([prompt.text for prompt in prompt_registry.values()]))
 
 # Prompt for Data science relevant
-ds_prompt = f"""
-You will be provided with job description queries. \
-The job description query will be delimited with #### characters.\
-
-First classify if the input is an actual job description. \
-If it is not a job description, return "The input is not a job description" immediately and do not conduct the following tasks. \
-
-Your task is to extract or classify certain key information from the description. \
-If the information isn't explicitly mentioned in the job description, don't make any assumptions - simply respond with 'Not mentioned'. \
-If there are [options] provided for a certain task, only return those [options] with the exact word. Don't add extra information for [options]. \
-
-Company's name: Extract Company's name with exact words or [not mentioned] if it could not be extracted.\
-
-Industry: Identify the industry that the company is in or [not mentioned] if it is not specified in the description. \
-
-Citizenship Requirement: Identify whether the job requires the applicant to be a [Permanent Resident only] or if this requirement is [not mentioned]. \
-
-Visa Sponsor Policy: Identify whether the company [Will provide], [Will not provide] visa sponsorship or if this policy is [not mentioned]. \
-
-Job type:  Classify one of [Full time, Intern, Contractor]. If the description contains words like (Duration, Pay Rate, Per hour), classify it as [Contractor]. \
-
-Years of Experience: Extract required YoE in years from the description. \
-
-Years of Experience level: Classify whether the job requires a [New grad] with under one year of experience, \
-a [Mid-level] professional with 1 to 3 years of experience,  \
-a [Senior] professional with more than 3 years of experience, or if this requirement is [not mentioned]. \
-Use the information extracted from the `Years of Experience` to make this decision. \
-
-Top Three Data science relevant Skills: Identify the top three technological skills required for the job. \
-
-Domain Knowledge Required: Identify any specific domain/Industry knowledge required for the job. \
-
-Minimum Education: Choose only one as the minimum requirement among [Phd only], [Master], [Bachelor], or [not mentioned]. If multiple degrees are mentioned, select the lowest qualification as the minimum requirement. \
-
-Return JSON format with keys = [Company, Industry, Citizenship, Visa_policy, JobType, YoE_year, YoE_level, DS_skills, Domain_Knowledge, Min_Education] \
-Values in the returned JSON must only be either string or a list of strings if multiple elements are required. \
-
-Don't provide extra explanations. Don't give default output. 
-"""
+ds_prompt = prompt_registry['Data relevant'].text
 # Prompt for Software Engineer
-se_prompt = f"""
-You will be provided with job description queries. \
-The job description query will be delimited with #### characters.\
-
-First classify if the input is an actual job description. \
-If it is not a job description, return "The input is not a job description" immediately and do not conduct the following tasks. \
-
-Your task is to extract or classify certain key information from the description. \
-If the information isn't explicitly mentioned in the job description, don't make any assumptions - simply respond with 'Not mentioned'. \
-If there are [options] provided for a certain task, only return those [options] with the exact word. Don't add extra information for [options]. \
-
-Company's name: Extract Company's name with exact words or [not mentioned] if it could not be extracted.\
-
-Industry: Identify the industry that the company is in or [not mentioned] if it is not specified in the description. \
-
-Citizenship Requirement: Identify whether the job requires the applicant to be a [Permanent Resident only] or if this requirement is [not mentioned]. \
-
-Visa Sponsor Policy: Identify whether the company [Will provide], [Will not provide] visa sponsorship or if this policy is [not mentioned]. \
-
-Job type:  Classify one of [Full time, Intern, Contractor]. If the description contains words like (Duration, Pay Rate, Per hour), classify it as [Contractor]. \
-
-Years of Experience: Extract required YoE in years from the description. \
-
-Years of Experience level: Classify whether the job requires a [New grad] with under one year of experience, \
-a [Mid-level] professional with 1 to 3 years of experience,  \
-a [Senior] professional with more than 3 years of experience, or if this requirement is [not mentioned]. \
-Use the information extracted from the `Years of Experience` to make this decision. \
-
-Required Programming Languages: List all the programming languages that are essential for the software engineering position at the company. \
-
-Top Three Software Engineering Relevant Skills: Identify the top three technological skills required for the software engineering job. \
-
-Domain Knowledge Required: Identify any specific domain/Industry knowledge required for the job. \
-
-Minimum Education: Choose only one as the minimum requirement among [Phd only], [Master], [Bachelor], or [not mentioned]. If multiple degrees are mentioned, select the lowest qualification as the minimum requirement. \
-
-Return JSON format with keys = [Company, Industry, Citizenship, Visa_policy, JobType, YoE_year, YoE_level, Languages, SE_skills, Domain_Knowledge, Min_Education] \
-Values in the returned JSON must only be either string or a list of strings if multiple elements are required. \
-
-Don't provide extra explanations. Don't give default output. 
-"""
-
+se_prompt = prompt_registry['Software Engineer'].text
 # Prompt for General positions
-general_prompt = f"""
-You will be provided with job description queries. \
-The job description query will be delimited with #### characters.\
-
-First classify if the input is an actual job description. \
-If it is not a job description, return "The input is not a job description" immediately and do not conduct the following tasks. \
-
-Your task is to extract or classify certain key information from the description. \
-If the information isn't explicitly mentioned in the job description, don't make any assumptions - simply respond with 'Not mentioned'. \
-If there are [options] provided for a certain task, only return those [options] with the exact word. Don't add extra information for [options]. \
-
-Company's name: Extract Company's name with exact words or [not mentioned] if it could not be extracted.\
-
-Industry: Identify the industry that the company is in or [not mentioned] if it is not specified in the description. \
-
-Citizenship Requirement: Identify whether the job requires the applicant to be a [Permanent Resident only] or if this requirement is [not mentioned]. \
-
-Visa Sponsor Policy: Identify whether the company [Will provide], [Will not provide] visa sponsorship or if this policy is [not mentioned]. \
-
-Job type:  Classify one of [Full time, Intern, Contractor]. If the description contains words like (Duration, Pay Rate, Per hour), classify it as [Contractor]. \
-
-Years of Experience: Extract required YoE in years from the description. \
-
-Years of Experience level: Classify whether the job requires a [New grad] with under one year of experience, \
-a [Mid-level] professional with 1 to 3 years of experience,  \
-a [Senior] professional with more than 3 years of experience, or if this requirement is [not mentioned]. \
-Use the information extracted from the `Years of Experience` to make this decision. \
-
-Domain Knowledge Required: Identify any specific domain/Industry knowledge required for the job. \
-
-Minimum Education: Choose only one as the minimum requirement among [Phd only], [Master], [Bachelor], or [not mentioned]. If multiple degrees are mentioned, select the lowest qualification as the minimum requirement. \
-
-Return JSON format with keys = [Company, Industry, Citizenship, Visa_policy, JobType, YoE_year, YoE_level, Domain_Knowledge, Min_Education] \
-Values in the returned JSON must only be either string or a list of strings if multiple elements are required. \
-
-Don't provide extra explanations. Don't give default output. 
-"""
+general_prompt = prompt_registry['General'].text
+
+# Prompt versions: a short content hash per role, used to invalidate cached results whenever a prompt changes
+prompt_versions = {role: prompt.version for role, prompt in prompt_registry.items()}
+
+# Functions of the function-calling mode: one to return the fields, one to reject inputs that aren't job descriptions
+EXTRACT_FUNCTION = 'extract_job_fields'
+REJECT_FUNCTION = 'reject_input'
+_FUNCTION_SYSTEM = [
+    _HEADER[0],
+    f"If the input is not an actual job description, call {REJECT_FUNCTION}. "
+    f"Otherwise call {EXTRACT_FUNCTION} with the key information of the description. "
+    "If the information isn't explicitly mentioned in the job description, don't make any assumptions - simply use 'not mentioned'. "
+    "For parameters with allowed values, only use one of those values with the exact word. ",
+]
+
+class CompiledFunctions(NamedTuple):
+    """
+    The function-calling variant of a role prompt: system prompt, function declarations, content hash version,
+    prompt token count and completion token budget.
+    """
+    role: str
+    system: str
+    functions: List[Dict[str, object]]
+    fields: Tuple[PromptField, ...]
+    version: str
+    tokens: int
+    max_tokens: int
+
+def _parameter(field: PromptField) -> Dict[str, object]:
+    description = field.instruction.strip()
+    if field.is_list:
+        return {'type': 'array', 'items': {'type': 'string'}, 'description': description}
+    if field.options:
+        return {'type': 'string', 'enum': list(field.options), 'description': description}
+    return {'type': 'string', 'description': description}
+
+def _value_tokens(field: PromptField) -> int:
+    # Completion tokens budgeted for one value: the longest option, a few list items, or a short phrase
+    if field.options:
+        return max(estimate_tokens(option) for option in field.options) + 2
+    return 40 if field.is_list else 30
+
+def compile_functions(role: str) -> CompiledFunctions:
+    """
+    Function to declare the fields of a role as function parameters for the function-calling mode.
+
+    :param role: Role name, one of the keys of role_fields.
+    :return: The compiled functions.
+    """
+    fields = prompt_registry[role].fields
+    functions = [
+        {'name': EXTRACT_FUNCTION,
+         'description': 'Record the key information extracted from a job description.',
+         'parameters': {'type': 'object',
+                        'properties': {field.key: _parameter(field) for field in fields},
+                        'required': [field.key for field in fields]}},
+        {'name': REJECT_FUNCTION,
+         'description': 'Reject an input that is not a job description.',
+         'parameters': {'type': 'object', 'properties': {}}},
+    ]
+    system = '\n'.join(_FUNCTION_SYSTEM)
+    declarations = json.dumps(functions, sort_keys=True)
+    version = hashlib.sha256((system + declarations).encode('utf-8')).hexdigest()[:12]
+    max_tokens = 16 + sum(estimate_tokens(json.dumps(field.key)) + _value_tokens(field) + 4 for field in fields)
+    return CompiledFunctions(role, system, functions, fields, version,
+                             estimate_tokens(system) + estimate_tokens(declarations), max_tokens)
+
+# Compiled once at import
+function_registry: Dict[str, CompiledFunctions] = {role: compile_functions(role) for role in role_fields}
+
+def get_functions(role_name: str) -> CompiledFunctions:
+    """
+    Function to get the compiled functions of a role.
+
+    :raises ValueError: If the role_name is not valid.
+    """
+    get_prompt(role_name)
+    return function_registry[role_name]
+
+def prompt_report() -> List[Dict[str, object]]:
+    """
+    Function to report the size of the compiled prompts.
+
+    :return: One dictionary per role with the version, the number of fields, the token count and the shared prefix tokens,
+             and the version, token count and completion budget of the function-calling variant.
+    """
+    return [{'role': prompt.role, 'version': prompt.version, 'fields': len(prompt.fields),
+             'tokens': prompt.tokens, 'shared_prefix_tokens': shared_prefix_tokens,
+             'function_version': function_registry[prompt.role].version,
+             'function_tokens': function_registry[prompt.role].tokens,
+             'function_max_tokens': function_registry[prompt.role].max_tokens}
+            for prompt in prompt_registry.values()]
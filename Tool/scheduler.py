@@ -0,0 +1,381 @@
+"""
+This module contains the rate-limit-aware request scheduler used in front of the OpenAI API.
+
+Every request first waits for capacity in two token buckets, one metering requests per minute (RPM) and one
+metering tokens per minute (TPM, estimated from the prompt before sending). Waiting requests are served
+first-in first-out. Rate-limit (429), server (5xx), timeout and connection errors are retried with jittered
+exponential backoff, honouring the Retry-After header when the API sends one.
+
+The TPM reservation of every attempt is reconciled when the attempt ends: with the usage reported by the response,
+refunded in full if the API rejected the request (4xx, e.g. 429), and kept at the estimate if the outcome is unknown
+(timeouts, connection and server errors). Responses without usage (streams) are settled by the caller.
+
+The scheduler only wraps a callable, so it can be exercised against a local fake endpoint (set the
+OPENAI_API_BASE environment variable before importing openai) or against a plain Python function.
+"""
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+import openai
+
+def _wake(future: 'asyncio.Future[None]') -> None:
+    if not future.done():
+        future.set_result(None)
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `capacity_per_minute` per minute.
+
+    :param capacity_per_minute: Size of the bucket and amount refilled per minute.
+    """
+    def __init__(self, capacity_per_minute: float) -> None:
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def time_until(self, amount: float) -> float:
+        """
+        Seconds to wait until `amount` tokens are available (amounts above the capacity wait for a full bucket).
+        """
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        """
+        Give back (or take, if negative) tokens once the actual usage of a request is known.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+def _retry_after(error: Exception) -> Optional[float]:
+    # openai 0.27 exposes the response headers on its errors
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def _usage_tokens(result: Any) -> Optional[int]:
+    # Tokens reported by a non-streamed response; streams, moderations and plain values report none
+    try:
+        return int(result['usage']['total_tokens'])
+    except (TypeError, KeyError, IndexError, ValueError):
+        return None
+
+def _failed_tokens(error: Exception, estimated_tokens: int) -> int:
+    # A request rejected by the API (4xx, e.g. 429) consumed no quota; otherwise it may have been processed
+    status = getattr(error, 'http_status', None)
+    if status is not None and 400 <= status < 500:
+        return 0
+    return estimated_tokens
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Function to check if an OpenAI error is worth retrying (429, 5xx, timeouts and connection errors).
+
+    :param error: The raised exception.
+    :return: True if the request should be retried, False otherwise.
+    """
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                          openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        status = getattr(error, 'http_status', None)
+        return status is None or status >= 500
+    return False
+
+class RequestScheduler:
+    """
+    Meters requests against RPM and TPM quotas and retries transient failures with backoff.
+
+    :param requests_per_minute: Requests per minute quota.
+    :param tokens_per_minute: Tokens per minute quota, None to meter requests only.
+    :param max_retries: Maximum number of retries of a request before the error is raised.
+    :param base_delay: Backoff delay of the first retry in seconds, doubled on every further retry.
+    :param max_delay: Upper bound of the backoff delay in seconds.
+    """
+    def __init__(self,
+                 requests_per_minute: float,
+                 tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 6,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0) -> None:
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        # Tickets given up by cancelled waiters, and the futures of the async waiters by ticket
+        self._abandoned: Set[int] = set()
+        self._waiters: Dict[int, Tuple[asyncio.AbstractEventLoop, 'asyncio.Future[None]']] = {}
+        # Metrics
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    # The helpers below are called with self._cond held
+    def _take_ticket(self) -> int:
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        return ticket
+
+    def _delay(self, tokens: int) -> float:
+        delay = self.request_bucket.time_until(1)
+        if self.token_bucket is not None:
+            delay = max(delay, self.token_bucket.time_until(tokens))
+        return delay
+
+    def _grant(self, tokens: int, start: float) -> float:
+        # Take the quota of the head of the queue and hand over to the next ticket
+        self.request_bucket.consume(1)
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens)
+        self._advance()
+        waited = time.monotonic() - start
+        self.requests += 1
+        self.total_wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        return waited
+
+    def _advance(self) -> None:
+        self._serving += 1
+        while self._serving in self._abandoned:
+            self._abandoned.discard(self._serving)
+            self._serving += 1
+        self._cond.notify_all()
+        waiter = self._waiters.get(self._serving)
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_wake, future)
+
+    def _abandon(self, ticket: int) -> None:
+        if ticket == self._serving:
+            self._advance()
+        elif ticket > self._serving:
+            self._abandoned.add(ticket)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Block until the quotas allow one request of `tokens` tokens, in arrival order.
+
+        :param tokens: Estimated number of tokens of the request (prompt + max completion).
+        :return: The time spent waiting in seconds.
+        """
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._take_ticket()
+            try:
+                while True:
+                    if ticket != self._serving:
+                        self._cond.wait()
+                        continue
+                    delay = self._delay(tokens)
+                    if delay <= 0:
+                        return self._grant(tokens, start)
+                    self._cond.wait(timeout=delay)
+            except BaseException:
+                self._abandon(ticket)
+                raise
+            finally:
+                self.queue_depth -= 1
+
+    async def acquire_async(self, tokens: int = 0) -> float:
+        """
+        Async version of acquire: the waiting is done on the event loop (no thread is held), in the same queue as
+        the blocking callers. A cancelled waiter leaves the queue without taking any quota.
+
+        :param tokens: Estimated number of tokens of the request (prompt + max completion).
+        :return: The time spent waiting in seconds.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._take_ticket()
+        try:
+            while True:
+                with self._cond:
+                    if ticket == self._serving:
+                        delay = self._delay(tokens)
+                        if delay <= 0:
+                            return self._grant(tokens, start)
+                        wake = None
+                    else:
+                        # Woken up by _advance when the ticket reaches the head of the queue
+                        wake = loop.create_future()
+                        self._waiters[ticket] = (loop, wake)
+                if wake is None:
+                    await asyncio.sleep(delay)
+                    continue
+                try:
+                    await wake
+                finally:
+                    with self._cond:
+                        self._waiters.pop(ticket, None)
+        except BaseException:
+            with self._cond:
+                self._abandon(ticket)
+            raise
+        finally:
+            with self._cond:
+                self.queue_depth -= 1
+
+    def settle(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """
+        Correct the TPM bucket with the actual token usage of a finished request (done by call and acall,
+        except for responses that report no usage, e.g. streams).
+
+        :param estimated_tokens: Tokens reserved by acquire.
+        :param actual_tokens: Tokens reported by the API.
+        :return: None
+        """
+        if self.token_bucket is None:
+            return
+        with self._cond:
+            self.token_bucket.refund(estimated_tokens - actual_tokens)
+            self._cond.notify_all()
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Jittered exponential backoff: a random delay between half and all of base_delay * 2**attempt (capped).
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, fn: Callable[..., Any], *args: Any, estimated_tokens: int = 0, **kwargs: Any) -> Any:
+        """
+        Call `fn(*args, **kwargs)` once the quotas allow it, retrying transient OpenAI errors.
+
+        :param fn: The function issuing the request, e.g., openai.ChatCompletion.create.
+        :param estimated_tokens: Estimated number of tokens of the request, reserved for every attempt and
+            reconciled when it ends (see settle).
+        :return: The return value of fn.
+
+        :raises openai.error.OpenAIError: If the error isn't retryable or the retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            self.acquire(estimated_tokens)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.settle(estimated_tokens, _failed_tokens(e, estimated_tokens))
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    with self._cond:
+                        self.failures += 1
+                    raise
+                delay = self.backoff_delay(attempt)
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                with self._cond:
+                    self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+                continue
+            actual_tokens = _usage_tokens(result)
+            if actual_tokens is not None:
+                self.settle(estimated_tokens, actual_tokens)
+            return result
+
+    async def acall(self, fn: Callable[..., Any], *args: Any, estimated_tokens: int = 0, **kwargs: Any) -> Any:
+        """
+        Async version of call: await `fn(*args, **kwargs)` (e.g., openai.ChatCompletion.acreate) once the quotas
+        allow it, retrying transient OpenAI errors. Waiting for the quotas happens on the event loop (see
+        acquire_async), so waiters hold no thread of the loop's executor.
+
+        :param fn: The coroutine function issuing the request.
+        :param estimated_tokens: Estimated number of tokens of the request, reserved for every attempt and
+            reconciled when it ends (see settle).
+        :return: The result of the awaited fn.
+
+        :raises openai.error.OpenAIError: If the error isn't retryable or the retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            await self.acquire_async(estimated_tokens)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                self.settle(estimated_tokens, _failed_tokens(e, estimated_tokens))
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    with self._cond:
+                        self.failures += 1
+                    raise
+                delay = self.backoff_delay(attempt)
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+                with self._cond:
+                    self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            actual_tokens = _usage_tokens(result)
+            if actual_tokens is not None:
+                self.settle(estimated_tokens, actual_tokens)
+            return result
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        Report the scheduler counters.
+
+        :return: A dictionary with the current and maximum queue depth, the number of requests, retries and failures,
+                 and the total, average and maximum wait time in seconds.
+        """
+        with self._cond:
+            return {
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'requests': self.requests,
+                'retries': self.retries,
+                'failures': self.failures,
+                'total_wait_time': self.total_wait_time,
+                'avg_wait_time': self.total_wait_time / self.requests if self.requests else 0.0,
+                'max_wait_time': self.max_wait_time,
+            }
+
+# Default quotas per API model name as (requests per minute, tokens per minute); adjust to your account tier
+rate_limits = {
+    'gpt-3.5-turbo': (3500, 90000),
+    'gpt-4': (200, 10000),
+    'text-moderation-latest': (1000, None),
+}
+_schedulers: Dict[str, RequestScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(model: str) -> RequestScheduler:
+    """
+    Function to get the shared scheduler of an API model, created on first use from `rate_limits`.
+
+    :param model: The API model name, e.g., 'gpt-3.5-turbo'.
+    :return: The scheduler of the model.
+    """
+    with _schedulers_lock:
+        if model not in _schedulers:
+            requests_per_minute, tokens_per_minute = rate_limits.get(model, (60, None))
+            _schedulers[model] = RequestScheduler(requests_per_minute, tokens_per_minute)
+        return _schedulers[model]
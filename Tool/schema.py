@@ -0,0 +1,253 @@
+"""
+This module contains the validation of the model output against the fields of the role prompt.
+
+parse_model_output turns a raw completion into a record in one pass: it extracts the JSON object (ignoring code
+fences and any prose around it), repairs common defects (trailing commas, Python literals, truncated output),
+parses it once, and validates and normalizes every field against the prompt registry (Tool.prompt): keys are
+matched case-insensitively or by their instruction label, option values are mapped onto the exact [options]
+(e.g. 'full-time' -> 'Full time', 'PhD' -> 'Phd only'), list fields become lists of strings and other values
+strings. The fields that are still missing or outside their options are reported, so that only those need to be
+asked again. extract_json_array recovers the JSON array of a packed completion (Tool.packing) the same way.
+"""
+import re
+import json
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from Tool.prompt import PromptField
+
+NOT_MENTIONED = 'not mentioned'
+_FENCE = re.compile(r"```(?:json|JSON)?")
+_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+# Spellings of option values the model commonly uses, by normalized form
+_OPTION_SYNONYMS = {
+    'fulltime': 'Full time', 'fulltimeemployee': 'Full time', 'permanent': 'Full time',
+    'internship': 'Intern', 'contract': 'Contractor', 'contracttohire': 'Contractor',
+    'phd': 'Phd only', 'doctorate': 'Phd only', 'doctoral': 'Phd only',
+    'masters': 'Master', 'mastersdegree': 'Master', 'ms': 'Master',
+    'bachelors': 'Bachelor', 'bachelorsdegree': 'Bachelor', 'bs': 'Bachelor', 'ba': 'Bachelor',
+    'entrylevel': 'New grad', 'junior': 'New grad', 'midlevel': 'Mid-level', 'senior': 'Senior',
+    'yes': 'Will provide', 'no': 'Will not provide',
+    'notspecified': NOT_MENTIONED, 'notprovided': NOT_MENTIONED, 'na': NOT_MENTIONED, 'none': NOT_MENTIONED,
+    'unknown': NOT_MENTIONED, 'notmentioned': NOT_MENTIONED,
+}
+
+class ParsedOutput(NamedTuple):
+    """
+    Result of parse_model_output.
+
+    :param record: The validated and normalized record, or None if no JSON object could be recovered.
+    :param invalid_fields: Keys of the fields that are missing or outside their options.
+    :param repaired: Whether the JSON text had to be repaired before parsing.
+    """
+    record: Optional[Dict[str, Any]]
+    invalid_fields: List[str]
+    repaired: bool
+
+def _normalize(text: str) -> str:
+    return re.sub(r'[^a-z0-9]', '', text.lower())
+
+def _extract_and_repair(text: str, opening: str = '{') -> Tuple[Optional[str], bool]:
+    # Scan from the first opening bracket ('{' for an object, '[' for an array) to its match once, dropping
+    # trailing commas and mapping Python literals outside strings; a truncated object or array is closed.
+    # Returns the JSON text and whether anything was changed.
+    text = _FENCE.sub('', text)
+    start = text.find(opening)
+    if start < 0:
+        return None, False
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = escape = False
+    repaired = False
+    i = start
+    while i < len(text):
+        char = text[i]
+        if in_string:
+            out.append(char)
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+            elif char == '\n':
+                # Raw newline inside a string is invalid JSON
+                out[-1] = '\\n'
+                repaired = True
+            i += 1
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if out and out[-1] == ',':
+                out.pop()
+                repaired = True
+            if stack:
+                stack.pop()
+            out.append(char)
+            if not stack:
+                return ''.join(out), repaired
+            i += 1
+            continue
+        elif char.isalpha():
+            word = re.match(r'[A-Za-z]+', text[i:]).group(0)
+            out.append(_LITERALS.get(word, word))
+            repaired = repaired or word in _LITERALS
+            i += len(word)
+            continue
+        elif char.isspace():
+            i += 1
+            continue
+        out.append(char)
+        i += 1
+    # Truncated output: close the open string and brackets
+    if in_string:
+        out.append('"')
+    if out and out[-1] == ',':
+        out.pop()
+    if out and out[-1] == ':':
+        out.append('null')
+    out.extend(reversed(stack))
+    return ''.join(out), True
+
+def extract_json_array(text: str) -> Optional[List[Any]]:
+    """
+    Extracts the JSON array of a completion like parse_model_output extracts its object: code fences and prose
+    around it are ignored and the same defects are repaired.
+
+    :param text: The content response from the model.
+    :return: The parsed array, or None if the completion has no JSON array (or starts with an object instead).
+    """
+    start = text.find('[')
+    if start < 0 or '{' in text[:start]:
+        return None
+    json_text, _ = _extract_and_repair(text, '[')
+    try:
+        elements = json.loads(json_text)
+    except json.JSONDecodeError:
+        return None
+    return elements if isinstance(elements, list) else None
+
+def _option_value(value: Any, options: Tuple[str, ...]) -> Optional[str]:
+    if isinstance(value, list):
+        value = value[0] if len(value) == 1 else None
+    if value is None:
+        return NOT_MENTIONED if NOT_MENTIONED in options else None
+    key = _normalize(str(value))
+    for option in options:
+        if _normalize(option) == key:
+            return option
+    synonym = _OPTION_SYNONYMS.get(key)
+    return synonym if synonym in options else None
+
+def _list_value(value: Any) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        if _normalize(value) in ('', 'notmentioned', 'none', 'na'):
+            return []
+        value = re.split(r'[,;\n]', value)
+    if not isinstance(value, list):
+        value = [value]
+    items: List[str] = []
+    for item in value:
+        item = str(item).strip()
+        if item and item not in items:
+            items.append(item)
+    return items
+
+def _text_value(value: Any) -> str:
+    if value is None:
+        return NOT_MENTIONED
+    if isinstance(value, list):
+        value = ', '.join(str(item).strip() for item in value if str(item).strip())
+    value = str(value).strip()
+    if _OPTION_SYNONYMS.get(_normalize(value)) == NOT_MENTIONED or not value:
+        return NOT_MENTIONED
+    return value
+
+def field_aliases(fields: Iterable[PromptField]) -> Dict[str, str]:
+    """
+    Function to map the normalized spellings of the field keys and instruction labels to the keys.
+    """
+    aliases = {}
+    for field in fields:
+        label = field.instruction.split(':', 1)[0]
+        aliases[_normalize(label)] = field.key
+        aliases[_normalize(label.replace("'s", ''))] = field.key
+        aliases[_normalize(field.key)] = field.key
+    return aliases
+
+def validate_record(raw: Dict[str, Any], fields: Iterable[PromptField]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Function to validate and normalize a parsed record against prompt fields.
+
+    :param raw: The parsed JSON object.
+    :param fields: The expected fields (see Tool.prompt.CompiledPrompt.fields).
+    :return: A tuple containing the normalized record, in field order and without unknown keys (invalid option values
+             are kept as given), and the keys of the missing or invalid fields.
+    """
+    fields = list(fields)
+    aliases = field_aliases(fields)
+    values = {}
+    for key, value in raw.items():
+        target = aliases.get(_normalize(str(key)))
+        if target is not None and target not in values:
+            values[target] = value
+    record: Dict[str, Any] = {}
+    invalid: List[str] = []
+    for field in fields:
+        if field.key not in values:
+            invalid.append(field.key)
+            continue
+        value = values[field.key]
+        if field.is_list:
+            record[field.key] = _list_value(value)
+        elif field.options:
+            option = _option_value(value, field.options)
+            if option is None:
+                invalid.append(field.key)
+                record[field.key] = _text_value(value)
+            else:
+                record[field.key] = option
+        else:
+            record[field.key] = _text_value(value)
+    return record, invalid
+
+def parse_model_output(response: str, fields: Iterable[PromptField]) -> ParsedOutput:
+    """
+    Function to extract, repair, parse, validate and normalize the JSON output of the model in one pass.
+
+    :param response: The content response from the model.
+    :param fields: The expected fields (see Tool.prompt.CompiledPrompt.fields).
+    :return: The parsed output (record None if no JSON object could be recovered).
+    """
+    raw = None
+    repaired = False
+    if response.lstrip().startswith('{'):
+        # Fast path: well-formed output is parsed exactly once
+        try:
+            raw = json.loads(response)
+        except json.JSONDecodeError:
+            raw = None
+    if raw is None:
+        text, repaired = _extract_and_repair(response)
+        if text is None:
+            return ParsedOutput(None, [], False)
+        try:
+            raw = json.loads(text)
+        except json.JSONDecodeError:
+            return ParsedOutput(None, [], repaired)
+    if not isinstance(raw, dict):
+        return ParsedOutput(None, [], repaired)
+    record, invalid = validate_record(raw, fields)
+    if not record:
+        # None of the expected fields: not an extraction
+        return ParsedOutput(None, [], repaired)
+    return ParsedOutput(record, invalid, repaired)
+
+def complete_record(record: Dict[str, Any], fields: Iterable[PromptField]) -> Dict[str, Any]:
+    """
+    Function to fill the fields still missing from a record with their 'not mentioned' value, in field order.
+    """
+    return {field.key: record.get(field.key, [] if field.is_list else NOT_MENTIONED) for field in fields}
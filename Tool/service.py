@@ -0,0 +1,294 @@
+"""
+This module contains the worker service: an HTTP API around the scan pipeline, backed by the persistent job
+queue of Tool.jobqueue and a pool of worker processes.
+
+The HTTP server (aiohttp) only validates and queues the scans and reads their results, so a slow GPT-4 call never
+blocks it. Worker processes claim the queued jobs and run them with llm_run_async (or llm_deploy_run_async for
+jobs that must not store data), each up to `concurrency` at a time on its own event loop. Workers share nothing
+but the queue database, so they can be added on more cores with `python -m Tool.service worker`, independently
+of the server and of the Streamlit apps, which become thin clients (ServiceClient) when JOBSCAN_SERVICE_URL is set.
+
+Endpoints:
+    POST /jobs        {"model": "GPT-3.5", "role": "Data relevant", "description": "...", "store_data": true,
+                       "use_cache": true, "session": "...", "session_limit": 0.5} -> 202 {"id": ..., "status": "queued"}.
+                      "session" and "session_limit" (dollars) charge the scan to a session budget (Tool.budget).
+                      An "Authorization: Bearer <OpenAI API key>" header runs the scan with the key of the user.
+    GET /jobs/<id>    Status of a job, with its response and info once done (or its error once failed).
+                      ?wait=<seconds> holds the request until the job is finished, up to MAX_WAIT seconds.
+    GET /health       Number of jobs per status.
+
+Command line usage:
+    python -m Tool.service serve --port 8090 --workers 4 --concurrency 8
+    python -m Tool.service worker --concurrency 8
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import traceback
+import multiprocessing
+from typing import Any, Dict, List, Optional, Tuple, Union
+import requests
+from aiohttp import web
+from Tool.jobqueue import JobQueue, DONE, FAILED, QUEUED, LEASE_SECONDS
+from Tool.prompt import prompt_registry
+from Tool.metrics import metrics
+from Tool.budget import BudgetLedger, BudgetScope
+
+valid_models = ['GPT-3.5', 'GPT-4', 'Cascade']
+# Longest hold of a GET /jobs/<id>?wait= request, and interval between two reads of the queue (server and workers)
+MAX_WAIT = 60
+POLL_INTERVAL = 0.2
+
+def _bad_request(message: str) -> web.Response:
+    return web.json_response({'error': message}, status=400)
+
+async def submit_job(request: web.Request) -> web.Response:
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return _bad_request('The body must be a JSON object.')
+    if not isinstance(body, dict):
+        return _bad_request('The body must be a JSON object.')
+    model_name = body.get('model', 'GPT-3.5')
+    role_name = body.get('role', 'Data relevant')
+    description = body.get('description')
+    if model_name not in valid_models:
+        return _bad_request(f"'{model_name}' is not a valid model. Choose from {valid_models}.")
+    if role_name not in prompt_registry:
+        return _bad_request(f"'{role_name}' is not a valid role. Choose from {list(prompt_registry)}.")
+    if not isinstance(description, str) or not description.strip():
+        return _bad_request("'description' must be a non-empty string.")
+    session, session_limit = body.get('session'), body.get('session_limit')
+    if session is not None and not isinstance(session, str):
+        return _bad_request("'session' must be a string.")
+    if session_limit is not None and (isinstance(session_limit, bool) or not isinstance(session_limit, (int, float))
+                                      or session_limit < 0):
+        return _bad_request("'session_limit' must be a non-negative number of dollars.")
+    authorization = request.headers.get('Authorization', '')
+    api_key = authorization[len('Bearer '):].strip() if authorization.startswith('Bearer ') else None
+    job_id = await asyncio.to_thread(request.app['queue'].submit, model_name, role_name, description,
+                                     bool(body.get('store_data', True)), bool(body.get('use_cache', True)), api_key,
+                                     session, session_limit)
+    metrics.inc('service_jobs_submitted_total', model=model_name, role=role_name)
+    return web.json_response({'id': job_id, 'status': QUEUED}, status=202, headers={'Location': f'/jobs/{job_id}'})
+
+async def job_status(request: web.Request) -> web.Response:
+    queue = request.app['queue']
+    try:
+        wait = min(max(float(request.query.get('wait', 0)), 0), MAX_WAIT)
+    except ValueError:
+        return _bad_request("'wait' must be a number of seconds.")
+    deadline = time.monotonic() + wait
+    while True:
+        job = await asyncio.to_thread(queue.get, request.match_info['job_id'])
+        if job is None:
+            return web.json_response({'error': 'Unknown job.'}, status=404)
+        if job['status'] in (DONE, FAILED) or time.monotonic() >= deadline:
+            return web.json_response(job)
+        await asyncio.sleep(POLL_INTERVAL)
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response(await asyncio.to_thread(request.app['queue'].counts))
+
+def create_app(queue: JobQueue) -> web.Application:
+    """
+    Function to create the HTTP application of the service.
+
+    :param queue: The job queue shared with the workers.
+    :return: The aiohttp application.
+    """
+    app = web.Application()
+    app['queue'] = queue
+    app.router.add_post('/jobs', submit_job)
+    app.router.add_get('/jobs/{job_id}', job_status)
+    app.router.add_get('/health', health)
+    return app
+
+async def _heartbeat(queue: JobQueue, job_id: str, worker: str) -> None:
+    # Renews the lease of a running job well before it expires, so a slow scan is never claimed twice
+    while True:
+        await asyncio.sleep(LEASE_SECONDS / 3)
+        if not await asyncio.to_thread(queue.renew, job_id, worker):
+            return
+
+async def _run_job(queue: JobQueue, job: Dict[str, Any], worker: str) -> None:
+    from Tool.llm_comp import llm_run_async, llm_deploy_run_async
+    run = llm_run_async if job['store_data'] else llm_deploy_run_async
+    budget = BudgetScope(session=job['budget_session'], session_limit=job['budget_limit'])
+    heartbeat = asyncio.ensure_future(_heartbeat(queue, job['id'], worker))
+    try:
+        response, info = await run(job['model'], job['role'], job['description'], use_cache=job['use_cache'],
+                                   api_key=job['api_key'], budget=budget)
+    except Exception as e:
+        await asyncio.to_thread(queue.fail, job['id'], worker, str(e))
+        metrics.inc('service_jobs_total', model=job['model'], role=job['role'], status=FAILED)
+    else:
+        await asyncio.to_thread(queue.complete, job['id'], worker, response, info)
+        metrics.inc('service_jobs_total', model=job['model'], role=job['role'], status=DONE)
+    finally:
+        heartbeat.cancel()
+
+async def _work(queue: JobQueue, worker: str, poll_interval: float) -> None:
+    # One claim-run-record loop; a worker process runs `concurrency` of them. An error of the queue (e.g. a locked
+    # database) is reported and retried after a pause, so it never stops the loop nor the other loops.
+    while True:
+        try:
+            job = await asyncio.to_thread(queue.claim, worker)
+            if job is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            await _run_job(queue, job, worker)
+        except Exception:
+            print(f"Worker {worker}: error in the job loop", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            metrics.inc('service_worker_errors_total')
+            await asyncio.sleep(poll_interval)
+
+async def run_worker_async(queue: JobQueue, concurrency: int = 8, poll_interval: float = POLL_INTERVAL) -> None:
+    """
+    Runs a worker until cancelled: `concurrency` jobs at a time are claimed from the queue and scanned.
+
+    :param queue: The job queue.
+    :param concurrency: Number of jobs run concurrently by this worker.
+    :param poll_interval: Seconds between two claims while the queue is empty.
+    """
+    from Tool.aio import close_session
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        await asyncio.gather(*[_work(queue, worker, poll_interval) for _ in range(concurrency)])
+    finally:
+        await close_session()
+
+def worker_main(db_path: str, concurrency: int = 8, poll_interval: float = POLL_INTERVAL) -> None:
+    """
+    Entry point of a worker process. Jobs left unfinished by a killed worker are claimed again once their
+    lease expires (see Tool.jobqueue.LEASE_SECONDS).
+    """
+    # Load API
+    import openai
+    from dotenv import load_dotenv
+    from Tool import llm_comp
+    _ = load_dotenv('API_key/.env')
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    # Jobs that must not store data are charged to a ledger shared by the worker processes instead of one in memory
+    # per process, so their session and daily limits hold across processes (it records costs, not descriptions)
+    llm_comp.deploy_budget_ledger = BudgetLedger(os.path.join(os.path.dirname(db_path), 'deploy_budget.sqlite'))
+    queue = JobQueue(db_path)
+    try:
+        asyncio.run(run_worker_async(queue, concurrency, poll_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+
+def start_workers(db_path: str, processes: int = 4, concurrency: int = 8) -> List[multiprocessing.Process]:
+    """
+    Function to start a pool of worker processes on a queue.
+
+    :param db_path: Path of the queue database.
+    :param processes: Number of worker processes.
+    :param concurrency: Number of jobs run concurrently by each process.
+    :return: The started processes.
+    """
+    # Spawned rather than forked: the parent may already run threads (event loop, metrics server)
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=worker_main, args=(db_path, concurrency), name=f'jobscan-worker-{index}', daemon=True)
+               for index in range(processes)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+class ServiceClient:
+    """
+    Blocking client of the worker service, used by the Streamlit apps instead of calling the pipeline inline.
+
+    :param base_url: URL of the service, e.g. 'http://127.0.0.1:8090'.
+    :param timeout: Seconds to wait for the result of a scan.
+    """
+    def __init__(self, base_url: str, timeout: float = 300) -> None:
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def submit(self, model_name: str, role_name: str, user_message: str, use_cache: bool = True,
+               api_key: Optional[str] = None, store_data: bool = True, session: Optional[str] = None,
+               session_limit: Optional[float] = None) -> str:
+        """
+        Queues a scan.
+
+        :param session: Session the scan is charged to, see Tool.budget.BudgetScope.
+        :param session_limit: Spend limit of the session in dollars, None for no limit.
+
+        :return: The job ID.
+
+        :raises ValueError: If the service rejects the scan (e.g. invalid model or role name).
+        """
+        headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+        reply = self._session.post(f'{self.base_url}/jobs', headers=headers, timeout=30, json={
+            'model': model_name, 'role': role_name, 'description': user_message,
+            'store_data': store_data, 'use_cache': use_cache, 'session': session, 'session_limit': session_limit})
+        if reply.status_code == 400:
+            raise ValueError(reply.json()['error'])
+        reply.raise_for_status()
+        return reply.json()['id']
+
+    def status(self, job_id: str, wait: float = 0) -> Dict[str, Any]:
+        """
+        :param wait: Seconds the service may hold the request until the job is finished.
+        :return: The status of a job, see Tool.jobqueue.JobQueue.get.
+        """
+        reply = self._session.get(f'{self.base_url}/jobs/{job_id}', params={'wait': wait}, timeout=wait + 30)
+        reply.raise_for_status()
+        return reply.json()
+
+    def scan(self, model_name: str, role_name: str, user_message: str, use_cache: bool = True,
+             api_key: Optional[str] = None, store_data: bool = True, session: Optional[str] = None,
+             session_limit: Optional[float] = None) -> Tuple[Dict[str, Union[float, str]], Union[str, None]]:
+        """
+        Queues a scan and waits for its result; same result as Tool.llm_comp.llm_run (store_data=True)
+        or llm_deploy_run (store_data=False).
+
+        :raises ValueError: If the service rejects the scan.
+        :raises RuntimeError: If the scan failed in the worker.
+        :raises TimeoutError: If the scan is not finished within the timeout.
+        """
+        job_id = self.submit(model_name, role_name, user_message, use_cache, api_key, store_data, session, session_limit)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            job = self.status(job_id, wait=min(MAX_WAIT, max(deadline - time.monotonic(), 0)))
+            if job['status'] == DONE:
+                return job['response'], job.get('info')
+            if job['status'] == FAILED:
+                raise RuntimeError(f"Scan {job_id} failed: {job.get('error')}")
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Scan {job_id} is not finished after {self.timeout} seconds.")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='JobScanGPT worker service: HTTP API and worker processes around a job queue.')
+    parser.add_argument('command', choices=['serve', 'worker'],
+                        help="'serve' runs the HTTP API (and --workers worker processes), 'worker' runs one worker process.")
+    parser.add_argument('--queue', default=os.path.join('data', 'jobs.sqlite'), help='Job queue database.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes started by serve (0 to run the workers separately).')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of jobs run concurrently by each worker process.')
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        worker_main(args.queue, args.concurrency)
+        return
+    workers = start_workers(args.queue, args.workers, args.concurrency)
+    print(f"Started {len(workers)} worker processes on {args.queue}", file=sys.stderr)
+    try:
+        web.run_app(create_app(JobQueue(args.queue)), host=args.host, port=args.port)
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == '__main__':
+    main()
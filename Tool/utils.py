@@ -1,13 +1,39 @@
 import os
 import json
 import time
-from typing import Any, Dict, List
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
 import openai
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: writers are then only serialized within the process
+    fcntl = None
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding('cl100k_base')
+except ImportError:
+    _encoding = None
+
+# Serializes writes to the JSONL store between threads (e.g. batch workers)
+_json_file_lock = threading.Lock()
+# Number of appends (in this process) between two compactions of the JSONL store
+COMPACT_EVERY = 10000
+_appends_since_compaction = 0
+# Seconds a validated API key is trusted, and the model retrieved to validate a key
+KEY_VALIDATION_TTL = 3600
+VALIDATION_MODEL = 'gpt-3.5-turbo'
+# Expiry time of the validated API keys, by hash
+_validated_keys: Dict[str, float] = {}
+_validated_keys_lock = threading.Lock()
 
 def write_to_file(file_name: str, data: str) -> None:
     """
     Function to write a string to a file. If the file already exists, a timestamp is appended to the filename
     to prevent overwriting. The function will automatically create a directory if it doesn't exist.
+    The scan pipeline stores the raw job descriptions in Tool.blobstore.BlobStore instead.
     
     :param file_name: The name of the file to write to
     :param data: The data to write to the file
@@ -55,72 +81,147 @@ def read_from_file(file_name: str) -> str:
     except Exception as e:
         print(f"An error occurred: {e}")
 
+def _json_file_paths(model_name: str) -> Tuple[str, str, str]:
+    # Paths of the JSONL store, its lock file and the legacy JSON array file of a model
+    valid_models = ['GPT-3.5', 'GPT-4']
+    if model_name not in valid_models:
+        raise ValueError(f"'{model_name}' is not a valid argument. Choose from {valid_models}.")
+    default_directory_name = os.path.join('data', 'LLM_output')
+    file_path = os.path.join(default_directory_name, model_name + '.jsonl')
+    return file_path, file_path + '.lock', os.path.join(default_directory_name, model_name + '.json')
+
+@contextmanager
+def _locked(lock_path: str):
+    # Exclusive lock shared by threads (threading lock) and processes (flock on a lock file)
+    with _json_file_lock:
+        with open(lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 def append_json_to_file(model_name: str, json_object: Dict[str, Any]) -> None:
     """
-    Function to append a JSON object to a file. The function loads the existing data, appends the new object, 
-    and writes all the data back to the file. The function will automatically create a directory if it doesn't exist.
+    Function to append a JSON object to a file. The object is written as a single line at the end of an
+    append-only JSONL file, so the cost of a write doesn't depend on the size of the history.
+    Writers are serialized with a file lock, which makes concurrent sessions and processes safe.
+    The store is compacted every COMPACT_EVERY appends (see compact_json_file), and a legacy JSON array
+    file from older versions is migrated on the first append.
+    The function will automatically create a directory if it doesn't exist.
 
     :param model_name: The model name, used to categorize the data. Must be one of the following: ['GPT-3.5', 'GPT-4'].
     :param json_object: The JSON object to append to the file.
     :return: None
     """
+    global _appends_since_compaction
+    file_path, lock_path, legacy_path = _json_file_paths(model_name)
 
-    # Check the model name is valid
-    valid_models = ['GPT-3.5', 'GPT-4']
-    if model_name not in valid_models:
-        raise ValueError(f"'{model_name}' is not a valid argument. Choose from {valid_models}.")
-    
-    # Check if directory exists and if not, create it
-    default_directory_name = os.path.join('data', 'LLM_output')
-    if not os.path.exists(default_directory_name):
-        os.makedirs(default_directory_name)
-    
-    # Create the full file path
-    file_name = model_name + '.json'
-    file_path = os.path.join(default_directory_name, file_name)
+    # Create the directory if it doesn't exist (concurrent first appends may race to create it)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    line = (json.dumps(json_object) + '\n').encode('utf-8')
+    with _locked(lock_path):
+        with open(file_path, 'ab+') as f:
+            # Start on a fresh line if a previous writer crashed mid-line
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    line = b'\n' + line
+            f.write(line)
+        _appends_since_compaction += 1
+        compact = _appends_since_compaction >= COMPACT_EVERY or os.path.exists(legacy_path)
+    if compact:
+        compact_json_file(model_name)
+
+def compact_json_file(model_name: str) -> int:
+    """
+    Function to compact the JSONL store of a model. Records of a legacy JSON array file are moved in front of
+    the JSONL records, and lines that can't be parsed (e.g. a torn write after a crash) are dropped.
+    The store is rewritten to a temporary file and atomically swapped in while holding the writer lock.
 
-    data = []
+    :param model_name: The model name, used to locate the data. Must be one of the following: ['GPT-3.5', 'GPT-4'].
+    :return: The number of records kept.
+    """
+    global _appends_since_compaction
+    file_path, lock_path, legacy_path = _json_file_paths(model_name)
+    if not os.path.exists(os.path.dirname(file_path)):
+        return 0
+    kept = 0
+    with _locked(lock_path):
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w') as out:
+            for record in _iter_records(file_path, legacy_path):
+                out.write(json.dumps(record) + '\n')
+                kept += 1
+        os.replace(temp_path, file_path)
+        if os.path.exists(legacy_path):
+            os.remove(legacy_path)
+        _appends_since_compaction = 0
+    return kept
 
-    # If file exists, load the existing data
+def _iter_records(file_path: str, legacy_path: str) -> Iterator[Dict[str, Any]]:
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'r') as f:
+            yield from json.load(f)
     if os.path.exists(file_path):
         with open(file_path, 'r') as f:
-            data = json.load(f)
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn or partially written line; skipped and removed by the next compaction
+                    continue
 
-    # Append the new JSON object
-    data.append(json_object)
+def iter_json_from_file(model_name: str) -> Iterator[Dict[str, Any]]:
+    """
+    Function to stream the JSON objects stored by append_json_to_file, one at a time and in insertion order,
+    without loading the whole history in memory.
 
-    # Write the updated data back to the file
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=4)
+    :param model_name: The model name, used to locate the data. Must be one of the following: ['GPT-3.5', 'GPT-4'].
+    :return: A generator of JSON objects (Python dictionaries).
+    """
+    file_path, _, legacy_path = _json_file_paths(model_name)
+    yield from _iter_records(file_path, legacy_path)
 
 def read_json_from_file(model_name: str) -> List[Dict[str, Any]]:
     """
     Function to read JSON data from a file. The function will read the file from the directory 
     where the append_json_to_file function writes its data.
+    Prefer iter_json_from_file for large histories, this function loads every record in memory.
     
     :param model_name: The model name, used to locate the data. Must be one of the following: ['GPT-3.5', 'GPT-4'].
     :return: The data read from the file as a list of JSON objects (Python dictionaries).
     """
-    # Check the model name is valid
-    valid_models = ['GPT-3.5', 'GPT-4']
-    if model_name not in valid_models:
-        raise ValueError(f"'{model_name}' is not a valid argument. Choose from {valid_models}.")
+    data = list(iter_json_from_file(model_name))
+    print(f"Data successfully read from {_json_file_paths(model_name)[0]}")
+    return data
 
-    # Define the default directory name
-    default_directory_name = os.path.join('data', 'LLM_output')
-    
-    # Create the full file path
-    file_name = model_name + '.json'
-    full_file_name = os.path.join(default_directory_name, file_name)
+def normalize_job_text(text: str) -> str:
+    """
+    Function to normalize a job description so that trivially different copies compare equal.
+    Leading/trailing whitespace is removed and every run of whitespace is collapsed to a single space.
 
-    # Read JSON data from the file
-    try:
-        with open(full_file_name, 'r') as f:
-            data = json.load(f)
-        print(f"Data successfully read from {full_file_name}")
-        return data
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    :param text: The job description
+    :return: The normalized job description
+    """
+    return ' '.join(text.split())
+
+def estimate_tokens(text: str) -> int:
+    """
+    Function to estimate the number of tokens of a text before sending it to the API.
+    Uses the tiktoken cl100k_base encoding when tiktoken is installed, otherwise about four characters per token.
+
+    :param text: The text to measure
+    :return: The (estimated) number of tokens
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
 
 def is_valid_json(s: str) -> bool:
     """
@@ -135,13 +236,103 @@ def is_valid_json(s: str) -> bool:
     except json.JSONDecodeError:
         return False
 
-def is_valid_openai_api_key(api_key):
-    openai.api_key = api_key
+class IncrementalJSONParser:
+    """
+    Parser that extracts the top-level fields of a JSON object while it is still being received,
+    e.g. from a streamed completion. A field is returned as soon as its value is complete.
+
+    Usage:
+        parser = IncrementalJSONParser()
+        for chunk in chunks:
+            for key, value in parser.feed(chunk):
+                ...
+    """
+    def __init__(self) -> None:
+        self._buffer = ''
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._field_start = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """
+        Add a piece of text and return the fields completed by it.
+
+        :param chunk: The next piece of the JSON text.
+        :return: A list of (key, value) tuples, in the order they appear.
+        """
+        self._buffer += chunk
+        fields = []
+        buffer = self._buffer
+        for position in range(self._position, len(buffer)):
+            c = buffer[position]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in '{[':
+                self._depth += 1
+                if self._depth == 1 and c == '{':
+                    self._field_start = position + 1
+            elif c in '}]':
+                if self._depth == 1:
+                    self._emit(position, fields)
+                self._depth -= 1
+            elif c == ',' and self._depth == 1:
+                self._emit(position, fields)
+                self._field_start = position + 1
+        self._position = len(buffer)
+        return fields
+
+    def _emit(self, end: int, fields: List[Tuple[str, Any]]) -> None:
+        # Parse the `"key": value` segment between the previous delimiter and `end`
+        if self._field_start is None:
+            return
+        segment = self._buffer[self._field_start:end].strip()
+        if not segment:
+            return
+        try:
+            fields.extend(json.loads('{' + segment + '}').items())
+        except json.JSONDecodeError:
+            pass
+
+def hash_api_key(api_key: str) -> str:
+    """
+    Function to hash an API key, so that caches never hold the key itself.
+    """
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+def is_valid_openai_api_key(api_key: str, ttl: float = KEY_VALIDATION_TTL) -> bool:
+    """
+    Function to check an OpenAI API key with a single cheap request (retrieving one model).
+    Valid keys are remembered by their hash for `ttl` seconds, so Streamlit reruns don't repeat the request;
+    invalid keys are not remembered, so a corrected key is checked right away.
+    The global openai.api_key is left untouched.
+
+    :param api_key: The API key to check.
+    :param ttl: Seconds during which a valid key is not checked again.
+    :return: True if the key is valid, False otherwise.
+    """
+    key_hash = hash_api_key(api_key)
+    now = time.time()
+    with _validated_keys_lock:
+        if _validated_keys.get(key_hash, 0) > now:
+            return True
     try:
-        # Attempt to list the available engines
-        openai.Engine.list()
-        return True
+        openai.Model.retrieve(VALIDATION_MODEL, api_key=api_key)
     except openai.error.OpenAIError as e:
         # Handle specific error types as needed
         print(f"{str(e)}")
-        return False
\ No newline at end of file
+        return False
+    with _validated_keys_lock:
+        # Drop the expired entries while at it
+        for expired in [key for key, expiry in _validated_keys.items() if expiry <= now]:
+            del _validated_keys[expired]
+        _validated_keys[key_hash] = now + ttl
+    return True
\ No newline at end of file
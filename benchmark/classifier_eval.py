@@ -0,0 +1,29 @@
+"""
+Measure precision/recall of the local job-description pre-classifier (Tool.classifier) on a labeled set.
+
+Usage (from the repository root):
+    python -m benchmark.classifier_eval [--fixtures benchmark/fixtures/job_description_labels.jsonl] [--thresholds 0.1 0.2 0.3]
+
+The fixture file holds one {"text": ..., "label": true|false} object per line, label true for job descriptions.
+Results are printed as one JSON object per threshold.
+"""
+import os
+import json
+import argparse
+from Tool.classifier import DEFAULT_THRESHOLD, evaluate_classifier
+
+default_fixtures = os.path.join(os.path.dirname(__file__), 'fixtures', 'job_description_labels.jsonl')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Evaluate the job-description pre-classifier.')
+    parser.add_argument('--fixtures', default=default_fixtures, help='Labeled JSONL file.')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.1, DEFAULT_THRESHOLD, 0.3, 0.4, 0.5])
+    args = parser.parse_args()
+
+    with open(args.fixtures, 'r') as f:
+        samples = [(record['text'], record['label']) for record in map(json.loads, f) if record]
+    for threshold in args.thresholds:
+        print(json.dumps(evaluate_classifier(samples, threshold)))
+
+if __name__ == '__main__':
+    main()
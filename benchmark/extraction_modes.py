@@ -0,0 +1,128 @@
+"""
+Side-by-side comparison of the two extraction modes of llm_completion: 'prompt' (JSON described in the role
+prompt) and 'functions' (the fields declared as a function and returned as the arguments of a function call).
+
+Both modes scan the same synthetic corpus (see benchmark.run_benchmark.synthetic_corpus) against the mock
+OpenAI server, or against --api-base. For every mode the report holds the prompt and completion tokens per
+scan, the p50/p95 latency, the share of outputs that could not be parsed or had invalid fields before any
+re-ask (see Tool.schema.parse_model_output), and the cost.
+
+Usage (from the repository root):
+    python -m benchmark.extraction_modes [--items 100] [--concurrency 10] [--defect-rate 0.1] [--output modes.json]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+from typing import Any, Dict, List
+import openai
+from benchmark.mock_server import MockConfig, start_mock_server
+from benchmark.run_benchmark import percentiles, synthetic_corpus
+
+async def bench_mode(mode: str, model_name: str, role_name: str, corpus: List[str], concurrency: int) -> Dict[str, Any]:
+    """
+    Function to scan the corpus with llm_completion_async in one extraction mode.
+    """
+    from Tool.llm_comp import api_cost, llm_completion_async
+    from Tool.prompt import get_prompt
+    from Tool.schema import parse_model_output
+    fields = get_prompt(role_name).fields
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    totals = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0, 'errors': 0,
+              'not_json': 0, 'invalid_fields': 0, 'repaired': 0}
+
+    async def scan(text: str) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response, token_usage = await llm_completion_async(model_name, role_name, text, mode=mode)
+            except Exception:
+                totals['errors'] += 1
+                return
+            latencies.append(time.perf_counter() - start)
+        parsed = parse_model_output(response, fields)
+        totals['prompt_tokens'] += token_usage['prompt_tokens']
+        totals['completion_tokens'] += token_usage['completion_tokens']
+        totals['cost'] += api_cost(model_name, token_usage)
+        if parsed.record is None:
+            totals['not_json'] += 1
+        elif parsed.invalid_fields:
+            totals['invalid_fields'] += 1
+        totals['repaired'] += parsed.repaired
+
+    start = time.perf_counter()
+    await asyncio.gather(*(scan(text) for text in corpus))
+    wall_time = time.perf_counter() - start
+    scans = max(1, len(latencies))
+    return {
+        'mode': mode,
+        'items': len(corpus),
+        'wall_time_s': wall_time,
+        'latency': percentiles(latencies),
+        'prompt_tokens_per_scan': totals['prompt_tokens'] / scans,
+        'completion_tokens_per_scan': totals['completion_tokens'] / scans,
+        'parse_failure_rate': (totals['not_json'] + totals['invalid_fields']) / scans,
+        'repair_rate': totals['repaired'] / scans,
+        'not_json': totals['not_json'],
+        'invalid_fields': totals['invalid_fields'],
+        'errors': totals['errors'],
+        'cost': totals['cost'],
+        'cost_per_scan': totals['cost'] / scans,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the prompt and function-calling extraction modes.')
+    parser.add_argument('--items', type=int, default=100, help='Job descriptions per mode.')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--model', default='GPT-3.5', choices=['GPT-3.5', 'GPT-4'])
+    parser.add_argument('--role', default='Data relevant', choices=['Data relevant', 'Software Engineer', 'General'])
+    parser.add_argument('--modes', nargs='+', default=['prompt', 'functions'], choices=['prompt', 'functions'])
+    parser.add_argument('--api-base', default=None, help='Use this endpoint instead of starting the mock server.')
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--defect-rate', type=float, default=0.1, help='Share of malformed extractions.')
+    parser.add_argument('--rpm', type=float, default=100000, help='Requests per minute allowed by the client scheduler.')
+    parser.add_argument('--tpm', type=float, default=100000000, help='Tokens per minute allowed by the client scheduler.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file (default: stdout).')
+    args = parser.parse_args()
+
+    server = None
+    if args.api_base is None:
+        server = start_mock_server(MockConfig(latency_ms=args.latency_ms, sigma=args.sigma,
+                                              defect_rate=args.defect_rate, seed=args.seed))
+        args.api_base = server.api_base
+    openai.api_base = args.api_base
+    openai.api_key = os.getenv('OPENAI_API_KEY', 'mock')
+
+    # The scheduler quotas must be set before the first request creates the schedulers
+    from Tool import scheduler
+    for model in ('gpt-3.5-turbo', 'gpt-4'):
+        scheduler.rate_limits[model] = (args.rpm, args.tpm)
+    from Tool.aio import run_sync
+    from Tool.prompt import prompt_report
+    corpus = synthetic_corpus(args.items, seed=args.seed)
+    report = {
+        'benchmark': 'jobscan-extraction-modes',
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'prompts': [row for row in prompt_report() if row['role'] == args.role],
+        'modes': [run_sync(bench_mode, mode, args.model, args.role, corpus, args.concurrency) for mode in args.modes],
+    }
+    if server is not None:
+        report['mock_server'] = dict(server.counters)
+        server.shutdown()
+    document = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(document)
+    else:
+        sys.stdout.write(document + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+A local stand-in for the OpenAI ChatCompletion and Moderation endpoints, for benchmarks and offline tests.
+
+It speaks the HTTP API used by openai 0.27 (POST /v1/chat/completions, with or without stream=True, and
+POST /v1/moderations) and answers with a well-formed extraction built from the keys listed in the system
+prompt (or from the parameters of the declared function, answered with a function call), a JSON array for
+packed requests, and token usage estimated from the request. Latency, server errors
+and rate limiting (429 with a Retry-After header) are drawn from configurable distributions. Inputs
+containing FLAG_ME are flagged by the moderation endpoint. GET /v1/models/<model> answers the API key checks;
+API keys starting with 'invalid' are rejected with 401 on every endpoint.
+
+Usage:
+    python -m benchmark.mock_server --port 8089 --latency-ms 800 --sigma 0.5 --error-rate 0.01 --rate-limit-rate 0.02
+then point the client at it:
+    OPENAI_API_BASE=http://127.0.0.1:8089/v1 OPENAI_API_KEY=mock streamlit run llm_app.py
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+@dataclass
+class MockConfig:
+    """
+    Behaviour of the mock server.
+
+    :param latency_ms: Median latency of a chat completion in milliseconds.
+    :param sigma: Shape of the log-normal latency distribution (0 for a fixed latency).
+    :param moderation_latency_ms: Median latency of a moderation request in milliseconds.
+    :param error_rate: Probability of answering 500.
+    :param rate_limit_rate: Probability of answering 429.
+    :param retry_after: Retry-After header of 429 answers, in seconds.
+    :param completion_tokens: Completion tokens reported per extraction.
+    :param defect_rate: Probability of a malformed extraction (code fence, prose prefix, trailing comma,
+                        option value outside its options, or a missing field).
+    :param seed: Seed of the random generator, None for a random seed.
+    """
+    latency_ms: float = 800
+    sigma: float = 0.5
+    moderation_latency_ms: float = 150
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 0.5
+    completion_tokens: int = 120
+    defect_rate: float = 0.0
+    seed: Optional[int] = None
+
+_KEYS_PATTERN = re.compile(r"keys = \[([^\]]+)\]")
+_PACK_PATTERN = re.compile(r"^\[\d+\]####", re.MULTILINE)
+_OPTION_VALUES = {
+    'Citizenship': 'not mentioned',
+    'Visa_policy': 'Will provide',
+    'JobType': 'Full time',
+    'YoE_year': '3',
+    'YoE_level': 'Mid-level',
+    'Min_Education': 'Bachelor',
+}
+_LIST_KEYS = {'DS_skills', 'SE_skills', 'Languages'}
+
+def _count_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+def _extraction(keys: List[str], user_text: str) -> Dict[str, Any]:
+    # A plausible extraction: the first words of the query as company name, fixed option values
+    words = re.findall(r"[A-Za-z]+", user_text)
+    record = {}
+    for key in keys:
+        if key == 'Company':
+            record[key] = ' '.join(words[:2]) or 'not mentioned'
+        elif key in _LIST_KEYS:
+            record[key] = ['Python', 'SQL', 'AWS']
+        else:
+            record[key] = _OPTION_VALUES.get(key, 'not mentioned')
+    return record
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'MockOpenAI/1.0'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _failure(self) -> bool:
+        # Draw rate limiting and server errors; returns True if an error was sent
+        config = self.server.config
+        draw = self.server.random()
+        if draw < config.rate_limit_rate:
+            self.server.count('rate_limited')
+            self._send(429, {'error': {'message': 'Rate limit reached (mock).', 'type': 'requests'}},
+                       {'Retry-After': str(config.retry_after)})
+            return True
+        if draw < config.rate_limit_rate + config.error_rate:
+            self.server.count('errors')
+            self._send(500, {'error': {'message': 'The server had an error (mock).', 'type': 'server_error'}})
+            return True
+        return False
+
+    def _unauthorized(self) -> bool:
+        # Reject the API keys marked as invalid; returns True if an error was sent
+        if self.headers.get('Authorization', '').startswith('Bearer invalid'):
+            self._send(401, {'error': {'message': 'Incorrect API key provided (mock).', 'type': 'invalid_request_error',
+                                       'code': 'invalid_api_key'}})
+            return True
+        return False
+
+    def do_GET(self) -> None:
+        if self._unauthorized():
+            return
+        if '/models/' in self.path:
+            model = self.path.rsplit('/', 1)[-1]
+            self._send(200, {'id': model, 'object': 'model', 'created': 0, 'owned_by': 'mock'})
+        else:
+            self._send(404, {'error': {'message': f'Unknown path {self.path} (mock).'}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self._unauthorized():
+            return
+        if self.path.endswith('/moderations'):
+            self.server.sleep(self.server.config.moderation_latency_ms)
+            self.server.count('moderations')
+            if self._failure():
+                return
+            text = request.get('input', '')
+            text = ' '.join(text) if isinstance(text, list) else text
+            self._send(200, {'id': 'modr-mock', 'model': 'text-moderation-mock',
+                             'results': [{'flagged': 'FLAG_ME' in text, 'categories': {}, 'category_scores': {}}]})
+        elif self.path.endswith('/chat/completions'):
+            self.server.sleep(self.server.config.latency_ms)
+            self.server.count('completions')
+            if self._failure():
+                return
+            self._chat(request)
+        else:
+            self._send(404, {'error': {'message': f'Unknown path {self.path} (mock).'}})
+
+    def _chat(self, request: Dict[str, Any]) -> None:
+        messages = request.get('messages', [])
+        system_text = messages[0]['content'] if messages else ''
+        user_text = messages[-1]['content'] if messages else ''
+        prompt_tokens = sum(_count_tokens(message.get('content') or '') + 4 for message in messages) + 3
+        functions = request.get('functions')
+        if functions:
+            prompt_tokens += _count_tokens(json.dumps(functions))
+            keys = list(functions[0]['parameters']['properties'])
+        else:
+            keys_match = _KEYS_PATTERN.search(system_text)
+            keys = [key.strip() for key in keys_match.group(1).split(',')] if keys_match else ['Company']
+        queries = _PACK_PATTERN.split(user_text)[1:]
+        if queries:
+            content = json.dumps([_extraction(keys, query) for query in queries])
+        else:
+            record = _extraction(keys, user_text.strip('#'))
+            content = json.dumps(record)
+            if self.server.random() < self.server.config.defect_rate:
+                content = self._defect(record, json_only=bool(functions))
+        function_call = {'name': functions[0]['name'], 'arguments': content} if functions else None
+        if function_call:
+            message = {'role': 'assistant', 'content': None, 'function_call': function_call}
+        else:
+            message = {'role': 'assistant', 'content': content}
+        completion_tokens = self.server.config.completion_tokens * max(1, len(queries))
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+        if request.get('stream'):
+            self._stream(request.get('model', 'mock'), content, function_call and function_call['name'])
+            return
+        self._send(200, {'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()),
+                         'model': request.get('model', 'mock'),
+                         'choices': [{'index': 0, 'message': message,
+                                      'finish_reason': 'function_call' if function_call else 'stop'}],
+                         'usage': usage})
+
+    def _defect(self, record: Dict[str, Any], json_only: bool = False) -> str:
+        # One of the defects seen in real completions; function arguments are always a bare JSON object,
+        # so only the value defects remain for them
+        kind = int(self.server.random() * 5)
+        if json_only and kind < 3:
+            return json.dumps(record)
+        if kind == 0:
+            return f"```json\n{json.dumps(record, indent=2)}\n```"
+        if kind == 1:
+            return f"Here is the extracted information:\n{json.dumps(record)}"
+        if kind == 2:
+            return json.dumps(record)[:-1] + ',}'
+        if kind == 3 and 'JobType' in record:
+            return json.dumps(dict(record, JobType='Part-time'))
+        return json.dumps({key: value for key, value in record.items() if key != 'Industry'})
+
+    def _stream(self, model: str, content: str, function_name: Optional[str] = None) -> None:
+        # Server-sent events, a few characters per chunk like the real API
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        pieces = [content[i:i + 4] for i in range(0, len(content), 4)]
+        for index, piece in enumerate(pieces + [None]):
+            if piece is None:
+                delta = {}
+            elif function_name:
+                # The first delta names the function, the following ones carry pieces of the arguments
+                delta = {'function_call': dict({'name': function_name} if index == 0 else {}, arguments=piece)}
+            else:
+                delta = {'content': piece}
+            finish_reason = None if piece is not None else ('function_call' if function_name else 'stop')
+            chunk = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server holding the mock configuration and request counters.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], config: MockConfig) -> None:
+        super().__init__(address, _Handler)
+        self.config = config
+        self.counters = {'moderations': 0, 'completions': 0, 'rate_limited': 0, 'errors': 0}
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+
+    def handle_error(self, request: Any, client_address: Tuple[str, int]) -> None:
+        # Clients cancelling a request (e.g. speculative completions) are expected, not errors
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def random(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def sleep(self, median_ms: float) -> None:
+        with self._lock:
+            factor = self._random.lognormvariate(0, self.config.sigma) if self.config.sigma > 0 else 1.0
+        time.sleep(median_ms * factor / 1000)
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+def start_mock_server(config: Optional[MockConfig] = None, host: str = '127.0.0.1', port: int = 0) -> MockOpenAIServer:
+    """
+    Function to start the mock server in a background thread.
+
+    :param config: Behaviour of the server, defaults to MockConfig().
+    :param host: Interface to listen on.
+    :param port: Port to listen on, 0 for any free port.
+    :return: The running server; its api_base attribute is the value for openai.api_base. Call shutdown() to stop it.
+    """
+    server = MockOpenAIServer((host, port), config or MockConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run a mock OpenAI ChatCompletion/Moderation server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=800)
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--moderation-latency-ms', type=float, default=150)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--defect-rate', type=float, default=0.0, help='Share of malformed extractions.')
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    config = MockConfig(latency_ms=args.latency_ms, sigma=args.sigma, moderation_latency_ms=args.moderation_latency_ms,
+                        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                        retry_after=args.retry_after, defect_rate=args.defect_rate, seed=args.seed)
+    server = MockOpenAIServer((args.host, args.port), config)
+    print(f"Mock OpenAI server listening on {server.api_base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
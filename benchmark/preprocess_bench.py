@@ -0,0 +1,78 @@
+"""
+Benchmark the job-description preprocessing (Tool.preprocess) on a corpus.
+
+Usage (from the repository root):
+    python -m benchmark.preprocess_bench [--corpus benchmark/fixtures/boilerplate_job_descriptions.jsonl] [--token-budget 1500]
+    python -m benchmark.preprocess_bench --compare --model GPT-3.5 --role "Data relevant"
+
+The corpus holds one {"id": ..., "description": ...} object per line. The report (JSON on stdout) gives the
+tokens saved per posting and in total, and the prompt cost saved per API model (Tool.budget.prices). With
+--compare, every posting is also scanned twice (verbatim and preprocessed) and the fields whose normalized values
+differ are listed; this calls the API configured by OPENAI_API_KEY / OPENAI_API_BASE (which may point to a
+local stand-in server). Without --compare, no API key is needed.
+"""
+import os
+import json
+import argparse
+from Tool.preprocess import DEFAULT_TOKEN_BUDGET, preprocess_job_description
+from Tool.budget import prices, token_cost
+
+default_corpus = os.path.join(os.path.dirname(__file__), 'fixtures', 'boilerplate_job_descriptions.jsonl')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark job-description preprocessing.')
+    parser.add_argument('--corpus', default=default_corpus, help='JSONL corpus of job descriptions.')
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_TOKEN_BUDGET)
+    parser.add_argument('--compare', action='store_true', help='Also compare extracted fields with and without preprocessing.')
+    parser.add_argument('--model', default='GPT-3.5', choices=['GPT-3.5', 'GPT-4'])
+    parser.add_argument('--role', default='Data relevant', choices=['Data relevant', 'Software Engineer', 'General'])
+    args = parser.parse_args()
+
+    if args.compare:
+        # The scan pipeline is only loaded to compare extractions
+        from Tool.llm_comp import llm_completion
+        from Tool.prompt import get_prompt
+        from Tool.schema import parse_model_output
+        fields = get_prompt(args.role).fields
+
+    items = []
+    with open(args.corpus, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip():
+                record = json.loads(line)
+                items.append((str(record.get('id', line_number)), record['description']))
+
+    report = {'token_budget': args.token_budget, 'items': []}
+    original_total = processed_total = 0
+    for item_id, description in items:
+        _, stats = preprocess_job_description(description, args.token_budget)
+        original_total += stats['original_tokens']
+        processed_total += stats['processed_tokens']
+        entry = {'id': item_id, **stats}
+        if args.compare:
+            raw_response, _ = llm_completion(args.model, args.role, description, token_budget=None)
+            processed_response, _ = llm_completion(args.model, args.role, description, token_budget=args.token_budget)
+            # Parsed and normalized as the pipeline does, so formatting differences don't count as changes
+            raw_fields = parse_model_output(raw_response, fields).record
+            processed_fields = parse_model_output(processed_response, fields).record
+            if raw_fields is None or processed_fields is None:
+                entry['changed_fields'] = None
+            else:
+                entry['changed_fields'] = sorted(key for key in set(raw_fields) | set(processed_fields)
+                                                 if raw_fields.get(key) != processed_fields.get(key))
+        report['items'].append(entry)
+
+    saved = original_total - processed_total
+    report['total'] = {
+        'original_tokens': original_total,
+        'processed_tokens': processed_total,
+        'tokens_saved': saved,
+        'reduction': saved / original_total if original_total else 0.0,
+        'prompt_cost_saved': {model: token_cost(model, saved, 0) for model in prices},
+    }
+    if args.compare:
+        report['total']['items_with_changed_fields'] = sum(1 for entry in report['items'] if entry['changed_fields'])
+    print(json.dumps(report, indent=4))
+
+if __name__ == '__main__':
+    main()
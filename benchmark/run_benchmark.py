@@ -0,0 +1,235 @@
+"""
+End-to-end benchmark of llm_run / llm_deploy_run and of the storage layer, without spending real money.
+
+A mock OpenAI server (benchmark.mock_server) is started in-process unless --api-base points to another
+endpoint. For every concurrency level (1, 10 and 100 by default) the benchmark scans a synthetic corpus of
+unique job descriptions (the result cache is bypassed) and measures throughput (JDs/sec), p50/p95/p99
+latency and the outcome of every scan. The storage functions (the legacy file-per-description write_to_file,
+the compressed text store of Tool.blobstore and append_json_to_file) are measured separately at the same
+concurrency levels (latency per write, files and bytes on disk). All files are
+written to a temporary working directory.
+
+Usage (from the repository root):
+    python -m benchmark.run_benchmark [--items 200] [--concurrency 1 10 100] [--latency-ms 300] [--output bench.json]
+
+The report is a single JSON document, suitable for regression tracking.
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+import openai
+from benchmark.mock_server import MockConfig, start_mock_server
+
+default_fixtures = os.path.join(os.path.dirname(__file__), 'fixtures', 'job_description_labels.jsonl')
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """
+    Function to summarize latencies.
+
+    :param values: Latencies in seconds.
+    :return: A dictionary with the mean, p50, p95, p99 and max latency in milliseconds.
+    """
+    if not values:
+        return {'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+    ordered = sorted(values)
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000
+    return {
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': pick(0.50),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+def synthetic_corpus(count: int, seed: int = 0, flagged_rate: float = 0.0) -> List[str]:
+    """
+    Function to build unique job descriptions from the labeled fixtures, so that neither the result cache
+    nor the near-duplicate index can serve them.
+
+    :param count: Number of job descriptions.
+    :param seed: Seed of the random generator.
+    :param flagged_rate: Share of the job descriptions carrying the marker flagged by the mock moderation.
+    :return: The job descriptions.
+    """
+    with open(default_fixtures, 'r') as f:
+        templates = [record['text'] for record in map(json.loads, f) if record['label']]
+    generator = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        noise = ' '.join(f"tag{generator.randrange(10 ** 6)}" for _ in range(60))
+        if generator.random() < flagged_rate:
+            noise += ' FLAG_ME'
+        corpus.append(f"{templates[index % len(templates)]}\nRequisition {index}: {noise}")
+    return corpus
+
+def _timed_run(function: Callable[..., Any], arguments: List[tuple], concurrency: int) -> Dict[str, Any]:
+    # Run function(*arguments[i]) on a thread pool; return wall time, per-call latencies and results
+    def call(args: tuple) -> tuple:
+        start = time.perf_counter()
+        try:
+            result = function(*args)
+            error = None
+        except Exception as e:
+            result, error = None, type(e).__name__
+        return time.perf_counter() - start, result, error
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(call, arguments))
+    return {'wall_time': time.perf_counter() - start, 'outcomes': outcomes}
+
+def bench_pipeline(run: Callable[..., Any], model_name: str, role_name: str, corpus: List[str], concurrency: int) -> Dict[str, Any]:
+    """
+    Function to measure end-to-end scans at one concurrency level.
+    """
+    measured = _timed_run(lambda text: run(model_name, role_name, text, use_cache=False),
+                          [(text,) for text in corpus], concurrency)
+    latencies = [latency for latency, _, _ in measured['outcomes']]
+    outcomes = {}
+    cost = 0.0
+    for _, result, error in measured['outcomes']:
+        key = error or str(result[1])
+        outcomes[key] = outcomes.get(key, 0) + 1
+        if result is not None:
+            cost += result[0].get('cost', 0)
+    return {
+        'concurrency': concurrency,
+        'items': len(corpus),
+        'wall_time_s': measured['wall_time'],
+        'throughput_jds_per_s': len(corpus) / measured['wall_time'] if measured['wall_time'] else 0.0,
+        'latency': percentiles(latencies),
+        'outcomes': outcomes,
+        'cost': cost,
+    }
+
+def _directory_size(path: str) -> Dict[str, int]:
+    files = size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return {'files': files, 'bytes': size}
+
+def bench_storage(corpus: List[str], concurrency: int, work_dir: str) -> Dict[str, Any]:
+    """
+    Function to measure write_to_file, the text store and append_json_to_file at one concurrency level, in a fresh directory.
+    """
+    from Tool.utils import write_to_file, append_json_to_file
+    from Tool.blobstore import BlobStore
+    os.chdir(work_dir)
+    store = BlobStore(os.path.join('data', 'text_store'))
+    record = {'Company': 'Acme Corp', 'Industry': 'Software', 'Citizenship': 'not mentioned', 'Visa_policy': 'not mentioned',
+              'JobType': 'Full time', 'YoE_year': '3', 'YoE_level': 'Mid-level', 'DS_skills': ['Python', 'SQL', 'Spark'],
+              'Domain_Knowledge': 'not mentioned', 'Min_Education': 'Bachelor'}
+    text_run = _timed_run(lambda index, text: write_to_file(f"Company_{index}.txt", text),
+                          list(enumerate(corpus)), concurrency)
+    store_run = _timed_run(lambda index, text: store.put(text, company=f"Company {index}", model='GPT-3.5'),
+                           list(enumerate(corpus)), concurrency)
+    store.close()
+    json_run = _timed_run(lambda index: append_json_to_file('GPT-3.5', dict(record, Company=f"Company {index}")),
+                          [(index,) for index in range(len(corpus))], concurrency)
+    return {
+        'concurrency': concurrency,
+        'writes': len(corpus),
+        'write_to_file': {'latency': percentiles([latency for latency, _, _ in text_run['outcomes']]),
+                          'errors': sum(1 for _, _, error in text_run['outcomes'] if error),
+                          **_directory_size(os.path.join('data', 'text_input'))},
+        'text_store': {'latency': percentiles([latency for latency, _, _ in store_run['outcomes']]),
+                       'errors': sum(1 for _, _, error in store_run['outcomes'] if error),
+                       **_directory_size(os.path.join('data', 'text_store'))},
+        'append_json_to_file': {'latency': percentiles([latency for latency, _, _ in json_run['outcomes']]),
+                                'errors': sum(1 for _, _, error in json_run['outcomes'] if error),
+                                **_directory_size(os.path.join('data', 'LLM_output'))},
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark JobScanGPT against a mock OpenAI server.')
+    parser.add_argument('--items', type=int, default=200, help='Job descriptions per concurrency level.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--model', default='GPT-3.5', choices=['GPT-3.5', 'GPT-4', 'Cascade'])
+    parser.add_argument('--role', default='Data relevant', choices=['Data relevant', 'Software Engineer', 'General'])
+    parser.add_argument('--deploy', action='store_true', help='Benchmark llm_deploy_run (no storage) instead of llm_run.')
+    parser.add_argument('--speculative', action='store_true', help='Run the completion concurrently with the moderation.')
+    parser.add_argument('--flagged-rate', type=float, default=0.0, help='Share of the job descriptions flagged by the mock moderation.')
+    parser.add_argument('--api-base', default=None, help='Use this endpoint instead of starting the mock server.')
+    parser.add_argument('--latency-ms', type=float, default=300)
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--moderation-latency-ms', type=float, default=80)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--defect-rate', type=float, default=0.0, help='Share of malformed extractions.')
+    parser.add_argument('--rpm', type=float, default=100000, help='Requests per minute allowed by the client scheduler.')
+    parser.add_argument('--tpm', type=float, default=100000000, help='Tokens per minute allowed by the client scheduler.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file (default: stdout).')
+    args = parser.parse_args()
+
+    server = None
+    if args.api_base is None:
+        config = MockConfig(latency_ms=args.latency_ms, sigma=args.sigma, moderation_latency_ms=args.moderation_latency_ms,
+                            error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                            defect_rate=args.defect_rate, seed=args.seed)
+        server = start_mock_server(config)
+        args.api_base = server.api_base
+    openai.api_base = args.api_base
+    openai.api_key = os.getenv('OPENAI_API_KEY', 'mock')
+
+    # The scheduler quotas must be set before the first request creates the schedulers
+    from Tool import scheduler
+    for model in ('gpt-3.5-turbo', 'gpt-4', 'text-moderation-latest'):
+        scheduler.rate_limits[model] = (args.rpm, args.tpm)
+    from Tool import llm_comp
+    from Tool.llm_comp import llm_run, llm_deploy_run
+    from Tool.metrics import metrics
+    llm_comp.speculative_moderation = args.speculative
+    run = llm_deploy_run if args.deploy else llm_run
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    original_dir = os.getcwd()
+    report = {
+        'benchmark': 'jobscan-e2e',
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'pipeline': [],
+        'storage': [],
+    }
+    # The storage functions print a line per write; keep stdout clean for the JSON report
+    with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stdout(io.StringIO()) as captured:
+        try:
+            for concurrency in args.concurrency:
+                os.chdir(work_dir)
+                corpus = synthetic_corpus(args.items, seed=args.seed + concurrency, flagged_rate=args.flagged_rate)
+                report['pipeline'].append(bench_pipeline(run, args.model, args.role, corpus, concurrency))
+                captured.truncate(0)
+                storage_dir = os.path.join(work_dir, f"storage_{concurrency}")
+                os.makedirs(storage_dir)
+                report['storage'].append(bench_storage(corpus, concurrency, storage_dir))
+                captured.truncate(0)
+        finally:
+            os.chdir(original_dir)
+    if server is not None:
+        report['mock_server'] = dict(server.counters)
+        server.shutdown()
+    scheduler_metrics = {model: scheduler.get_scheduler(model).metrics()
+                         for model in ('gpt-3.5-turbo', 'gpt-4', 'text-moderation-latest')}
+    report['scheduler'] = scheduler_metrics
+    report['counters'] = metrics.counter_summary()
+    document = json.dumps(report, indent=4)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(document)
+    else:
+        sys.stdout.write(document + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,39 @@
 import streamlit as st
 import os
-from Tool.llm_comp import llm_run
+import uuid
+from Tool.llm_comp import llm_run, result_index, budget_ledger
+from Tool.budget import BudgetScope
+from Tool.metrics import metrics, start_metrics_server, start_periodic_dump
+from Tool.prompt import prompt_report
+from Tool.service import ServiceClient
 import openai
 from dotenv import load_dotenv
 # Load API
 _ = load_dotenv('API_key/.env') 
 openai.api_key  = os.getenv('OPENAI_API_KEY')
+# Optional metrics export: Prometheus endpoint and/or periodic JSON dump
+if os.getenv('METRICS_PORT'):
+    start_metrics_server(int(os.getenv('METRICS_PORT')))
+
+@st.cache_resource
+def metrics_dump(file_path: str):
+    return start_periodic_dump(file_path)
+
+if os.getenv('METRICS_DUMP_PATH'):
+    metrics_dump(os.getenv('METRICS_DUMP_PATH'))
+
+# Optional worker service (Tool.service): scans are queued there instead of running in this script thread
+@st.cache_resource
+def service_client(base_url: str):
+    return ServiceClient(base_url)
+
+service = service_client(os.getenv('JOBSCAN_SERVICE_URL')) if os.getenv('JOBSCAN_SERVICE_URL') else None
+
+# Optional spend limit per browser session in dollars (the daily limit is JOBSCAN_DAILY_BUDGET)
+if 'budget_session' not in st.session_state:
+    st.session_state['budget_session'] = uuid.uuid4().hex
+session_limit = float(os.getenv('JOBSCAN_SESSION_BUDGET')) if os.getenv('JOBSCAN_SESSION_BUDGET') else None
+session_budget = BudgetScope(session=st.session_state['budget_session'], session_limit=session_limit)
 
 # Config
 about = """JobScanGPT is an LLM-based application designed to help users streamline the process of analyzing job descriptions. 
@@ -44,11 +72,18 @@ role_name = st.sidebar.selectbox('What role are you looking for?',('Data relevan
 user_message = st.sidebar.text_area('Provide a job description', '')
 if st.sidebar.button('Submit'):
     with st.spinner('Processing...'):
-        response, info = llm_run(model_name, role_name, user_message)
+        if service is not None:
+            response, info = service.scan(model_name, role_name, user_message, session=session_budget.session,
+                                          session_limit=session_budget.session_limit)
+        else:
+            response, info = llm_run(model_name, role_name, user_message, budget=session_budget)
         cost = round(response['cost'], 4)
         if info == None:
             del response['cost']
+            duplicate_of = response.pop('duplicate_of', None)
             cols[0].write(response)
+            if duplicate_of is not None:
+                cols[0].caption('Served from a near-duplicate job description scanned earlier.')
             cols[0].markdown("""
                 * Years of Experience Level is categorized into four groups:
                     * [New grad]: Under one year of experience.
@@ -62,12 +97,43 @@ if st.sidebar.button('Submit'):
             cols[0].write('The input is not a job description.')
         elif info == 'not_json':
             cols[0].write('Somthing wrong with LLM.')
+        elif info == 'over_budget':
+            cols[0].write('The spend limit is reached; try again later.')
         else:
             cols[0].write(info)
         cols[1].write(str(cost)+'💲')
 else:
     cols[0].write('Wait for input.')
 
+## Search stored results
+with st.expander('Search scanned jobs'):
+    search_cols = st.columns(3)
+    yoe_level = search_cols[0].selectbox('Years of Experience level', ('Any', 'New grad', 'Mid-level', 'Senior', 'not mentioned'))
+    visa_policy = search_cols[1].selectbox('Visa Sponsor Policy', ('Any', 'Will provide', 'Will not provide', 'not mentioned'))
+    skills = search_cols[2].text_input('Required skills (comma separated)', '')
+    results = result_index.query(yoe_level=None if yoe_level == 'Any' else yoe_level,
+                                 visa_policy=None if visa_policy == 'Any' else visa_policy,
+                                 skills=[skill.strip() for skill in skills.split(',') if skill.strip()])
+    st.write(f'{len(results)} matching jobs (latest 100 shown)')
+    if results:
+        st.dataframe(results)
+
+## Admin: pipeline metrics (since the app started)
+with st.expander('Admin: pipeline metrics'):
+    stages = metrics.stage_summary()
+    if stages:
+        st.write('Latency per stage (ms)')
+        st.dataframe(stages)
+        st.write('Scans, tokens and cost')
+        st.dataframe(metrics.counter_summary())
+        st.download_button('Download Prometheus metrics', metrics.to_prometheus(), file_name='metrics.txt')
+    else:
+        st.write('No scans yet.')
+    st.write('Spend per day and model (ledger)')
+    st.dataframe(budget_ledger.summary())
+    st.write('Compiled prompts (tokens)')
+    st.dataframe(prompt_report())
+
 ### Note
 st.sidebar.markdown('''
 * English language supported only.
@@ -1,8 +1,23 @@
 import streamlit as st
 import os
+import uuid
 from Tool.llm_comp import llm_deploy_run
-from Tool.utils import is_valid_openai_api_key
-import openai
+from Tool.budget import BudgetScope
+from Tool.utils import hash_api_key, is_valid_openai_api_key
+from Tool.service import ServiceClient
+
+# Optional worker service (Tool.service): scans are queued there instead of running in this script thread
+@st.cache_resource
+def service_client(base_url: str):
+    return ServiceClient(base_url)
+
+service = service_client(os.getenv('JOBSCAN_SERVICE_URL')) if os.getenv('JOBSCAN_SERVICE_URL') else None
+
+# Optional spend limit per browser session in dollars (the daily limit is JOBSCAN_DAILY_BUDGET)
+if 'budget_session' not in st.session_state:
+    st.session_state['budget_session'] = uuid.uuid4().hex
+session_limit = float(os.getenv('JOBSCAN_SESSION_BUDGET')) if os.getenv('JOBSCAN_SESSION_BUDGET') else None
+session_budget = BudgetScope(session=st.session_state['budget_session'], session_limit=session_limit)
 
 # Config
 about = "JobScanGPT is an LLM-based application designed to help users streamline the process of analyzing job descriptions. \
@@ -38,6 +53,8 @@ cols[1].subheader('Cost:')
 # Load API
 openai_api_key = os.getenv("OPENAI_API_KEY")
 api_key_provided = openai_api_key is not None
+# Key of this session only, passed to every scan (the global openai.api_key is shared by all sessions)
+session_api_key = None
 
 if not api_key_provided:
     openai_api_key = st.sidebar.text_input(
@@ -46,15 +63,21 @@ if not api_key_provided:
         type="password",
     )
     if openai_api_key:
-        spinner = st.sidebar.empty()
-        with st.spinner('Key Verifying...'):
-            if is_valid_openai_api_key(openai_api_key):
-                openai.api_key = openai_api_key
-                st.sidebar.success('API key is valid!')
-                api_key_provided = True
-            else:
-                st.sidebar.error('Incorrect API key provided')
-                openai_api_key = None
+        # Reruns of this session skip the validation; other sessions hit the validated-key cache
+        if st.session_state.get('validated_key_hash') == hash_api_key(openai_api_key):
+            valid = True
+        else:
+            with st.spinner('Key Verifying...'):
+                valid = is_valid_openai_api_key(openai_api_key)
+            if valid:
+                st.session_state['validated_key_hash'] = hash_api_key(openai_api_key)
+        if valid:
+            st.sidebar.success('API key is valid!')
+            api_key_provided = True
+            session_api_key = openai_api_key
+        else:
+            st.sidebar.error('Incorrect API key provided')
+            openai_api_key = None
 
 ### User Input
 st.sidebar.header('User Input: 👇')
@@ -63,11 +86,29 @@ role_name = st.sidebar.selectbox('What role are you looking for?',('Data relevan
 user_message = st.sidebar.text_area('Provide a job description', '')
 if st.sidebar.button('Submit'):
     with st.spinner('Processing...'):
-        response, info = llm_deploy_run(model_name, role_name, user_message)
+        # Render the fields progressively while the completion is streamed
+        result_area = cols[0].empty()
+        streamed_fields = {}
+        def show_field(key, value):
+            streamed_fields[key] = value
+            result_area.write(streamed_fields)
+        if service is not None:
+            # The service returns the whole result at once (no streamed fields)
+            response, info = service.scan(model_name, role_name, user_message, api_key=session_api_key,
+                                          store_data=False, session=session_budget.session,
+                                          session_limit=session_budget.session_limit)
+        else:
+            response, info = llm_deploy_run(model_name, role_name, user_message, on_field=show_field,
+                                            api_key=session_api_key, budget=session_budget)
         cost = round(response['cost'], 4)
+        # Streamed completions report no usage: their cost is counted from estimated tokens
+        cost_estimated = response.pop('cost_estimated', False)
         if info == None:
             del response['cost']
-            cols[0].write(response)
+            duplicate_of = response.pop('duplicate_of', None)
+            result_area.write(response)
+            if duplicate_of is not None:
+                cols[0].caption('Served from a near-duplicate job description scanned earlier.')
             cols[0].markdown("""
                 * Years of Experience Level is categorized into four groups:
                     * [New grad]: Under one year of experience.
@@ -76,14 +117,16 @@ if st.sidebar.button('Submit'):
                     * [not mentioned]: If this requirement is not specified in the job description.
                             """)
         elif info == 'flagged':
-            cols[0].write('The input is not appropriate!')
+            result_area.write('The input is not appropriate!')
         elif info == 'not_job':
-            cols[0].write('The input is not a job description.')
+            result_area.write('The input is not a job description.')
         elif info == 'not_json':
-            cols[0].write('Somthing wrong with LLM.')
+            result_area.write('Somthing wrong with LLM.')
+        elif info == 'over_budget':
+            result_area.write('The spend limit of this session is reached.')
         else:
-            cols[0].write(info)
-        cols[1].write(str(cost)+'💲')
+            result_area.write(info)
+        cols[1].write(('~' if cost_estimated else '')+str(cost)+'💲')
 else:
     cols[0].write('Wait for input.')
 
@@ -92,6 +135,6 @@ st.sidebar.markdown('''
 * English language supported only.
 * Refreshing the app requires re-submitting the API key for security.
 * Input and output data are not stored; see Github for data storage options.
-* Expect a 5-second delay for output due to network latency.
+* Results appear field by field as the model answers; the full output takes about 5 seconds.
                     ''')
 st.sidebar.markdown('''[GitHub Repo](https://github.com/yuting1214/JobScanGPT)''', unsafe_allow_html=True)
\ No newline at end of file
@@ -0,0 +1,66 @@
+import streamlit as st
+import pandas as pd
+from Tool.llm_comp import result_index
+
+st.set_page_config(page_title="JobScanGPT - Analytics", page_icon="📊", layout="wide")
+
+# The rollup tables are maintained on every stored scan, so a render only reads a few thousand rows
+@st.cache_data(ttl=30)
+def load_rollups():
+    fields = pd.DataFrame(result_index.field_rollup(), columns=['role', 'industry', 'field', 'value', 'n'])
+    skills = pd.DataFrame(result_index.skill_rollup(), columns=['role', 'industry', 'skill', 'n'])
+    return fields.convert_dtypes(dtype_backend='pyarrow'), skills.convert_dtypes(dtype_backend='pyarrow')
+
+def distribution(fields, field, by):
+    # Share of each value of a field per group (rows sum to 1)
+    counts = fields[fields['field'] == field].pivot_table(index=by, columns='value', values='n', aggfunc='sum', fill_value=0)
+    return counts.div(counts.sum(axis=1), axis=0)
+
+st.title("Analytics")
+st.write("Aggregates over all the extractions stored by the app.")
+fields, skills = load_rollups()
+if fields.empty:
+    st.write('No scans yet.')
+    st.stop()
+
+## Filters
+filter_cols = st.columns(2)
+roles = filter_cols[0].multiselect('Roles', sorted(fields['role'].unique()))
+top_industries = filter_cols[1].slider('Industries shown', 3, 30, 10)
+if roles:
+    fields = fields[fields['role'].isin(roles)]
+    skills = skills[skills['role'].isin(roles)]
+# Largest industries of the selected roles
+totals = fields[fields['field'] == 'records'].groupby('industry')['n'].sum().sort_values(ascending=False)
+industries = list(totals.index[:top_industries])
+
+## Overview
+records = int(fields.loc[fields['field'] == 'records', 'n'].sum())
+visa = fields[fields['field'] == 'visa_policy'].groupby('value')['n'].sum()
+provide, refuse = int(visa.get('Will provide', 0)), int(visa.get('Will not provide', 0))
+overview = st.columns(3)
+overview[0].metric('Scanned jobs', f"{records:,}")
+overview[1].metric('Visa sponsorship (of all jobs)', f"{provide / records:.1%}" if records else '-')
+overview[2].metric('Visa sponsorship (where stated)', f"{provide / (provide + refuse):.1%}" if provide + refuse else '-')
+
+## Skills
+st.subheader('Most required skills')
+skill_counts = skills.groupby(skills['skill'].str.lower()).agg(skill=('skill', 'first'), n=('n', 'sum'))
+st.bar_chart(skill_counts.nlargest(20, 'n').set_index('skill')['n'])
+
+## Distributions by industry and role
+industry_fields = fields[fields['industry'].isin(industries)]
+st.subheader('Visa sponsor policy by industry')
+st.bar_chart(distribution(industry_fields, 'visa_policy', 'industry'))
+tabs = st.tabs(['Experience level', 'Minimum education'])
+for tab, field in zip(tabs, ['yoe_level', 'min_education']):
+    by_industry, by_role = tab.columns(2)
+    by_industry.write('By industry')
+    by_industry.bar_chart(distribution(industry_fields, field, 'industry'))
+    by_role.write('By role')
+    by_role.bar_chart(distribution(fields, field, 'role'))
+
+with st.expander('Skills by industry'):
+    top = skills[skills['industry'].isin(industries)]
+    st.dataframe(top.pivot_table(index='skill', columns='industry', values='n', aggfunc='sum', fill_value=0)
+                 .assign(total=lambda frame: frame.sum(axis=1)).nlargest(30, 'total'))
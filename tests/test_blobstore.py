@@ -0,0 +1,22 @@
+from Tool.blobstore import BlobStore
+
+def write_files(directory):
+    directory.mkdir()
+    (directory / 'Acme_Corp_1690000000.txt').write_text('Data Scientist at Acme, Python and SQL.')
+    (directory / 'Globex_1690000001.txt').write_text('Data Engineer at Globex, Spark.')
+    (directory / 'notes.md').write_text('not a scan')
+
+def test_imported_text_files_are_moved(tmp_path):
+    write_files(tmp_path / 'text_input')
+    store = BlobStore(str(tmp_path / 'text_store'))
+    assert store.import_text_files(str(tmp_path / 'text_input')) == 2
+    assert sorted(path.name for path in (tmp_path / 'text_input').iterdir()) == ['notes.md']
+    assert [store.get(scan['record_id']) for scan in store.find('Acme Corp')] == ['Data Scientist at Acme, Python and SQL.']
+    # Nothing is left to import
+    assert store.import_text_files(str(tmp_path / 'text_input')) == 0
+
+def test_import_can_keep_the_files(tmp_path):
+    write_files(tmp_path / 'text_input')
+    store = BlobStore(str(tmp_path / 'text_store'))
+    assert store.import_text_files(str(tmp_path / 'text_input'), remove=False) == 2
+    assert len(list((tmp_path / 'text_input').iterdir())) == 3
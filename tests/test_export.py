@@ -0,0 +1,18 @@
+import os
+from Tool.export import POINTER_FILE, dataset_path, export_parquet, read_parquet
+from Tool.utils import append_json_to_file
+
+def test_export_keeps_foreign_directories(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    append_json_to_file('GPT-3.5', {'Company': 'Acme', 'cost': 0.01, 'role': 'Data relevant', 'scanned_at': 1.69e9})
+    os.makedirs(os.path.join('data', 'text_store'))
+    # Partitions of the unversioned layout are exported data, the app's own directories are not
+    os.makedirs(os.path.join('data', 'model=GPT-3.5', 'role=General'))
+    for _ in range(3):
+        assert export_parquet('data', models=('GPT-3.5',))['records'] == 1
+    names = sorted(os.listdir('data'))
+    versions = [name for name in names if name.startswith('v')]
+    assert len(versions) == 2
+    assert sorted(set(names) - set(versions)) == sorted([POINTER_FILE, 'LLM_output', 'text_store'])
+    assert os.path.basename(dataset_path('data')) in versions
+    assert read_parquet('data').column('Company').to_pylist() == ['Acme']
@@ -0,0 +1,95 @@
+import json
+import openai
+import pytest
+from Tool import batch
+from Tool.ingest import Checkpoint, ingest_run, iter_postings, posting_id
+
+DESCRIPTIONS = [f"Data Engineer #{index}. Build pipelines in Python and SQL, 3+ years of experience, full-time."
+                for index in range(6)]
+
+@pytest.fixture
+def dumps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'dumps').mkdir()
+    # The last posting of the JSONL dump repeats the first one of the CSV dump
+    with open(tmp_path / 'dumps' / 'a.csv', 'w') as f:
+        f.write('id,description\n' + ''.join(f'{index},"{text}"\n' for index, text in enumerate(DESCRIPTIONS[:3])))
+    with open(tmp_path / 'dumps' / 'b.jsonl', 'w') as f:
+        f.writelines(json.dumps({'description': text}) + '\n' for text in DESCRIPTIONS[3:] + DESCRIPTIONS[:1])
+    return ['dumps']
+
+@pytest.fixture
+def fake_batch_run(monkeypatch):
+    # Scans nothing: every posting gets the info chosen by the test, and the scanned IDs are recorded
+    scanned, infos = [], {}
+    def batch_run(model_name, role_name, items, budget_limit=None, **options):
+        for item_id, description in items:
+            scanned.append(item_id)
+            yield {'id': item_id, 'response': {'cost': 0.001}, 'info': infos.get(description)}
+    monkeypatch.setattr(batch, 'batch_run', batch_run)
+    return scanned, infos
+
+def run(paths, checkpoint, limit=None):
+    results = []
+    for result in ingest_run('GPT-3.5', 'General', paths, checkpoint, max_workers=2, store_data=False, use_cache=False):
+        results.append(result)
+        if len(results) == limit:
+            break
+    return results
+
+def test_duplicates_are_dropped_through_the_checkpoint(dumps, tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+    postings = list(iter_postings(dumps, seen=checkpoint))
+    assert [posting['id'] for posting in postings] == [posting_id(text) for text in DESCRIPTIONS]
+    assert postings[0]['source'] == 'dumps/a.csv:0' and postings[3]['source'] == 'dumps/b.jsonl'
+    assert len(list(iter_postings(dumps))) == 7
+
+def test_interrupted_run_resumes_where_it_stopped(dumps, tmp_path, fake_batch_run):
+    scanned, _ = fake_batch_run
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+    first = run(dumps, checkpoint, limit=2)
+    second = run(dumps, checkpoint)
+    assert [result['id'] for result in first + second] == [posting_id(text) for text in DESCRIPTIONS]
+    assert second[0]['source'] == 'dumps/a.csv:2'
+    assert checkpoint.summary() == {'done': {'None': 6}, 'cost': pytest.approx(0.006)}
+    # A third run has nothing left to scan
+    assert run(dumps, checkpoint) == []
+    assert len(scanned) == 6
+
+def test_only_final_results_are_checkpointed(dumps, tmp_path, fake_batch_run):
+    _, infos = fake_batch_run
+    infos.update({DESCRIPTIONS[1]: 'not_job', DESCRIPTIONS[2]: 'not_json', DESCRIPTIONS[3]: 'error',
+                  DESCRIPTIONS[4]: 'over_budget', DESCRIPTIONS[5]: 'flagged'})
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+    run(dumps, checkpoint)
+    assert checkpoint.summary()['done'] == {'None': 1, 'not_job': 1, 'flagged': 1}
+    # The next run retries the malformed, failed and over-budget postings only
+    infos.clear()
+    retried = run(dumps, checkpoint)
+    assert [result['id'] for result in retried] == [posting_id(text) for text in DESCRIPTIONS[2:5]]
+    assert checkpoint.summary()['done'] == {'None': 4, 'not_job': 1, 'flagged': 1}
+
+def test_checkpoint_survives_reopening(dumps, tmp_path, fake_batch_run):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+    run(dumps, checkpoint, limit=3)
+    checkpoint.close()
+    reopened = Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+    assert len(run(dumps, reopened)) == 3
+
+def test_resume_against_fake_endpoint(dumps, tmp_path, monkeypatch):
+    from benchmark.mock_server import MockConfig, start_mock_server
+    server = start_mock_server(MockConfig(latency_ms=1, sigma=0, moderation_latency_ms=1, seed=0))
+    monkeypatch.setattr(openai, 'api_base', server.api_base)
+    monkeypatch.setattr(openai, 'api_key', 'test')
+    try:
+        checkpoint = Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+        first = run(dumps, checkpoint, limit=2)
+        second = run(dumps, checkpoint)
+    finally:
+        server.shutdown()
+        server.server_close()
+    # The postings finished before the interruption are not scanned again
+    assert not {result['id'] for result in first} & {result['id'] for result in second}
+    assert sorted(result['id'] for result in first + second) == sorted(posting_id(text) for text in DESCRIPTIONS)
+    assert all(result['info'] is None for result in first + second)
+    assert sum(checkpoint.summary()['done'].values()) == 6
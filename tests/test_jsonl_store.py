@@ -0,0 +1,76 @@
+import os
+import json
+import threading
+import pytest
+from Tool import utils
+from Tool.utils import append_json_to_file, compact_json_file, iter_json_from_file, read_json_from_file
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # The store lives under data/ of the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, '_appends_since_compaction', 0)
+    return tmp_path
+
+def store_path(model_name='GPT-3.5'):
+    return os.path.join('data', 'LLM_output', model_name + '.jsonl')
+
+def test_append_writes_one_line_per_record():
+    for index in range(3):
+        append_json_to_file('GPT-3.5', {'Company': f'C{index}', 'DS_skills': ['Python']})
+    with open(store_path(), 'r') as f:
+        lines = f.read().splitlines()
+    assert [json.loads(line)['Company'] for line in lines] == ['C0', 'C1', 'C2']
+    assert list(iter_json_from_file('GPT-3.5')) == [json.loads(line) for line in lines]
+    assert read_json_from_file('GPT-4') == []
+
+def test_invalid_model_name():
+    with pytest.raises(ValueError):
+        append_json_to_file('GPT-5', {})
+
+def test_append_after_torn_line_starts_a_new_line():
+    append_json_to_file('GPT-3.5', {'Company': 'A'})
+    with open(store_path(), 'a') as f:
+        f.write('{"Company": "tor')
+    append_json_to_file('GPT-3.5', {'Company': 'B'})
+    # The torn line is skipped when reading and dropped by the compaction
+    assert [record['Company'] for record in iter_json_from_file('GPT-3.5')] == ['A', 'B']
+    assert compact_json_file('GPT-3.5') == 2
+    with open(store_path(), 'r') as f:
+        assert len(f.read().splitlines()) == 2
+
+def test_compaction_migrates_legacy_json_array():
+    os.makedirs(os.path.join('data', 'LLM_output'))
+    legacy_path = os.path.join('data', 'LLM_output', 'GPT-4.json')
+    with open(legacy_path, 'w') as f:
+        json.dump([{'Company': 'Old1'}, {'Company': 'Old2'}], f)
+    # The first append migrates the legacy records in front of the new ones
+    append_json_to_file('GPT-4', {'Company': 'New'})
+    assert not os.path.exists(legacy_path)
+    assert [record['Company'] for record in iter_json_from_file('GPT-4')] == ['Old1', 'Old2', 'New']
+
+def test_compaction_every_n_appends(monkeypatch):
+    monkeypatch.setattr(utils, 'COMPACT_EVERY', 5)
+    compactions = []
+    original = utils.compact_json_file
+    monkeypatch.setattr(utils, 'compact_json_file', lambda model_name: compactions.append(model_name) or original(model_name))
+    for index in range(12):
+        append_json_to_file('GPT-3.5', {'index': index})
+    assert compactions == ['GPT-3.5', 'GPT-3.5']
+    assert [record['index'] for record in iter_json_from_file('GPT-3.5')] == list(range(12))
+
+def test_concurrent_appends_keep_every_record():
+    def write(worker):
+        for index in range(50):
+            append_json_to_file('GPT-3.5', {'worker': worker, 'index': index})
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    records = list(iter_json_from_file('GPT-3.5'))
+    assert len(records) == 400
+    assert {(record['worker'], record['index']) for record in records} == {(w, i) for w in range(8) for i in range(50)}
+
+def test_compaction_without_store_is_a_no_op():
+    assert compact_json_file('GPT-3.5') == 0
@@ -0,0 +1,91 @@
+import pytest
+from Tool.dedup import NearDuplicateIndex, shingles
+
+POSTING = (
+    "Data Scientist - Acme Analytics (Full time, Remote). We are looking for a data scientist to join our growing "
+    "analytics team. You will build forecasting models, design experiments and present insights to product "
+    "managers. Requirements: 3+ years of experience with Python and SQL, a bachelor's degree in statistics, "
+    "computer science or a related field, and experience with cloud data warehouses. Nice to have: Spark, dbt "
+    "and Airflow. Benefits include health insurance, 401(k) matching and unlimited PTO. Salary range $120,000 - "
+    "$150,000. We are an equal opportunity employer."
+)
+# Same posting re-posted with a tracking footer and different whitespace
+REPOST = POSTING.replace('. ', '.  ') + "\n\nPosted via JobBoard, ref 88213."
+OTHER = (
+    "Registered Nurse, night shift. Provide patient care in a 30-bed surgical unit, administer medication and "
+    "coordinate with physicians. Requires an active RN license and BLS certification. $45 per hour."
+)
+SCOPE = 'GPT-3.5|Data relevant|v1'
+
+def jaccard(first, second):
+    a, b = set(shingles(first)), set(shingles(second))
+    return len(a & b) / len(a | b)
+
+@pytest.fixture
+def index():
+    return NearDuplicateIndex(':memory:')
+
+def test_shingles_ignore_case_punctuation_and_whitespace():
+    assert shingles('Python,  SQL and C++ skills', k=2) == ['and c++', 'c++ skills', 'python sql', 'sql and']
+    assert shingles('Two words', k=4) == ['two', 'words']
+    assert shingles('') == []
+
+def test_bands_must_divide_permutations():
+    with pytest.raises(ValueError):
+        NearDuplicateIndex(':memory:', num_perm=100, bands=16)
+
+def test_identical_text_matches_exactly(index):
+    document_id = index.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert index.lookup(POSTING, SCOPE) == (document_id, 1.0, {'Company': 'Acme'}, None)
+
+def test_repost_is_found_above_threshold(index):
+    index.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert jaccard(POSTING, REPOST) > 0.9
+    match = index.lookup(REPOST, SCOPE)
+    assert match is not None and match[2] == {'Company': 'Acme'}
+    # The MinHash estimate stays close to the exact Jaccard similarity
+    assert match[1] == pytest.approx(jaccard(POSTING, REPOST), abs=0.08)
+
+def test_different_posting_is_not_matched(index):
+    index.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert index.lookup(OTHER, SCOPE) is None
+
+def test_threshold_controls_matches():
+    strict = NearDuplicateIndex(':memory:', threshold=1.0)
+    strict.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert strict.lookup(REPOST, SCOPE) is None
+    assert strict.lookup(POSTING, SCOPE) is not None
+    # A posting with a rewritten half is found by a loose threshold only
+    half = POSTING[:len(POSTING) // 2] + ' ' + OTHER
+    similarity = jaccard(POSTING, half)
+    assert 0.2 < similarity < 0.7
+    loose = NearDuplicateIndex(':memory:', threshold=0.2, num_perm=128, bands=64)
+    loose.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert loose.lookup(half, SCOPE) is not None
+    default = NearDuplicateIndex(':memory:')
+    default.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert default.lookup(half, SCOPE) is None
+
+def test_results_are_shared_within_a_scope_only(index):
+    index.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    assert index.lookup(POSTING, 'GPT-4|Data relevant|v1') is None
+
+def test_most_similar_document_wins_and_match_is_recorded(index):
+    index.add(REPOST, SCOPE, {'Company': 'Repost'}, None)
+    document_id = index.add(POSTING, SCOPE, {'Company': 'Acme'}, None)
+    index.add(OTHER, SCOPE, {}, 'not_job')
+    match = index.lookup(POSTING, SCOPE)
+    assert match[:2] == (document_id, 1.0)
+    recorded = index._connect().execute("SELECT document_id, similarity FROM matches").fetchall()
+    assert recorded == [(document_id, 1.0)]
+
+def test_info_is_returned_with_the_response(index):
+    index.add(OTHER, SCOPE, {}, 'not_job')
+    assert index.lookup(OTHER, SCOPE)[2:] == ({}, 'not_job')
+
+@pytest.mark.parametrize('text', ['', '   ', '--- *** ---'])
+def test_text_without_shingles_is_neither_stored_nor_matched(index, text):
+    assert index.add(text, SCOPE, {}, 'not_job') is None
+    assert index.lookup(text, SCOPE) is None
+    assert index.lookup('!!!', SCOPE) is None
+    assert index._connect().execute("SELECT COUNT(*) FROM documents").fetchone()[0] == 0
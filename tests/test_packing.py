@@ -0,0 +1,32 @@
+import json
+import pytest
+from Tool.packing import _parse_pack
+from Tool.prompt import get_prompt
+
+FIELDS = get_prompt('Data relevant').fields
+RECORD = {'Company': 'Acme', 'Industry': 'Software', 'JobType': 'Full time', 'DS_skills': ['Python', 'SQL']}
+PACK = [RECORD, 'This is not a job description.', dict(RECORD, Company='Globex')]
+
+@pytest.mark.parametrize('response', [
+    json.dumps(PACK),
+    '```json\n' + json.dumps(PACK, indent=2) + '\n```',
+    'Here are the results for the 3 descriptions:\n' + json.dumps(PACK) + '\nLet me know if you need more.',
+    json.dumps(PACK)[:-1] + ',]',
+])
+def test_pack_is_extracted_from_fences_and_prose(response):
+    parsed = _parse_pack(response, 3, FIELDS)
+    assert [valid for valid, _ in parsed] == [True, True, True]
+    assert json.loads(parsed[0][1]) == RECORD and json.loads(parsed[2][1])['Company'] == 'Globex'
+    assert 'not a job description' in parsed[1][1].lower()
+
+@pytest.mark.parametrize('response', [
+    json.dumps(PACK[:2]),
+    json.dumps(RECORD),
+    'Sorry, I cannot help with that.',
+])
+def test_unusable_pack_fails_every_description(response):
+    assert _parse_pack(response, 3, FIELDS) == [(False, '')] * 3
+
+def test_invalid_elements_fail_alone():
+    parsed = _parse_pack(json.dumps([RECORD, 42, {'answer': '42'}]), 3, FIELDS)
+    assert [valid for valid, _ in parsed] == [True, False, False]
@@ -0,0 +1,73 @@
+import json
+import pytest
+from Tool.prompt import get_prompt
+from Tool.schema import NOT_MENTIONED, complete_record, parse_model_output
+
+FIELDS = get_prompt('Data relevant').fields
+RECORD = {
+    'Company': 'Acme', 'Industry': 'Software', 'Citizenship': 'not mentioned', 'Visa_policy': 'Will provide',
+    'JobType': 'Full time', 'YoE_year': '3', 'YoE_level': 'Senior', 'DS_skills': ['Python', 'SQL', 'Spark'],
+    'Domain_Knowledge': 'Retail', 'Min_Education': 'Bachelor',
+}
+
+def test_well_formed_output_is_not_repaired():
+    parsed = parse_model_output(json.dumps(RECORD), FIELDS)
+    assert parsed.record == RECORD
+    assert (parsed.invalid_fields, parsed.repaired) == ([], False)
+
+@pytest.mark.parametrize('response', [
+    '```json\n' + json.dumps(RECORD, indent=2) + '\n```',
+    'Here is the extracted information:\n' + json.dumps(RECORD) + '\nLet me know if you need anything else.',
+])
+def test_fences_and_prose_are_ignored(response):
+    assert parse_model_output(response, FIELDS).record == RECORD
+
+def test_trailing_commas_and_python_literals_are_repaired():
+    response = json.dumps(RECORD)[:-1] + ', "Extra": None, "Flag": True,}'
+    parsed = parse_model_output(response, FIELDS)
+    assert parsed.record == RECORD
+    assert parsed.repaired
+
+def test_raw_newline_in_string_is_repaired():
+    response = json.dumps(dict(RECORD, Domain_Knowledge='RETAIL_PLACEHOLDER')).replace('RETAIL_PLACEHOLDER', 'Retail\nand logistics')
+    parsed = parse_model_output(' ' + response, FIELDS)
+    assert parsed.record['Domain_Knowledge'] == 'Retail\nand logistics'
+    assert parsed.repaired
+
+def test_truncated_output_is_closed_and_missing_fields_reported():
+    response = '{"Company": "Acme", "Industry": "Software", "DS_skills": ["Python", "SQ'
+    parsed = parse_model_output(response, FIELDS)
+    assert parsed.record == {'Company': 'Acme', 'Industry': 'Software', 'DS_skills': ['Python', 'SQ']}
+    assert parsed.repaired
+    assert set(parsed.invalid_fields) == set(RECORD) - {'Company', 'Industry', 'DS_skills'}
+    completed = complete_record(parsed.record, FIELDS)
+    assert list(completed) == list(RECORD)
+    assert completed['Visa_policy'] == NOT_MENTIONED
+
+def test_keys_and_options_are_normalized():
+    response = json.dumps({
+        "Company's name": 'Acme', 'industry': 'Software', 'Visa Sponsor Policy': 'yes', 'job_type': 'full-time',
+        'Years of Experience level': 'senior', 'Minimum Education': "Master's degree", 'Citizenship': None,
+        'DS_skills': 'Python, SQL; Python', 'YoE_year': 3, 'Domain_Knowledge': ['Retail', 'Ads'],
+    })
+    parsed = parse_model_output(response, FIELDS)
+    assert parsed.record == {
+        'Company': 'Acme', 'Industry': 'Software', 'Citizenship': 'not mentioned', 'Visa_policy': 'Will provide',
+        'JobType': 'Full time', 'YoE_year': '3', 'YoE_level': 'Senior', 'DS_skills': ['Python', 'SQL'],
+        'Domain_Knowledge': 'Retail, Ads', 'Min_Education': 'Master',
+    }
+    assert parsed.invalid_fields == []
+
+def test_values_outside_the_options_are_kept_and_reported():
+    parsed = parse_model_output(json.dumps(dict(RECORD, JobType='Seasonal')), FIELDS)
+    assert parsed.record['JobType'] == 'Seasonal'
+    assert parsed.invalid_fields == ['JobType']
+
+@pytest.mark.parametrize('response', [
+    'Sorry, this does not look like a job description.',
+    '["Python", "SQL"]',
+    '{"answer": "42"}',
+    '{"Company": "Acme" "Industry": "Software"}',
+])
+def test_unrecoverable_output_has_no_record(response):
+    assert parse_model_output(response, FIELDS).record is None
@@ -0,0 +1,44 @@
+from Tool.preprocess import preprocess_job_description
+
+BENEFITS = "Benefits:\nHealth, dental and vision insurance. Unlimited paid time off. Free lunch every day."
+EEO = "We are an equal opportunity employer and value diversity at our company."
+
+def test_boilerplate_sections_and_sentences_are_dropped():
+    posting = ("Data Engineer\nResponsibilities:\nBuild batch and streaming pipelines in Python and SQL. "
+               "Own the quality of the warehouse tables used by the analytics team.\n"
+               "Requirements:\n3+ years of experience with Spark. Bachelor's degree required.\n" + BENEFITS + "\n" + EEO)
+    processed, stats = preprocess_job_description(posting)
+    assert 'Build batch and streaming pipelines' in processed
+    assert '3+ years of experience' in processed
+    assert 'dental' not in processed and 'equal opportunity' not in processed
+    assert stats['tokens_saved'] > 0
+
+def test_title_naming_a_boilerplate_section_is_not_a_heading():
+    for title in ('Privacy Engineer', 'Benefits Analyst', 'Legal Counsel'):
+        posting = (f"{title}\nYou will design the tooling of our platform team and review the work of two engineers.\n"
+                   "Requirements:\nPython, 5 years of experience.\n" + BENEFITS)
+        processed, _ = preprocess_job_description(posting)
+        assert processed.startswith(f"{title}\nYou will design the tooling")
+        assert 'Python, 5 years of experience.' in processed
+        assert 'dental' not in processed
+
+def test_text_before_the_first_heading_is_kept():
+    # A posting opening with a boilerplate section name keeps it: the title and summary come first
+    posting = "Benefits\nThe benefits team runs payroll and insurance for 3,000 employees.\nResponsibilities:\nRun payroll."
+    processed, _ = preprocess_job_description(posting)
+    assert processed.startswith('Benefits\nThe benefits team runs payroll')
+
+def test_posting_is_never_stripped_to_nothing():
+    posting = ("About the team\nWe are small.\n" + BENEFITS + " Commuter benefits. Gym membership. "
+               "Yearly learning budget. Team offsites twice a year. Home office stipend. Wellness days.")
+    processed, stats = preprocess_job_description(posting)
+    # Stripping would keep less than a quarter of the posting: it is sent unstripped instead
+    assert processed == '\n'.join(line for line in posting.splitlines())
+    assert stats['tokens_saved'] == 0
+
+def test_token_budget_keeps_protected_sentences():
+    posting = ' '.join(f"Filler sentence number {index} about the team." for index in range(200)) \
+        + " Visa sponsorship is not available."
+    processed, stats = preprocess_job_description(posting, token_budget=50)
+    assert 'Visa sponsorship is not available.' in processed
+    assert stats['processed_tokens'] <= 50
@@ -0,0 +1,97 @@
+import json
+import os
+import pytest
+from Tool.database import ResultIndex
+from Tool.utils import append_json_to_file
+
+RECORDS = [
+    ('GPT-3.5', 'Data relevant', {'Company': 'Acme', 'Industry': 'Software', 'Visa_policy': 'Will provide',
+                                  'YoE_level': 'Senior', 'DS_skills': ['Python', 'SQL', 'Spark']}),
+    ('GPT-3.5', 'Data relevant', {'Company': 'Globex', 'Industry': 'Finance', 'Visa_policy': 'Will not provide',
+                                  'YoE_level': 'Senior', 'DS_skills': 'python, Tableau'}),
+    ('GPT-4', 'Software Engineer', {'Company': 'Initech', 'Industry': 'Software', 'Visa_policy': 'Will provide',
+                                    'YoE_level': 'Junior', 'Languages': ['Python', 'Go'], 'SE_skills': ['Kubernetes']}),
+]
+
+@pytest.fixture
+def index(tmp_path):
+    index = ResultIndex(str(tmp_path / 'index.sqlite'))
+    for model_name, role_name, record in RECORDS:
+        index.add(model_name, role_name, record)
+    return index
+
+def test_query_filters_are_combined_and_case_insensitive(index):
+    rows = index.query(yoe_level='senior', visa_policy='WILL PROVIDE', skills=['python'])
+    assert [row['Company'] for row in rows] == ['Acme']
+    assert rows[0]['model'] == 'GPT-3.5' and rows[0]['role'] == 'Data relevant'
+
+def test_query_returns_newest_first_with_limit(index):
+    assert [row['Company'] for row in index.query()] == ['Initech', 'Globex', 'Acme']
+    assert [row['Company'] for row in index.query(limit=1)] == ['Initech']
+    assert len(index.query(limit=None)) == 3
+
+def test_skills_match_any_list_field(index):
+    # Python is a DS skill of Acme and Globex (comma separated) and a language of Initech
+    assert index.count(skills=['Python']) == 3
+    assert index.count(skills=['Python', 'Go']) == 1
+    assert index.count(skills=['Python'], model='GPT-3.5') == 2
+    assert index.count(role='Software Engineer') == 1
+    assert index.count(skills=['COBOL']) == 0
+
+def test_none_filters_are_ignored(index):
+    assert index.count(industry=None) == 3
+
+def test_invalid_filter(index):
+    with pytest.raises(ValueError):
+        index.query(salary='100k')
+
+def test_top_skills(index):
+    assert index.top_skills(limit=1) == [('Python', 3)]
+    assert dict(index.top_skills(source='Languages')) == {'Python': 1, 'Go': 1}
+    assert dict(index.top_skills(industry='Finance')) == {'python': 1, 'Tableau': 1}
+
+def test_rollups_follow_inserts(index):
+    fields = index.field_rollup(role='Data relevant')
+    assert ('Data relevant', 'Software', 'records', '', 1) in fields
+    assert ('Data relevant', 'Finance', 'visa_policy', 'Will not provide', 1) in fields
+    assert ('Data relevant', 'Software', 'min_education', 'not mentioned', 1) in fields
+    skills = index.skill_rollup()
+    assert ('Software Engineer', 'Software', 'Kubernetes', 1) in skills
+    assert len([row for row in skills if row[2].lower() == 'python']) == 3
+
+def test_rebuild_rollups_matches_incremental(index):
+    fields, skills = sorted(index.field_rollup()), sorted(index.skill_rollup())
+    index.rebuild_rollups()
+    assert sorted(index.field_rollup()) == fields
+    assert sorted(index.skill_rollup()) == skills
+
+def test_new_index_is_backfilled_from_history(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    append_json_to_file('GPT-3.5', dict(RECORDS[0][2], cost=0.01, role='Data relevant', text_id='t1', scanned_at=1.69e9))
+    # Older records have no role: their list fields tell
+    append_json_to_file('GPT-4', RECORDS[2][2])
+    index = ResultIndex(os.path.join('data', 'index.sqlite'), history_models=('GPT-3.5', 'GPT-4'))
+    rows = index.query()
+    assert [(row['model'], row['role'], row['Company']) for row in rows] == [
+        ('GPT-4', 'Software Engineer', 'Initech'), ('GPT-3.5', 'Data relevant', 'Acme')]
+    assert 'cost' not in rows[1] and 'text_id' not in rows[1]
+    assert ('Data relevant', 'Software', 'records', '', 1) in index.field_rollup()
+    # Reopening an index that already has records doesn't import the history again
+    assert ResultIndex(os.path.join('data', 'index.sqlite'), history_models=('GPT-3.5', 'GPT-4')).count() == 2
+
+def test_stored_scan_is_indexed_once(tmp_path, monkeypatch):
+    from Tool import llm_comp
+    from Tool.blobstore import BlobStore
+    monkeypatch.chdir(tmp_path)
+    # A new index next to the history: the scan is appended to the history before it is indexed
+    monkeypatch.setattr(llm_comp, 'result_index', ResultIndex(os.path.join('data', 'index.sqlite'),
+                                                              history_models=('GPT-3.5', 'GPT-4')))
+    monkeypatch.setattr(llm_comp, 'text_store', BlobStore())
+    context = llm_comp.ScanContext('GPT-3.5', 'Data relevant', 'Data Scientist at Acme, Python and SQL.',
+                                   None, None, None, '')
+    response_dict, info = llm_comp.finalize_scan(context, json.dumps(RECORDS[0][2]),
+                                                 {'prompt_tokens': 100, 'completion_tokens': 50}, store_data=True)
+    assert info is None and response_dict['Company'] == 'Acme'
+    assert llm_comp.result_index.count() == 1
+    assert llm_comp.result_index.count(role='Data relevant', company='Acme') == 1
+    assert ('Data relevant', 'Software', 'records', '', 1) in llm_comp.result_index.field_rollup()
@@ -0,0 +1,154 @@
+import time
+import asyncio
+import openai
+import pytest
+from benchmark.mock_server import MockConfig, start_mock_server
+from Tool.scheduler import RequestScheduler, TokenBucket, is_retryable_error
+
+MESSAGES = [{'role': 'user', 'content': 'Data Scientist. Python, SQL, 3+ years of experience.'}]
+
+@pytest.fixture
+def mock_server():
+    servers = []
+    def start(**config):
+        server = start_mock_server(MockConfig(latency_ms=1, sigma=0, moderation_latency_ms=1, seed=0, **config))
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def create(server):
+    return lambda: openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=MESSAGES, api_key='test',
+                                                api_base=server.api_base, request_timeout=10)
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)
+    assert bucket.time_until(60) == 0
+    bucket.consume(60)
+    assert bucket.time_until(1) == pytest.approx(1.0, abs=0.05)
+    # Amounts above the capacity wait for a full bucket only
+    assert bucket.time_until(600) == pytest.approx(60.0, abs=0.1)
+    bucket.refund(1000)
+    assert bucket.tokens == 60
+
+def test_acquire_meters_requests_per_minute():
+    scheduler = RequestScheduler(requests_per_minute=120)
+    for _ in range(120):
+        assert scheduler.acquire() == pytest.approx(0, abs=0.01)
+    start = time.monotonic()
+    scheduler.acquire()
+    assert time.monotonic() - start == pytest.approx(0.5, abs=0.1)
+
+def test_settle_returns_unused_tokens():
+    scheduler = RequestScheduler(requests_per_minute=1000, tokens_per_minute=6000)
+    scheduler.acquire(6000)
+    scheduler.settle(6000, 100)
+    assert scheduler.token_bucket.time_until(5000) == 0
+
+def test_backoff_delay_is_jittered_exponential():
+    scheduler = RequestScheduler(requests_per_minute=1000, base_delay=1.0, max_delay=8.0)
+    for attempt in range(6):
+        delay = scheduler.backoff_delay(attempt)
+        ceiling = min(8.0, 2 ** attempt)
+        assert ceiling / 2 <= delay <= ceiling
+
+def test_call_succeeds_against_fake_endpoint(mock_server):
+    server = mock_server()
+    scheduler = RequestScheduler(requests_per_minute=1000)
+    response = scheduler.call(create(server), estimated_tokens=100)
+    assert response['choices'][0]['message']['content']
+    assert scheduler.metrics()['requests'] == 1
+    assert server.counters['completions'] == 1
+
+def test_call_honours_retry_after_then_gives_up(mock_server):
+    server = mock_server(rate_limit_rate=1.0, retry_after=0.3)
+    scheduler = RequestScheduler(requests_per_minute=1000, max_retries=2, base_delay=0.01)
+    start = time.monotonic()
+    with pytest.raises(openai.error.RateLimitError):
+        scheduler.call(create(server))
+    # Two retries, each delayed by the Retry-After header rather than the 10 ms backoff
+    assert time.monotonic() - start >= 0.6
+    assert server.counters['rate_limited'] == 3
+    metrics = scheduler.metrics()
+    assert (metrics['requests'], metrics['retries'], metrics['failures']) == (3, 2, 1)
+
+def test_call_retries_server_errors(mock_server):
+    server = mock_server(error_rate=1.0)
+    scheduler = RequestScheduler(requests_per_minute=1000, max_retries=3, base_delay=0.01)
+    with pytest.raises(openai.error.APIError):
+        scheduler.call(create(server))
+    assert server.counters['errors'] == 4
+    assert scheduler.metrics()['retries'] == 3
+
+def test_call_does_not_retry_client_errors():
+    scheduler = RequestScheduler(requests_per_minute=1000, base_delay=0.01)
+    calls = []
+    def invalid_request():
+        calls.append(1)
+        raise openai.error.InvalidRequestError('Bad request.', param=None)
+    with pytest.raises(openai.error.InvalidRequestError):
+        scheduler.call(invalid_request)
+    assert len(calls) == 1
+    assert scheduler.metrics()['retries'] == 0
+
+def test_is_retryable_error():
+    assert is_retryable_error(openai.error.RateLimitError('429'))
+    assert is_retryable_error(openai.error.APIError('502', http_status=502))
+    assert not is_retryable_error(openai.error.APIError('400', http_status=400))
+    assert not is_retryable_error(openai.error.AuthenticationError('401'))
+    assert not is_retryable_error(ValueError('not an API error'))
+
+def test_acall_retries_until_success():
+    scheduler = RequestScheduler(requests_per_minute=1000, base_delay=0.01)
+    attempts = []
+    async def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise openai.error.RateLimitError('Rate limit reached.', headers={'retry-after': '0.2'})
+        return 'ok'
+    assert asyncio.run(scheduler.acall(flaky)) == 'ok'
+    assert len(attempts) == 3
+    assert attempts[1] - attempts[0] >= 0.2
+    assert scheduler.metrics()['retries'] == 2
+
+def test_attempts_are_settled_with_their_usage():
+    scheduler = RequestScheduler(requests_per_minute=1000, tokens_per_minute=6000, base_delay=0.01)
+    attempts = []
+    async def rejected_twice():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise openai.error.RateLimitError('Rate limit reached.', http_status=429)
+        return {'usage': {'total_tokens': 100}}
+    asyncio.run(scheduler.acall(rejected_twice, estimated_tokens=3000))
+    # The rejected attempts are refunded, the last one is charged its reported usage
+    assert scheduler.token_bucket.tokens == pytest.approx(5900, abs=20)
+
+def test_failed_attempt_of_unknown_outcome_keeps_its_estimate():
+    scheduler = RequestScheduler(requests_per_minute=1000, tokens_per_minute=6000, max_retries=0)
+    def server_error():
+        raise openai.error.APIError('Bad gateway.', http_status=502)
+    with pytest.raises(openai.error.APIError):
+        scheduler.call(server_error, estimated_tokens=3000)
+    assert scheduler.token_bucket.tokens == pytest.approx(3000, abs=20)
+
+def test_call_settles_reported_usage_against_fake_endpoint(mock_server):
+    server = mock_server()
+    scheduler = RequestScheduler(requests_per_minute=1000, tokens_per_minute=6000)
+    response = scheduler.call(create(server), estimated_tokens=5000)
+    assert scheduler.token_bucket.tokens == pytest.approx(6000 - response['usage']['total_tokens'], abs=20)
+
+def test_cancelled_waiter_takes_no_quota():
+    scheduler = RequestScheduler(requests_per_minute=60)
+    scheduler.acquire(0)
+    scheduler.request_bucket.consume(scheduler.request_bucket.tokens)
+    async def scenario():
+        waiter = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0.05)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    asyncio.run(scenario())
+    assert scheduler.metrics()['queue_depth'] == 0
+    assert scheduler.metrics()['requests'] == 1
@@ -0,0 +1,34 @@
+import openai
+import pytest
+from Tool import llm_comp
+from Tool.budget import BudgetLedger
+
+POSTING = ("Data Scientist at Acme Analytics, full time. Build forecasting models in Python and SQL and present "
+           "insights to product managers. 3+ years of experience and a bachelor's degree required.")
+
+@pytest.fixture
+def endpoint(monkeypatch):
+    from benchmark.mock_server import MockConfig, start_mock_server
+    server = start_mock_server(MockConfig(latency_ms=1, sigma=0, moderation_latency_ms=1, seed=0))
+    monkeypatch.setattr(openai, 'api_base', server.api_base)
+    monkeypatch.setattr(openai, 'api_key', 'test')
+    monkeypatch.setattr(llm_comp, 'deploy_budget_ledger', BudgetLedger(':memory:'))
+    yield
+    server.shutdown()
+    server.server_close()
+
+def test_streamed_cost_is_labelled_as_estimate(endpoint):
+    fields = []
+    response, info = llm_comp.llm_deploy_run('GPT-3.5', 'Data relevant', POSTING, use_cache=False,
+                                             on_field=lambda key, value: fields.append(key))
+    assert info is None and fields
+    assert response['cost'] > 0 and response['cost_estimated'] is True
+    [row] = llm_comp.deploy_budget_ledger.summary()
+    assert row['estimated_cost'] == pytest.approx(row['cost'])
+
+def test_reported_cost_is_not_labelled(endpoint):
+    response, info = llm_comp.llm_deploy_run('GPT-3.5', 'Data relevant', POSTING, use_cache=False)
+    assert info is None
+    assert 'cost_estimated' not in response
+    [row] = llm_comp.deploy_budget_ledger.summary()
+    assert row['estimated_cost'] == 0